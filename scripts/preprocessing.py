@@ -1,13 +1,25 @@
 import fire
 from so_study.load_so_data import transform_raw_edit_data_to_pt_format
+from so_study.trajectory_store import pack_trajectory_directory, sparsify_trajectory_directory
+from so_study.badge_index import build_badge_index
 from reputation_study.data_preprosessor import (
     create_reputation_dataset,
-    create_dataset
+    create_dataset,
+    create_datasets
 )
+from reputation_study.pipeline import run_reputation_pipeline
+from reputation_study.convert_so_data_to_pandas import dump_pandas_dataframes, dump_spark_reputation_dataset
 
 if __name__ == '__main__':
     fire.Fire({
         'transform_raw_edit_data_to_pt_format': transform_raw_edit_data_to_pt_format,
         "create_reputation_dataset": create_reputation_dataset,
         "create_dataset": create_dataset,
+        "create_datasets": create_datasets,
+        "run_reputation_pipeline": run_reputation_pipeline,
+        "convert_so_data_to_pandas": dump_pandas_dataframes,
+        "create_reputation_dataset_spark": dump_spark_reputation_dataset,
+        "pack_trajectories": pack_trajectory_directory,
+        "sparsify_trajectories": sparsify_trajectory_directory,
+        "build_badge_index": build_badge_index,
     })
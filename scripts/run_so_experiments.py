@@ -159,7 +159,7 @@ experiment_options = {
 }
 
 
-def run_experiment(on: str = "electorate", resume: bool = False):
+def run_experiment(on: str = "electorate", resume: bool = False, backend: str = "pt"):
 
     settings = experiment_options[on.lower()]
 
@@ -181,19 +181,22 @@ def run_experiment(on: str = "electorate", resume: bool = False):
     training_set = settings.dataset(
         data_path=settings.data_path,
         dset_type="train",
-        threshold_achievement=settings.threshold_achievement
+        threshold_achievement=settings.threshold_achievement,
+        backend=backend
     )
 
     validation_set = settings.dataset(
         data_path=settings.data_path,
         dset_type="validate",
-        threshold_achievement=settings.threshold_achievement
+        threshold_achievement=settings.threshold_achievement,
+        backend=backend
     )
 
     testing_set = settings.dataset(
         data_path=settings.data_path,
         dset_type="test",
-        threshold_achievement=settings.threshold_achievement
+        threshold_achievement=settings.threshold_achievement,
+        backend=backend
     )
 
     all_set = settings.dataset(
@@ -201,6 +204,7 @@ def run_experiment(on: str = "electorate", resume: bool = False):
         dset_type="all",
         threshold_achievement=settings.threshold_achievement,
         subsample=False,
+        backend=backend
     )
 
     train_loader = torch.utils.data.DataLoader(training_set, **loader_params)
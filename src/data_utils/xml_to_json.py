@@ -1,10 +1,37 @@
 import xml.etree.ElementTree as ET
 from tqdm import tqdm
-import libarchive.public
 import json
+import re
+from functools import partial
 
+from so_study.io_utils import map_processes
 
-def default_archive_to_json(input_dir, output_dir=None):
+try:
+    import libarchive.public
+except ImportError:
+    # only needed to read the archives, the rows can be parsed without it
+    libarchive = None
+
+
+# the integer columns of the dump tables, their values are converted without the int_like_re check first
+SCHEMAS = {
+    'Users': {
+        'Id': int, 'Reputation': int, 'Views': int, 'UpVotes': int, 'DownVotes': int, 'AccountId': int,
+    },
+    'Posts': {
+        'Id': int, 'PostTypeId': int, 'AcceptedAnswerId': int, 'ParentId': int, 'Score': int, 'ViewCount': int,
+        'OwnerUserId': int, 'LastEditorUserId': int, 'AnswerCount': int, 'CommentCount': int, 'FavoriteCount': int,
+    },
+    'PostHistory': {
+        'Id': int, 'PostHistoryTypeId': int, 'PostId': int, 'UserId': int,
+    },
+    'Votes': {
+        'Id': int, 'PostId': int, 'VoteTypeId': int, 'UserId': int, 'BountyAmount': int,
+    },
+}
+
+
+def default_archive_to_json(input_dir, output_dir=None, num_workers=None, ordered=True):
     if output_dir is None:
         output_dir = input_dir
     for table, no_write in [
@@ -17,10 +44,19 @@ def default_archive_to_json(input_dir, output_dir=None):
             archive = f'{input_dir}/stackoverflow.com-{table}.7z',
             json_file = f'{output_dir}/{table}.json',
             no_write = no_write,
+            table = table,
+            num_workers = num_workers,
+            ordered = ordered,
         )
 
 
-def archive_to_json(archive, json_file, no_write):
+def archive_to_json(archive, json_file, no_write, table=None, num_workers=None, ordered=True, batch_size=20000):
+    """
+    With ``num_workers`` the rows are parsed by a pool of processes with parse_row and the column types of
+    SCHEMAS[table], ``batch_size`` lines at a time, giving the same json as the serial parse. ``ordered=False`` writes the batches as they finish instead of in archive order.
+    """
+    if num_workers is not None:
+        return archive_to_json_parallel(archive, json_file, no_write, table, num_workers, ordered, batch_size)
     with open(json_file, 'w') as f:
         for d in tqdm(load_archive(archive), desc=archive):
             for c in no_write:
@@ -29,21 +65,50 @@ def archive_to_json(archive, json_file, no_write):
             f.write(json.dumps(d) + '\n')
 
 
+def archive_to_json_parallel(archive, json_file, no_write, table, num_workers=None, ordered=True, batch_size=20000):
+    convert = partial(convert_batch, schema=SCHEMAS.get(table), no_write=frozenset(no_write))
+    with libarchive.public.file_reader(archive) as e, open(json_file, 'w') as f, tqdm(desc=archive) as progress:
+        entry = next(e)
+        for rows, text in map_processes(convert, batches(split_lines(entry.get_blocks()), batch_size),
+                                        num_workers, ordered):
+            f.write(text)
+            progress.update(rows)
+
+
+def batches(lines, batch_size):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def load_archive(archive):
     with libarchive.public.file_reader(archive) as e:
         entry = next(e)
-        buf = b''
-        for block in entry.get_blocks():
-            buf += block
-            try:
-                ss = buf.decode('utf8').split('\n')
-            except UnicodeDecodeError:
-                continue
-            for s in ss[:-1]:
-                d = parse(s)
-                if d is not None:
-                    yield d
-            buf = ss[-1].encode('utf8')
+        for s in split_lines(entry.get_blocks()):
+            d = parse(s)
+            if d is not None:
+                yield d
+
+
+def split_lines(blocks):
+    """
+    Decoded lines of a stream of utf8 blocks. b'\n' never occurs inside a multi-byte character, so the blocks are
+    split on bytes and only the trailing partial line is carried over to the next block.
+    """
+    rest = b''
+    for block in blocks:
+        lines = block.split(b'\n')
+        lines[0] = rest + lines[0]
+        rest = lines.pop()
+        for line in lines:
+            yield line.decode('utf8')
+    if rest:
+        yield rest.decode('utf8')
 
 
 int_lim = 1<<63
@@ -63,6 +128,71 @@ def parse(line):
         return None
 
 
+row_re = re.compile(r'\s*<row\s(.*)/>\s*$')
+attribute_re = re.compile(r'([\w:.-]+)\s*=\s*"([^"]*)"')
+whitespace = str.maketrans('\t\n\r', '   ')
+# the only references xml knows: the five predefined entities and numeric character references
+reference_re = re.compile(r'&(?:(lt|gt|amp|quot|apos)|#([0-9]+)|#x([0-9a-fA-F]+));')
+entities = {'lt': '<', 'gt': '>', 'amp': '&', 'quot': '"', 'apos': "'"}
+# int() only accepts strings starting like this, anything else is a string without trying the conversion
+int_like_re = re.compile(r'\s*[-+]?\d')
+
+
+def xml_reference(m):
+    if m.group(1) is not None:
+        return entities[m.group(1)]
+    return chr(int(m.group(2))) if m.group(2) is not None else chr(int(m.group(3), 16))
+
+
+def xml_unescape(value):
+    """The unescaped value, None when it has an '&' that is not a reference (the xml parser rejects the row)"""
+    if '&' not in value:
+        return value
+    unescaped, n = reference_re.subn(xml_reference, value)
+    return unescaped if value.count('&') == n else None
+
+
+def parse_row(line, schema=None):
+    """
+    parse for the one-row lines of the dumps, without building an element: the attributes are matched with a
+    regex and unescaped the way the xml parser does. Values get the same conversion as try_int, so the output is the
+    same as parse; the columns ``schema`` types as int (the dumps hold integers there) skip the int_like_re check.
+    """
+    m = row_re.match(line)
+    if m is None:
+        return None
+    # the same attribute value normalization as the xml parser: literal whitespace becomes a space
+    dic = {k: xml_unescape(v.translate(whitespace)) for k, v in attribute_re.findall(m.group(1))}
+    if None in dic.values():
+        return None
+    schema = {} if schema is None else schema
+    for k, v in dic.items():
+        convert = schema.get(k)
+        if convert is None and int_like_re.match(v):
+            convert = int
+        if convert is not None:
+            try:
+                n = convert(v)
+            except ValueError:
+                continue
+            if -int_lim < n < int_lim:
+                dic[k] = n
+    return dic
+
+
+def convert_batch(lines, schema=None, no_write=frozenset()):
+    """The json lines of a batch of xml lines and the number of rows in it"""
+    out = []
+    for line in lines:
+        d = parse_row(line, schema)
+        if d is None:
+            continue
+        for c in no_write:
+            d.pop(c, None)
+        out.append(json.dumps(d) + '\n')
+    return len(out), ''.join(out)
+
+
 if __name__ == "__main__":
     in_folder = "/Volumes/Seagate Backup Plus Drive/"
     default_archive_to_json("")
\ No newline at end of file
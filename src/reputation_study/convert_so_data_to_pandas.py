@@ -1,7 +1,24 @@
-from pyspark.sql import SparkSession
-import pyspark.sql.functions as F
-from pyspark.sql import Window
+import io
+import os
+import gzip
 import datetime
+import itertools
+
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from reputation_study.data_preprosessor import dump_activity_dataset
+from so_study.io_utils import map_processes
+
+try:
+    from pyspark.sql import SparkSession
+    import pyspark.sql.functions as F
+    from pyspark.sql import Window
+except ImportError:
+    # only needed by the "spark" backend
+    SparkSession = F = Window = None
 
 
 def get_spark(appName, mem, cores):
@@ -36,8 +53,7 @@ def add_timeid(D, col_in, col_out='WeekId', time_type="week", start_date=datetim
     )
 
 
-def compute_pandas_dataframes(users, posts, reps, min_rep, max_rep, time_type="week"):
-    assert time_type in ["week", "day"]
+def join_users(users, posts, reps, min_rep, max_rep, time_type="week"):
     U = (
         users
             .select(
@@ -72,6 +88,13 @@ def compute_pandas_dataframes(users, posts, reps, min_rep, max_rep, time_type="w
     UP = add_timeid(U.join(P, on=U.UserId == P.PostUserId, how='inner'), 'PostCreationTime', 'PostTimeId', time_type=time_type)
     UR = add_timeid(U.join(R, on=U.UserId == R.RepUserId, how='inner'), 'RepTime', 'RepTimeId', time_type=time_type)
 
+    return U, UP, UR
+
+
+def compute_pandas_dataframes(users, posts, reps, min_rep, max_rep, time_type="week"):
+    assert time_type in ["week", "day"]
+    U, UP, UR = join_users(users, posts, reps, min_rep, max_rep, time_type=time_type)
+
     users_df = U.toPandas()
     posts_df = UP.groupby('UserId', 'PostTimeId', 'PostTypeId').agg(
         F.count('PostUserId').alias('Count'),
@@ -84,22 +107,343 @@ def compute_pandas_dataframes(users, posts, reps, min_rep, max_rep, time_type="w
     return users_df, posts_df, reps_df
 
 
-def get_dataframe_from_spark():
-    # data_dir = "../../data/"
-    threshold = 200
-    data_dir = "/Volumes/Seagate Backup Plus Drive/so_data/"
-    users_df, posts_df, reps_df = get_spark_dataframes(f"{data_dir}/raw")
-    print("Read into Spark")
-    users_df, posts_df, reps_df = compute_pandas_dataframes(users_df, posts_df, reps_df, min_rep=threshold-10, max_rep=500000, time_type="week")
+def compute_activity_windows(users, posts, reps, min_rep, max_rep, threshold_achievement, target_reputation,
+                             reputation_range, time_type="week"):
+    """
+    data_preprosessor.load_and_transform_data inside the Spark job: the cumulative reputation and the crossing
+    TimeId come from window functions and only the zero-filled [t-ta, t+ta] windows of the eligible users are
+    collected. Returns the user ids, their (users x 4 x 2ta+1) questions/answers/edits/reputation windows and the
+    last time id of the data.
+    """
+    assert time_type in ["week", "day"]
+    ta = threshold_achievement
+    U, UP, UR = join_users(users, posts, reps, min_rep, max_rep, time_type=time_type)
+
+    by_user = Window.partitionBy('UserId')
+    up_to_now = Window.unboundedPreceding, Window.currentRow
+
+    # reputation per TimeId as load_data and rename_post_time leave it (rows without a PostTypeId are dropped),
+    # without the users ending below the target (drop_unwanted_users)
+    reputation = (
+        UR
+        .filter(F.col('PostTypeId').isNotNull() & F.col('RepTimeId').isNotNull())
+        .withColumnRenamed('RepTimeId', 'TimeId')
+        .groupby('UserId', 'TimeId')
+        .agg(F.sum(F.coalesce(F.col('RepDelta'), F.lit(0))).alias('Sum'))
+        .withColumn('Total', F.sum('Sum').over(by_user))
+        .filter(F.col('Total') >= target_reputation)
+        .withColumn('Reputation', F.sum('Sum').over(by_user.orderBy('TimeId').rowsBetween(*up_to_now)))
+        .cache()
+    )
+    min_col, max_col = reputation.agg(F.min('TimeId'), F.max('TimeId')).first()
+
+    crossings = (
+        reputation
+        .filter(F.col('Reputation') >= target_reputation)
+        .groupby('UserId')
+        .agg(F.min('TimeId').alias('Crossing'))
+        .filter((F.col('Crossing') - ta - min_col > 0) & (F.col('Crossing') + ta < max_col - 1))
+    )
+
+    # [t-ta-1, t+ta+1] for every crossing user, the outer two are only used for the eligibility filters
+    grid = crossings.select(
+        'UserId',
+        F.posexplode(F.sequence(F.col('Crossing') - ta - 1, F.col('Crossing') + ta + 1)).alias('Position', 'TimeId')
+    )
+
+    # the reputation at every grid time is the last event at or before it (or, before any event, the first one):
+    # the forward and backward filled pivot of preprocess_dfs
+    in_time_order = by_user.orderBy('TimeId', F.col('Position').asc_nulls_first())
+    filled = (
+        grid
+        .select('UserId', 'TimeId', F.lit(None).cast('long').alias('Reputation'), 'Position')
+        .unionByName(
+            reputation
+            .join(crossings.select('UserId'), 'UserId')
+            .select('UserId', 'TimeId', 'Reputation', F.lit(None).cast('int').alias('Position'))
+        )
+        .withColumn('Reputation', F.coalesce(
+            F.last('Reputation', ignorenulls=True).over(in_time_order.rowsBetween(*up_to_now)),
+            F.first('Reputation', ignorenulls=True).over(
+                in_time_order.rowsBetween(Window.unboundedPreceding, Window.unboundedFollowing)),
+        ))
+        .filter(F.col('Position').isNotNull())
+    )
+
+    eligible = (
+        filled
+        .groupby('UserId')
+        .agg(
+            F.max(F.when(F.col('Position') == 0, F.col('Reputation'))).alias('Before'),
+            F.max(F.when(F.col('Position') == 2 * ta + 2, F.col('Reputation'))).alias('After'),
+        )
+        .filter((F.col('After') <= reputation_range[1]) & (F.col('Before') >= reputation_range[0]))
+        .select('UserId')
+    )
+
+    # questions, answers and edits (add_edits: one per "edit" reputation row) per TimeId
+    counts = (
+        UP
+        .select('UserId', F.col('PostTimeId').alias('TimeId'), 'PostTypeId')
+        .unionByName(
+            UR
+            .filter((F.col('RepText') == 'edit') & F.col('RepTimeId').isNotNull())
+            .select('UserId', F.col('RepTimeId').alias('TimeId'), F.lit(3).alias('PostTypeId'))
+        )
+        .groupby('UserId', 'TimeId')
+        .pivot('PostTypeId', [1, 2, 3])
+        .count()
+        .withColumnRenamed('1', 'Questions')
+        .withColumnRenamed('2', 'Answers')
+        .withColumnRenamed('3', 'Edits')
+    )
+
+    channels = ['Questions', 'Answers', 'Edits', 'Reputation']
+    windows = (
+        filled
+        .join(eligible, 'UserId')
+        .filter((F.col('Position') >= 1) & (F.col('Position') <= 2 * ta + 1))
+        .join(counts, ['UserId', 'TimeId'], 'left')
+        .select('UserId', 'Position', *[F.coalesce(F.col(c), F.lit(0)).alias(c) for c in channels])
+        .toPandas()
+    )
+    reputation.unpersist()
+
+    user_ids, rows = np.unique(windows.UserId.values.astype(np.int64), return_inverse=True)
+    activities = np.zeros((len(user_ids), len(channels), 2 * ta + 1), dtype=np.int64)
+    activities[rows, :, windows.Position.values - 1] = windows[channels].values
+    return user_ids, activities, max_col
+
+
+def dump_spark_reputation_dataset(
+        data_dir: str = "/Volumes/Seagate Backup Plus Drive/so_data/",
+        out_data_path: str = 'data/reputation_data',
+        threshold: int = 200,
+        threshold_achievement: int = 70,
+        target_reputation: int = 500,
+        reputation_range_u: int = 1000,
+        reputation_range_l: int = 250,
+        time_type: str = "week",
+        split: str = 'random'
+):
+    """create_reputation_dataset straight from the json files, with the windows computed by Spark"""
+    users, posts, reps = get_spark_dataframes(f"{data_dir}/raw")
+    user_ids, activity_data, last_time_id = compute_activity_windows(
+        users, posts, reps, min_rep=threshold-10, max_rep=500000, threshold_achievement=threshold_achievement,
+        target_reputation=target_reputation, reputation_range=[reputation_range_l, reputation_range_u],
+        time_type=time_type
+    )
+    dump_activity_dataset(user_ids, activity_data, out_data_path, last_time_id=last_time_id, split=split)
+
+
+############################################
+# Local backend
+############################################
+
+SECONDS_PER_TIME_ID = {"week": 604800, "day": 86400}
+USERS_AFTER = pd.Timestamp(year=2012, month=1, day=1)
+
+
+def time_ids(times, time_type="week", start_date=datetime.datetime(year=2008, month=7, day=27)):
+    """add_timeid for a pandas column of (UTC) timestamps, null where the time is"""
+    seconds = times.values.astype('datetime64[s]').astype(np.int64)
+    ids = (seconds - int(pd.Timestamp(start_date).value // 10 ** 9)) // SECONDS_PER_TIME_ID[time_type]
+    return pd.Series(ids, index=times.index).where(times.notna())
+
+
+def spark_like(df):
+    """The dtypes toPandas gives: integer columns without nulls are int64, with nulls float64"""
+    for col in df.columns:
+        if df[col].dtype.kind == 'f' and df[col].notna().all() and (df[col] % 1 == 0).all():
+            df[col] = df[col].astype(np.int64)
+    return df
+
+
+def line_batches(fname, chunksize):
+    """The gzipped json lines file in batches of ``chunksize`` raw lines, decompressed but not parsed"""
+    with gzip.open(fname, 'rb') as f:
+        while True:
+            lines = list(itertools.islice(f, chunksize))
+            if len(lines) == 0:
+                return
+            yield b''.join(lines)
+
+
+def parse_json_lines(lines):
+    return pd.read_json(io.BytesIO(lines), lines=True, convert_dates=False)
+
+
+def column(chunk, name):
+    return chunk[name] if name in chunk else pd.Series(np.nan, index=chunk.index)
+
+
+def users_chunk(lines, min_rep, max_rep):
+    chunk = parse_json_lines(lines)
+    U = pd.DataFrame({
+        'UserId': column(chunk, 'Id'),
+        'UserRep': column(chunk, 'Reputation'),
+        'UserCreationTime': pd.to_datetime(column(chunk, 'CreationDate')),
+        'UserLastAccessTime': pd.to_datetime(column(chunk, 'LastAccessDate')),
+    })
+    # user -1 is not a real user, users without an id are dropped like the null comparison drops them in Spark
+    return U[U.UserId.notna() & (U.UserId != -1) & (U.UserRep >= min_rep) & (U.UserRep < max_rep) &
+             (U.UserCreationTime > USERS_AFTER)]
+
+
+def local_users(data_dir, min_rep, max_rep, time_type="week", chunksize=500000, num_workers=None):
+    parse = partial(users_chunk, min_rep=min_rep, max_rep=max_rep)
+    parts = list(map_processes(parse, line_batches(f'{data_dir}/Users.json.gz', chunksize), num_workers))
+    U = pd.concat(parts, ignore_index=True).sort_values('UserCreationTime', kind='mergesort', ignore_index=True)
+    U['UserCreationDayId'] = time_ids(U.UserCreationTime, time_type)
+    U['UserLastAccessDayId'] = time_ids(U.UserLastAccessTime, time_type)
+    return spark_like(U)
+
+
+POSTS_KEYS = ['UserId', 'PostTimeId', 'PostTypeId']
+REPS_KEYS = ['UserId', 'RepTimeId', 'PostTypeId', 'RepText']
+
+
+def posts_chunk(lines, user_ids, time_type="week"):
+    chunk = parse_json_lines(lines)
+    owner = column(chunk, 'OwnerUserId')
+    chunk = chunk[owner.isin(user_ids)]
+    UP = pd.DataFrame({
+        'UserId': owner[chunk.index],
+        'PostTimeId': time_ids(pd.to_datetime(column(chunk, 'CreationDate')), time_type),
+        'PostTypeId': column(chunk, 'PostTypeId'),
+    })
+    return UP.groupby(POSTS_KEYS, dropna=False).size().rename('Count').reset_index()
+
+
+def local_posts(data_dir, user_ids, time_type="week", chunksize=500000, num_workers=None):
+    aggregate = partial(posts_chunk, user_ids=user_ids, time_type=time_type)
+    parts = list(map_processes(aggregate, line_batches(f'{data_dir}/Posts.json.gz', chunksize), num_workers))
+    posts_df = pd.concat(parts, ignore_index=True).groupby(POSTS_KEYS, dropna=False).Count.sum().reset_index()
+    return spark_like(posts_df)
+
+
+def reps_chunk(lines, user_ids, time_type="week"):
+    chunk = parse_json_lines(lines)
+    user = column(chunk, 'UserId')
+    chunk = chunk[user.isin(user_ids)]
+    UR = pd.DataFrame({
+        'UserId': user[chunk.index],
+        'RepTimeId': time_ids(pd.to_datetime(column(chunk, 'Time')), time_type),
+        'PostTypeId': column(chunk, 'PostTypeId'),
+        'RepText': column(chunk, 'Text'),
+        'RepDelta': column(chunk, 'Delta'),
+    })
+    grouped = UR.groupby(REPS_KEYS, dropna=False).RepDelta
+    return pd.DataFrame({'Count': grouped.size(), 'Sum': grouped.sum(min_count=1)}).reset_index()
+
+
+def local_reps(data_dir, user_ids, time_type="week", chunksize=500000, num_workers=None):
+    aggregate = partial(reps_chunk, user_ids=user_ids, time_type=time_type)
+    parts = list(map_processes(aggregate, line_batches(f'{data_dir}/Reps.json.gz', chunksize), num_workers))
+    grouped = pd.concat(parts, ignore_index=True).groupby(REPS_KEYS, dropna=False)
+    reps_df = pd.DataFrame({'Count': grouped.Count.sum(), 'Sum': grouped.Sum.sum(min_count=1)}).reset_index()
+    return spark_like(reps_df)
+
+
+def compute_pandas_dataframes_local(data_dir, min_rep, max_rep, time_type="week", chunksize=500000,
+                                    num_workers=None):
+    """
+    compute_pandas_dataframes without Spark: the json files are streamed in batches of lines that a process pool
+    parses and aggregates, then the per batch counts are combined. Rows come out sorted by their group keys.
+    """
+    assert time_type in ["week", "day"]
+    users_df = local_users(data_dir, min_rep, max_rep, time_type=time_type, chunksize=chunksize,
+                           num_workers=num_workers)
+    user_ids = users_df.UserId.values
+    posts_df = local_posts(data_dir, user_ids, time_type=time_type, chunksize=chunksize, num_workers=num_workers)
+    reps_df = local_reps(data_dir, user_ids, time_type=time_type, chunksize=chunksize, num_workers=num_workers)
+    return users_df, posts_df, reps_df
+
+
+############################################
+# Output
+############################################
+
+# the integer columns of the frames as they are written to parquet: int32 ids and counts, int16 time ids
+PARQUET_DTYPES = {
+    "users_df": {'UserId': 'int32', 'UserRep': 'int32', 'UserCreationDayId': 'int16', 'UserLastAccessDayId': 'int16'},
+    "posts_df": {'UserId': 'int32', 'PostTimeId': 'int16', 'PostTypeId': 'int8', 'Count': 'int32'},
+    "reputation_df": {'UserId': 'int32', 'RepTimeId': 'int16', 'PostTypeId': 'int8', 'Count': 'int32', 'Sum': 'int32'},
+}
+
+
+INTEGER_DTYPES = ['int8', 'int16', 'int32', 'int64']
+
+
+def fitting_dtype(values, dtype):
+    """``dtype``, or the first wider integer type when the values are outside its range"""
+    if values.notna().sum() == 0:
+        return dtype
+    low, high = values.min(), values.max()
+    for candidate in INTEGER_DTYPES[INTEGER_DTYPES.index(dtype):]:
+        info = np.iinfo(candidate)
+        if info.min <= low and high <= info.max:
+            return candidate
+    raise OverflowError(f"{values.name} has values in [{low}, {high}], outside of the int64 range")
+
+
+def write_frame(df, out_dir, name, output_format="parquet"):
+    if output_format == "pickle":
+        df.to_pickle(f"{out_dir}/{name}.pkl.gz", compression="gzip")
+    elif output_format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError("Writing parquet needs pyarrow (pip install pyarrow), or use output_format='pickle'")
+        df = df.copy()
+        for col, dtype in PARQUET_DTYPES[name].items():
+            # a column with values that do not fit gets a wider type (astype would wrap them), columns with nulls
+            # use the nullable integer types
+            dtype = fitting_dtype(df[col], dtype)
+            df[col] = df[col].astype(dtype if df[col].notna().all() else dtype.capitalize())
+        df.to_parquet(f"{out_dir}/{name}.parquet", engine="pyarrow", compression="zstd", index=False)
+    else:
+        raise ValueError(f"Unknown output format {output_format}, expected 'parquet' or 'pickle'")
+
+
+def dump_pandas_dataframes(
+        data_dir: str = "/Volumes/Seagate Backup Plus Drive/so_data/",
+        threshold: int = 200,
+        backend: str = "spark",
+        time_type: str = "week",
+        num_workers: int = None,
+        output_format: str = "parquet"
+):
+    """
+    Writes the users, posts and reputation frames of ``<data_dir>/raw`` to ``<data_dir>/<threshold>``, computed
+    with Spark (``backend="spark"``) or in-process with pandas (``backend="local"``), as typed parquet files or
+    (``output_format="pickle"``) gzip pickles
+    """
+    if backend == "spark":
+        users_df, posts_df, reps_df = get_spark_dataframes(f"{data_dir}/raw")
+        print("Read into Spark")
+        users_df, posts_df, reps_df = compute_pandas_dataframes(users_df, posts_df, reps_df, min_rep=threshold-10, max_rep=500000, time_type=time_type)
+    elif backend == "local":
+        users_df, posts_df, reps_df = compute_pandas_dataframes_local(f"{data_dir}/raw", min_rep=threshold-10, max_rep=500000, time_type=time_type, num_workers=num_workers)
+    else:
+        raise ValueError(f"Unknown backend {backend}, expected 'spark' or 'local'")
     print("Computed Dataframes")
-    users_df.to_pickle(f"{data_dir}/{threshold}/users_df.pkl.gz", compression="gzip")
+    if not os.path.exists(f"{data_dir}/{threshold}"):
+        os.makedirs(f"{data_dir}/{threshold}")
+    write_frame(users_df, f"{data_dir}/{threshold}", "users_df", output_format)
     print("Dumped Users")
-    posts_df.to_pickle(f"{data_dir}/{threshold}/posts_df.pkl.gz", compression="gzip")
+    write_frame(posts_df, f"{data_dir}/{threshold}", "posts_df", output_format)
     print("Dumped Posts")
-    reps_df.to_pickle(f"{data_dir}/{threshold}/reputation_df.pkl.gz", compression="gzip")
+    write_frame(reps_df, f"{data_dir}/{threshold}", "reputation_df", output_format)
     print("Dumped Reputation")
     print("<==========================> Done <======================================>")
 
 
+def get_dataframe_from_spark():
+    # data_dir = "../../data/"
+    dump_pandas_dataframes(threshold=200, backend="spark")
+
+
 if __name__ == "__main__":
-    get_dataframe_from_spark()
+    import fire
+    fire.Fire(dump_pandas_dataframes)
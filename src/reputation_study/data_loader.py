@@ -2,25 +2,68 @@ import json
 import torch
 import os
 
+import numpy as np
+
 from torch.utils import data
 
 
+class DenseActivitySplits:
+    """
+    Serves the rows of the ``<split>_activity.npy`` arrays (users x channels x time) written by the preprocessors.
+    Several splits are chained without copying them, which is how the "all" split reuses train/test/validate.
+    """
+    def __init__(self, data_path: str, splits: list):
+        self.data_path = data_path
+        self.splits = splits
+        self.user_ids = [np.load(os.path.join(data_path, f"{split}_user_ids.npy")) for split in splits]
+        self.bounds = np.cumsum([len(ids) for ids in self.user_ids])
+        self._arrays = None
+
+    def __getstate__(self):
+        # the memmaps are re-opened lazily in each DataLoader worker
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def __getitem__(self, index):
+        if self._arrays is None:
+            self._arrays = [np.load(os.path.join(self.data_path, f"{split}_activity.npy"), mmap_mode='c')
+                            for split in self.splits]
+        split = int(np.searchsorted(self.bounds, index, side='right'))
+        row = index - (self.bounds[split - 1] if split > 0 else 0)
+        activity = self._arrays[split][row]
+        # the arrays are written as int64 like the user_<id>.pt tensors and wrapped without a copy, older
+        # directories still have int32 arrays
+        return torch.from_numpy(activity if activity.dtype == np.int64 else activity.astype(np.int64))
+
+
 class ReputationDataset(data.Dataset):
     def __init__(self,
                data_path: str = '../data/reputation_data',
                dset_type: str = "train",
                threshold_achievement: int = 25,
-               subsample: bool=True
+               subsample: bool=True,
+               backend: str = "pt"
                ):
 
         super(ReputationDataset, self).__init__()
 
-        with open("{}/data_indexes.json".format(data_path), 'r') as f:
-            list_IDs = json.load(f)
-            if dset_type == "all":
-                self.list_IDs = list_IDs["train"]+list_IDs["test"]+list_IDs["validate"]
-            else:
-                self.list_IDs = list_IDs[dset_type]
+        splits = ["train", "test", "validate"] if dset_type == "all" else [dset_type]
+
+        # directories written before the dense arrays existed only have the user_<id>.pt files
+        if backend == "dense" and not all(os.path.exists(os.path.join(data_path, f"{split}_activity.npy"))
+                                          for split in splits):
+            print(f"No dense activity arrays in {data_path}, reading the user_<id>.pt files")
+            backend = "pt"
+
+        if backend == "dense":
+            self.activity = DenseActivitySplits(data_path, splits)
+            self.list_IDs = [int(u) for ids in self.activity.user_ids for u in ids]
+        else:
+            self.activity = None
+            with open("{}/data_indexes.json".format(data_path), 'r') as f:
+                list_IDs = json.load(f)
+                self.list_IDs = [u for split in splits for u in list_IDs[split]]
 
         if subsample:
             self.list_IDs = self.list_IDs[:10000]
@@ -31,9 +74,14 @@ class ReputationDataset(data.Dataset):
     def __len__(self):
         return len(self.list_IDs)
 
-    def __getitem__(self, index):
+    def _load(self, index):
+        if self.activity is not None:
+            return self.activity[index]
         id = self.list_IDs[index]
-        x = torch.load(os.path.join(self.data_path, f'user_{id}.pt'))
+        return torch.load(os.path.join(self.data_path, f'user_{id}.pt'))
+
+    def __getitem__(self, index):
+        x = self._load(index)
         # return x[0, :]+x[1, :]+x[2, :], x[-1, :]
         # return x[0, :], x[-1, :]
         # return x[1, :], x[-1, :]
@@ -42,8 +90,7 @@ class ReputationDataset(data.Dataset):
 
 class ReputationDatasetAllActions(ReputationDataset):
     def __getitem__(self, index):
-        id = self.list_IDs[index]
-        x = torch.load(os.path.join(self.data_path, f'user_{id}.pt'))
+        x = self._load(index)
         reputation = x[-1, :]
         return x[0], x[1], x[2]#, (reputation > 1).astype(float)
 
@@ -71,8 +118,7 @@ class ElectorateDatasetAllActions(ReputationDataset):
         return ['Answers', 'Questions', 'Comments', 'Edits', 'AnswerVotes', 'QuestionVotes', 'ReviewTasks']
 
     def __getitem__(self, index):
-        id = self.list_IDs[index]
-        x = torch.load(os.path.join(self.data_path, f'user_{id}.pt'))
+        x = self._load(index)
         return [v.squeeze(dim=0) for v in x.split(1, dim=0)]
 
 
@@ -80,9 +126,11 @@ class StrunkWhiteDatasetAllActions(ElectorateDatasetAllActions):
     def __init__(self,
                data_path: str = '../data/pt_s',
                dset_type: str = "train",
-               threshold_achievement: int = 25
+               threshold_achievement: int = 25,
+               **kwargs
                ):
 
         super(StrunkWhiteDatasetAllActions, self).__init__(data_path=data_path,
                                                           dset_type=dset_type,
-                                                          threshold_achievement=threshold_achievement)
+                                                          threshold_achievement=threshold_achievement,
+                                                          **kwargs)
@@ -1,36 +1,53 @@
 import os
 import torch
 import json
+import hashlib
+
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import numpy as np
 
 from tqdm import tqdm
 
+from so_study.io_utils import atomic_write
+
 
 ############################################
 # Reputation Data
 ############################################
 
-def get_activity_helper(posts_df, user_id):
-    try:
-        result = posts_df.loc[user_id]
-    except:
-        result = pd.Series(data=np.zeros(posts_df.shape[1]).astype(int), index=posts_df.columns)
-    return result
+POSTS_COLUMNS = ['UserId', 'PostTimeId', 'PostTypeId', 'Count']
+REPS_COLUMNS = ['UserId', 'RepTimeId', 'PostTypeId', 'RepText', 'Count', 'Sum']
 
 
-def load_data(in_data_path: str):
-    posts_df = pd.read_pickle(os.path.join(in_data_path, "posts_df.pkl.gz"), compression="gzip")
-    reps_df = pd.read_pickle(os.path.join(in_data_path, "reputation_df.pkl.gz"), compression="gzip")
+def interchange_file(in_data_path: str, name: str):
+    """The parquet file of a frame written by convert_so_data_to_pandas when there is one, its gzip pickle otherwise"""
+    parquet = os.path.join(in_data_path, f"{name}.parquet")
+    return parquet if os.path.exists(parquet) else os.path.join(in_data_path, f"{name}.pkl.gz")
 
-    for col in posts_df.columns:
-        posts_df[col] = posts_df[col].astype(int)
 
-    for col in ['UserId', 'RepTimeId', 'Count', 'Sum']:
-        if col == 'Sum':
-            reps_df.Sum.fillna(0, inplace=True)
-        reps_df[col] = reps_df[col].astype(int)
+def load_data(in_data_path: str):
+    posts_fname = interchange_file(in_data_path, "posts_df")
+    reps_fname = interchange_file(in_data_path, "reputation_df")
+
+    # the parquet files are already typed with compact integer columns (and read with multiple threads)
+    if posts_fname.endswith(".parquet"):
+        posts_df = pd.read_parquet(posts_fname, columns=POSTS_COLUMNS)
+    else:
+        posts_df = pd.read_pickle(posts_fname, compression="gzip")
+        for col in posts_df.columns:
+            posts_df[col] = posts_df[col].astype(int)
+
+    if reps_fname.endswith(".parquet"):
+        reps_df = pd.read_parquet(reps_fname, columns=REPS_COLUMNS)
+        reps_df['Sum'] = reps_df.Sum.fillna(0)
+    else:
+        reps_df = pd.read_pickle(reps_fname, compression="gzip")
+        for col in ['UserId', 'RepTimeId', 'Count', 'Sum']:
+            if col == 'Sum':
+                reps_df.Sum.fillna(0, inplace=True)
+            reps_df[col] = reps_df[col].astype(int)
 
     return posts_df, reps_df
 
@@ -68,51 +85,106 @@ def drop_unwanted_users(posts_df, reps_df, target_reputation=2000):
     return posts_df, reps_df
 
 
+class UserEvents:
+    """
+    Per-user time series kept as sorted events instead of a dense UserId x TimeId pivot: the user in row ``i`` has
+    events at ``times[offsets[i]:offsets[i + 1]]`` with the summed ``values`` at each of them.
+    """
+    def __init__(self, user_ids, offsets, times, values):
+        self.user_ids = user_ids
+        self.offsets = offsets
+        self.times = times
+        self.values = values
+        self._keys = None
+
+    @classmethod
+    def from_frame(cls, df, column):
+        df = df.groupby(['UserId', 'TimeId'])[column].sum().reset_index()
+        user_ids, counts = np.unique(df.UserId.values, return_counts=True)
+        offsets = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        return cls(user_ids, offsets, df.TimeId.values.astype(np.int64), df[column].values.astype(np.int64))
+
+    @property
+    def shape(self):
+        return len(self.user_ids), len(self.times)
+
+    def rows(self, user_ids):
+        """Row of every user, -1 for users without events"""
+        if len(self.user_ids) == 0:
+            return np.full(len(user_ids), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.user_ids, user_ids), len(self.user_ids) - 1)
+        return np.where(self.user_ids[rows] == user_ids, rows, -1)
+
+    def cumulative(self):
+        """Running total of every user (a segmented cumsum)"""
+        total = np.cumsum(self.values)
+        before = np.concatenate([[0], total])[self.offsets[:-1]]
+        return UserEvents(self.user_ids, self.offsets, self.times, total - np.repeat(before, np.diff(self.offsets)))
+
+    def last(self):
+        """Value of the last event of every user"""
+        return self.values[self.offsets[1:] - 1]
+
+    def first_reaching(self, target):
+        """The first event of every user with a value of at least ``target``, as (UserId, TimeId, value) columns"""
+        positions = np.flatnonzero(self.values >= target)
+        owners = np.searchsorted(self.offsets, positions, side='right') - 1
+        owners, first = np.unique(owners, return_index=True)
+        positions = positions[first]
+        return pd.DataFrame({'UserId': self.user_ids[owners], 'TimeId': self.times[positions],
+                             'Sum': self.values[positions]})
+
+    def _last_event(self, rows, times):
+        # index of the last event at or before each time, searched in one sorted array of (row, time) keys
+        low, high = self.times.min(), self.times.max()
+        stride = high - low + 2
+        if self._keys is None:
+            owners = np.repeat(np.arange(len(self.user_ids)), np.diff(self.offsets))
+            self._keys = owners * stride + (self.times - low + 1)
+        queries = rows * stride + (np.clip(times, low - 1, high) - low + 1)
+        return np.searchsorted(self._keys, queries, side='right') - 1
+
+    def at(self, rows, times):
+        """Dense values at the given times (broadcast against ``rows``), zero where the user has no event"""
+        rows, times = np.broadcast_arrays(rows, times)
+        result = np.zeros(rows.shape, dtype=self.values.dtype)
+        if len(self.times) == 0:
+            return result
+        found = rows >= 0
+        index = self._last_event(rows[found], times[found])
+        hit = (index >= self.offsets[rows[found]]) & (self.times[index] == times[found])
+        values = np.zeros(len(index), dtype=self.values.dtype)
+        values[hit] = self.values[index[hit]]
+        result[found] = values
+        return result
+
+    def latest(self, rows, times):
+        """
+        The value of the last event at or before the given times; before the first event of a user that first value.
+        This is the forward and backward filled pivot the reputation used to be kept in.
+        """
+        rows, times = np.broadcast_arrays(rows, times)
+        index = np.maximum(self._last_event(rows, times), self.offsets[rows])
+        return self.values[index]
+
+
 def preprocess_dfs(posts_df, reps_df, target_reputation=2000):
-    p_dfs = []
-    for post_type in [1, 2, 3]:
-        p_dfs.append(posts_df[posts_df.PostTypeId == post_type]
-                     .groupby(['UserId', f'TimeId']).Count.sum().reset_index()
-                     .pivot(index='UserId', columns=f'TimeId', values='Count')
-                     .fillna(0))
+    p_events = [UserEvents.from_frame(posts_df[posts_df.PostTypeId == post_type], 'Count') for post_type in [1, 2, 3]]
 
     del posts_df
 
-    r_df1 = reps_df.groupby(["UserId", f"TimeId"]) \
-        .Sum.sum() \
-        .groupby("UserId") \
-        .cumsum() \
-        .reset_index()
+    r_events = UserEvents.from_frame(reps_df, 'Sum').cumulative()
 
     del reps_df
 
-    r_df = r_df1 \
-        .loc[(r_df1.Sum >= target_reputation)] \
-        .groupby('UserId').head(1)
-
-    r_df2 = r_df1.pivot(index='UserId', columns=f'TimeId', values='Sum').ffill(axis=1).bfill(axis=1)
-
-    # fill in coluns if they don't exist.
-    min_col = r_df2.columns.min()
-    max_col = r_df2.columns.max()
-    col_names = list(range(min_col, max_col + 1))
-
-    print("Adding missing columns")
-    for col in range(min_col, max_col + 1):
-        for p_df in p_dfs:
-            if col not in p_df.columns:
-                p_df[col] = 0
+    r_df = r_events.first_reaching(target_reputation)
 
-        if col not in r_df2.columns:
-            r_df2[col] = r_df2[col - 1]
+    for p_events_type in p_events:
+        print(p_events_type.shape)
+    print(r_events.shape)
 
-    p_dfs = [p_df[col_names] for p_df in p_dfs]
-
-    for p_df in p_dfs:
-        print(p_df.shape)
-    print(r_df2.shape)
-
-    return p_dfs, r_df2, r_df
+    return p_events, r_events, r_df
 
 
 def load_and_transform_by_reputation(in_data_path: str, out_data_path: str, threshold_achievement: int):
@@ -121,200 +193,338 @@ def load_and_transform_by_reputation(in_data_path: str, out_data_path: str, thre
     total_cutoff = 3000
     reputation_range = 500, 3000
 
-    posts_df, reps_df = load_data(in_data_path)
-    posts_df = add_edits(posts_df, reps_df)
-    posts_df, reps_df = rename_post_time(posts_df, reps_df)
-    posts_df, reps_df = drop_unwanted_users(posts_df, reps_df, target_reputation=target_reputation)
-    print("Reshaping the data")
-    p_dfs, r_df2, r_df = preprocess_dfs(posts_df, reps_df, target_reputation=target_reputation)
+    p_events, r_events, r_df = load_reputation_events(in_data_path, target_reputation)
 
-    min_col = r_df2.columns.min()
-    max_col = r_df2.columns.max()
-    col_names = list(range(min_col, max_col + 1))
+    min_col = r_events.times.min()
+    max_col = r_events.times.max()
 
-    joined = r_df.merge(r_df2, how="inner", on="UserId", suffixes=(None, None))
+    week_of_crossing = r_df.TimeId.values
+    keep = (week_of_crossing - ta - min_col > 0) & (week_of_crossing + ta < max_col - 1)
+    crossing_users = r_df.UserId.values[keep].astype(np.int64)
+    rows = r_events.rows(crossing_users)
+    start = week_of_crossing[keep] - ta
 
-    base = pd.DataFrame({"reputation": np.arange(reputation_range[0], reputation_range[1])})
+    reputation_after = r_events.latest(rows, start + 2 * ta + 1)
+    keep = (reputation_after <= reputation_range[1]) & (reputation_after >= target_reputation + 5)
+    crossing_users, rows, start = crossing_users[keep], rows[keep], start[keep]
 
-    user_ids = []
-    counter = 0
-    for user, row in tqdm(joined.iterrows(), total=len(joined), desc='activity at threshold'):
-        date_of_crossing = int(row[f'TimeId'])
-        if date_of_crossing-ta-min_col <= 0:
-            continue
-        if date_of_crossing+ta >= max_col - 1:
-            continue
+    # the loop this replaces stopped once it had written 20001 users
+    user_cap = 20000
+    crossing_users, rows, start = crossing_users[:user_cap + 1], rows[:user_cap + 1], start[:user_cap + 1]
 
-        user_id = int(row['UserId'])
-        my_reputation = row[col_names]
+    times = start[:, None] + np.arange(2 * ta + 1)
+    reputation = r_events.latest(rows[:, None], times)
 
-        if my_reputation.loc[date_of_crossing + ta + 1] > reputation_range[1]:
-            continue
-        if my_reputation.loc[date_of_crossing + ta + 1] < target_reputation + 5:
-            continue
-
-        my_questions = get_activity_helper(p_dfs[0], user_id)
-        my_answers = get_activity_helper(p_dfs[1], user_id)
-        my_edits = get_activity_helper(p_dfs[2], user_id)
+    # activity summed into reputation bins of 10 points, as a histogram over flattened (user, bin) indices
+    first_bin, last_bin = reputation_range[0] // 10, (reputation_range[1] - 1) // 10
+    num_bins = last_bin - first_bin + 1
+    inside = (reputation >= reputation_range[0]) & (reputation < reputation_range[1])
+    cells = (np.arange(len(crossing_users))[:, None] * num_bins + reputation // 10 - first_bin)[inside]
 
-        my_activity = {
-            "questions": my_questions.loc[date_of_crossing - ta:date_of_crossing + ta].values.astype(int),
-            "answers": my_answers.loc[date_of_crossing - ta:date_of_crossing + ta].values.astype(int),
-            "edits": my_edits.loc[date_of_crossing - ta:date_of_crossing + ta].values.astype(int),
-            "reputation": my_reputation.loc[date_of_crossing - ta:date_of_crossing + ta].values.astype(int),
-        }
-        data = pd.DataFrame(my_activity).groupby("reputation").sum().reset_index().merge(base, on="reputation", how="right").fillna(0)
-        data = data[(data.reputation >= reputation_range[0]) & (data.reputation < reputation_range[1])]
-        data = data.groupby(data.reputation // 10).agg("sum")[["questions", "answers", "edits"]].reset_index()
+    activities = [np.broadcast_to(np.arange(first_bin, last_bin + 1), (len(crossing_users), num_bins))]
+    for p in p_events:
+        counts = p.at(p.rows(crossing_users)[:, None], times)[inside]
+        activities.append(np.bincount(cells, weights=counts, minlength=len(crossing_users) * num_bins)
+                          .reshape(-1, num_bins).astype(np.int64))
+    activities = np.stack(activities, axis=1)
 
-        user_ids.append(user_id)
-        activity_data = torch.tensor(data.values.astype(int).T)
-        torch.save(activity_data, os.path.join(out_data_path, f'user_{user_id}.pt'))
-        counter += 1
-        if counter>20000:
-            break
-    print(data.columns)
+    dump_user_tensors(crossing_users, activities, out_data_path, last_time_id=max_col)
 
-    user_ids = np.array(user_ids)
-    return user_ids
+    return crossing_users
 
 
 
-def load_and_transform_data(
-        in_data_path: str,
-        out_data_path: str,
-        threshold_achievement: int,
-        target_reputation: int,
-        reputation_range: list
-):
-    ta = threshold_achievement
-    reputation_range = reputation_range[0], reputation_range[1]
-
+def load_reputation_events(in_data_path: str, target_reputation: int):
     posts_df, reps_df = load_data(in_data_path)
     posts_df = add_edits(posts_df, reps_df)
     posts_df, reps_df = rename_post_time(posts_df, reps_df)
     posts_df, reps_df = drop_unwanted_users(posts_df, reps_df, target_reputation=target_reputation)
     print("Reshaping the data")
-    p_dfs, r_df2, r_df = preprocess_dfs(posts_df, reps_df, target_reputation=target_reputation)
+    return preprocess_dfs(posts_df, reps_df, target_reputation=target_reputation)
 
-    min_col = r_df2.columns.min()
-    max_col = r_df2.columns.max()
-    col_names = list(range(min_col, max_col + 1))
 
-    joined = r_df.merge(r_df2, how="inner", on="UserId", suffixes=(None, None))
+def activity_at_threshold(p_events, r_events, threshold_achievement: int, target_reputation: int,
+                          reputation_range: list):
+    """
+    The activity of every user in the weeks around crossing ``target_reputation``. The events may have been loaded
+    for a lower target, the users ending below this one are left out as drop_unwanted_users would have done.
+    """
+    ta = threshold_achievement
 
-    user_ids = []
-    counter = 0
+    kept = r_events.last() >= target_reputation
+    print(f"Leaving out {int((~kept).sum())} users below {target_reputation}")
+    min_col = r_events.times[r_events.offsets[:-1][kept]].min()
+    max_col = r_events.times[r_events.offsets[1:][kept] - 1].max()
+    r_df = r_events.first_reaching(target_reputation)
+    r_df = r_df[np.in1d(r_df.UserId.values, r_events.user_ids[kept])]
 
-    for user, row in tqdm(joined.iterrows(), total=len(joined), desc='activity at threshold'):
+    # every user that crosses the target, only their windows are ever made dense
+    week_of_crossing = r_df.TimeId.values
+    keep = (week_of_crossing - ta - min_col > 0) & (week_of_crossing + ta < max_col - 1)
+    user_ids = r_df.UserId.values[keep].astype(np.int64)
+    rows = r_events.rows(user_ids)
+    start = week_of_crossing[keep] - ta
 
-        week_of_crossing = int(row[f'TimeId'])
+    keep = r_events.latest(rows, start + 2 * ta + 1) <= reputation_range[1]  # done a lot after cross
+    keep &= r_events.latest(rows, start - 1) >= reputation_range[0]  # done nothing after cross
+    user_ids, rows, start = user_ids[keep], rows[keep], start[keep]
 
-        if week_of_crossing-ta-min_col <= 0:
-            continue
-        if week_of_crossing+ta >= max_col - 1:
-            continue
+    # the [t-ta, t+ta] window of every user, taken from all channels at once
+    times = start[:, None] + np.arange(2 * ta + 1)
+    activities = [p.at(p.rows(user_ids)[:, None], times) for p in p_events]
+    activities.append(r_events.latest(rows[:, None], times))
+    activities = np.stack(activities, axis=1)
 
-        user_id = int(row['UserId'])
+    return user_ids, activities
 
-        my_reputation = row[col_names]
 
-        if my_reputation.loc[week_of_crossing + ta+1] > reputation_range[1]: # done a lot after cross
-            continue
-        if my_reputation.loc[week_of_crossing - ta - 1] < reputation_range[0]: # done nothing after cross
-            continue
+def load_and_transform_data(
+        in_data_path: str,
+        out_data_path: str,
+        threshold_achievement: int,
+        target_reputation: int,
+        reputation_range: list
+):
+    p_events, r_events, _ = load_reputation_events(in_data_path, target_reputation)
+    user_ids, activities = activity_at_threshold(p_events, r_events, threshold_achievement, target_reputation,
+                                                 reputation_range)
 
-        my_questions = get_activity_helper(p_dfs[0], user_id)
-        my_answers = get_activity_helper(p_dfs[1], user_id)
-        my_edits = get_activity_helper(p_dfs[2], user_id)
+    dump_user_tensors(user_ids, activities, out_data_path, last_time_id=r_events.times.max())
 
-        my_activity = {
-            "questions": my_questions.loc[week_of_crossing-ta:week_of_crossing+ta].values.astype(int),
-            "answers": my_answers.loc[week_of_crossing - ta:week_of_crossing + ta].values.astype(int),
-            "edits": my_edits.loc[week_of_crossing - ta:week_of_crossing + ta].values.astype(int),
-            "reputation": my_reputation.loc[week_of_crossing-ta:week_of_crossing+ta].values.astype(int)
-        }
+    return user_ids, activities
 
-        data = pd.DataFrame(my_activity)
 
-        user_ids.append(user_id)
-        activity_data = torch.tensor(data.values.astype(int).T)
-        torch.save(activity_data, os.path.join(out_data_path, f'user_{user_id}.pt'))
-        counter += 1
+MANIFEST = 'manifest.json'
 
-    print(data.columns)
 
-    user_ids = np.array(user_ids)
+def load_manifest(out_data_path):
+    """
+    The manifest of a dataset directory: the last time id of the data it was built from and the content hash of
+    every user's activity
+    """
+    fname = os.path.join(out_data_path, MANIFEST)
+    if not os.path.exists(fname):
+        return {'last_time_id': None, 'users': {}}
+    with open(fname, 'r') as f:
+        return json.load(f)
 
-    return user_ids
 
+def activity_hash(activity):
+    return hashlib.sha1(np.ascontiguousarray(activity, dtype=np.int64).tobytes()).hexdigest()
 
-def dump_user_ids(user_ids, out_data_path):
-    np.random.seed(11)
-    size_data = len(user_ids)
 
-    train = np.random.choice(user_ids, size=int(np.floor(0.6 * size_data)), replace=False)
-    user_ids = user_ids[~np.in1d(user_ids, train)]
-    validate = np.random.choice(user_ids, size=int(np.floor(0.2 * size_data)), replace=False)
-    user_ids = user_ids[~np.in1d(user_ids, validate)]
-    test = np.random.choice(user_ids, size=int(np.floor(0.2 * size_data)), replace=False)
+def dump_user_tensors(user_ids, activity_data, out_data_path, last_time_id=None, num_workers=None):
+    """
+    Writes the ``user_<id>.pt`` file of every user, in parallel. Users whose activity has the same hash as in the
+    manifest of an earlier build are not written again and files of users no longer in the data are removed. The
+    activity itself is always recomputed from the full data, only the writes are skipped. The manifest records
+    ``last_time_id``, the last time id of that data (or keeps the one of the earlier build). Returns the ids of the
+    users that were written.
+    """
+    manifest = load_manifest(out_data_path)
+    hashes = {str(u): activity_hash(a) for u, a in zip(user_ids, activity_data)}
 
-    if not os.path.exists(out_data_path):
-        os.makedirs(out_data_path)
+    def fname(user_id):
+        return os.path.join(out_data_path, f'user_{user_id}.pt')
 
-    with open(os.path.join(out_data_path, 'data_indexes.json'), 'w') as f:
-        obj = dict()
-        obj['train'] = [int(u) for u in train]
-        obj['test'] = [int(u) for u in test]
-        obj['validate'] = [int(u) for u in validate]
+    changed = [i for i, u in enumerate(user_ids)
+               if manifest['users'].get(str(u)) != hashes[str(u)] or not os.path.exists(fname(u))]
+    for user_id in set(manifest['users']) - set(hashes):
+        if os.path.exists(fname(user_id)):
+            os.remove(fname(user_id))
+    print(f"{len(changed)} of {len(user_ids)} users changed since the build up to time id "
+          f"{manifest['last_time_id']}")
 
-        json.dump(obj, f)
+    def save(i):
+        torch.save(torch.tensor(activity_data[i]), fname(user_ids[i]))
 
+    with ThreadPoolExecutor(num_workers) as executor:
+        list(tqdm(executor.map(save, changed), total=len(changed), desc='dumping activity data'))
 
-############################################
-# Electorate Data
-############################################
+    # the manifest goes last, a build stopped before it is redone in full
+    with atomic_write(os.path.join(out_data_path, MANIFEST), 'w') as f:
+        last_time_id = int(last_time_id) if last_time_id is not None else manifest['last_time_id']
+        json.dump({'last_time_id': last_time_id, 'users': hashes}, f)
 
-def load_and_transform_electorate_data(in_data_path, threshold_achievement, badge="Electorate", not_badge=""):
-    action_names = ['Answers', 'Questions', 'Comments', 'Edits', 'AnswerVotes', 'QuestionVotes', 'ReviewTasks']
+    return {int(user_ids[i]) for i in changed}
 
-    activity_df = pd.read_csv(os.path.join(in_data_path, "so_badges.csv.gz"), compression="gzip")
 
-    activity_df.Date = pd.to_datetime(activity_df.Date)
-    activity_df['time_ix'] = (activity_df.Date - pd.datetime(year=2017, month=1, day=1)).dt.days
+def hash_split(user_ids, fractions=(0.6, 0.2)):
+    """
+    Train, validate and test users by a hash of the user id, so a user keeps its split when the data is rebuilt
+    """
+    position = np.array([int(hashlib.sha1(str(int(u)).encode()).hexdigest()[:8], 16) for u in user_ids],
+                        dtype=np.float64) / 16 ** 8
+    train = position < fractions[0]
+    validate = ~train & (position < fractions[0] + fractions[1])
+    return user_ids[train], user_ids[validate], user_ids[~train & ~validate]
 
-    badge_wins = activity_df.dropna(subset=[badge]).groupby('DummyUserId')['time_ix'].first().reset_index()
-    print(f"Total {badge_wins.shape} users found")
-    if not_badge != "":
-        not_badge = activity_df.dropna(subset=[not_badge]).groupby('DummyUserId')['time_ix'].first().reset_index()
-        print(f"Dropping {not_badge.shape[0]} users")
-        badge_wins = badge_wins[~badge_wins.DummyUserId.isin(not_badge.DummyUserId)]
 
-    badge_wins.rename(columns={'time_ix': 'badge_win_date'}, inplace=True)
+def split_user_ids(user_ids, split='random'):
+    if split == 'hash':
+        train, validate, test = hash_split(np.asarray(user_ids))
+    elif split == 'random':
+        # a seeded generator of its own (the same draws as np.random.seed(11)) so datasets can be written in parallel
+        random_state = np.random.RandomState(11)
+        size_data = len(user_ids)
 
-    df = pd.merge(activity_df[['DummyUserId', 'time_ix'] + action_names],
-                  badge_wins[['DummyUserId', "badge_win_date"]], on='DummyUserId')
+        train = random_state.choice(user_ids, size=int(np.floor(0.6 * size_data)), replace=False)
+        user_ids = user_ids[~np.in1d(user_ids, train)]
+        validate = random_state.choice(user_ids, size=int(np.floor(0.2 * size_data)), replace=False)
+        user_ids = user_ids[~np.in1d(user_ids, validate)]
+        test = random_state.choice(user_ids, size=int(np.floor(0.2 * size_data)), replace=False)
+    else:
+        raise ValueError(f"Unknown split {split}, expected 'random' or 'hash'")
 
-    user_ids = []
-    activities = []
+    obj = dict()
+    obj['train'] = [int(u) for u in train]
+    obj['test'] = [int(u) for u in test]
+    obj['validate'] = [int(u) for u in validate]
+    return obj
 
-    max_time = df.time_ix.max()
 
-    for user_id, user_actions in tqdm(df.groupby("DummyUserId"),
-                                      total=df.DummyUserId.nunique(),
-                                      desc='Processing user activities'):
-        badge_win_date = user_actions.badge_win_date.min()
-        if badge_win_date - threshold_achievement < 0:
-            continue
-        if max_time - badge_win_date - (threshold_achievement + 1) < 0:
+def dump_user_ids(user_ids, out_data_path, split='random', splits=None):
+    if splits is None:
+        splits = split_user_ids(user_ids, split=split)
+
+    if not os.path.exists(out_data_path):
+        os.makedirs(out_data_path)
+
+    with open(os.path.join(out_data_path, 'data_indexes.json'), 'w') as f:
+        json.dump(splits, f)
+
+    return splits
+
+
+def dump_dense_splits(user_ids, activity_data, splits, out_data_path, changed=None):
+    """
+    Writes every split as one contiguous (users x channels x time) array, read by DenseActivitySplits. With the
+    ``changed`` user ids of dump_user_tensors, splits with the same users as before and none of them changed are
+    left as they are.
+    """
+    row_of_user = {int(u): i for i, u in enumerate(user_ids)}
+    for split, split_ids in splits.items():
+        ids_file = os.path.join(out_data_path, f'{split}_user_ids.npy')
+        if changed is not None and os.path.exists(ids_file) and \
+                os.path.exists(os.path.join(out_data_path, f'{split}_activity.npy')) and \
+                np.array_equal(np.load(ids_file), split_ids) and not changed.intersection(split_ids):
             continue
+        rows = np.array([row_of_user[u] for u in split_ids], dtype=np.int64)
+        np.save(ids_file, np.array(split_ids, dtype=np.int64))
+        np.save(os.path.join(out_data_path, f'{split}_activity.npy'), activity_data[rows].astype(np.int64))
 
-        user_acts = user_actions.set_index("time_ix").loc[badge_win_date-threshold_achievement:badge_win_date+threshold_achievement]
 
-        activities.append(user_acts[action_names].values.astype(int).T)
-        user_ids.append(int(user_id))
+############################################
+# Electorate Data
+############################################
 
-    return np.array(user_ids), np.stack(activities)
+ELECTORATE_ACTIONS = ['Answers', 'Questions', 'Comments', 'Edits', 'AnswerVotes', 'QuestionVotes', 'ReviewTasks']
+
+
+def read_activity_chunks(fname, columns, chunksize=1000000):
+    """
+    Streams ``so_badges.csv.gz`` in chunks with compact dtypes, yielding ``(user_ids, time_ix, chunk)`` where
+    time_ix counts the days since 2017-01-01 (the date part of every ``Date`` is parsed with a fixed format)
+    """
+    dtypes = {c: np.int32 for c in ELECTORATE_ACTIONS}
+    dtypes.update({'DummyUserId': np.int32, 'Date': str})
+    usecols = ['DummyUserId', 'Date'] + columns
+    start = pd.Timestamp(year=2017, month=1, day=1)
+    for chunk in pd.read_csv(fname, usecols=usecols, dtype={c: dtypes.get(c, np.float32) for c in usecols},
+                             chunksize=chunksize, compression="gzip"):
+        days = (pd.to_datetime(chunk.Date.str.slice(0, 10), format='%Y-%m-%d') - start).dt.days
+        yield chunk.DummyUserId.values, days.values.astype(np.int32), chunk
+
+
+def first_achievements(fname, badges, chunksize=1000000):
+    """
+    User ids and time_ix of the first row of every user with the badge set, for all ``badges`` in one scan
+    """
+    user_ids, days = {b: [] for b in badges}, {b: [] for b in badges}
+    for users, time_ix, chunk in read_activity_chunks(fname, list(badges), chunksize):
+        for b in badges:
+            achieved = chunk[b].notna().values
+            user_ids[b].append(users[achieved])
+            days[b].append(time_ix[achieved])
+
+    achievements = {}
+    for b in badges:
+        users, first = np.unique(np.concatenate(user_ids[b]), return_index=True)
+        achievements[b] = users, np.concatenate(days[b])[first]
+    return achievements
+
+
+def badge_winners(achievements, badge, not_badge=""):
+    badge_users, badge_win_dates = achievements[badge]
+    print(f"Total {len(badge_users)} users found")
+    if not_badge != "":
+        not_badge_users, _ = achievements[not_badge]
+        print(f"Dropping {len(not_badge_users)} users")
+        keep = ~np.in1d(badge_users, not_badge_users)
+        badge_users, badge_win_dates = badge_users[keep], badge_win_dates[keep]
+    return badge_users, badge_win_dates
+
+
+def _scatter_rows(activities, user_ids, starts, users, times, actions):
+    """Adds every row inside the window of its user (``user_ids`` sorted, windows from ``starts``) to that window"""
+    if len(user_ids) == 0:
+        return
+    rows = np.minimum(np.searchsorted(user_ids, users), len(user_ids) - 1)
+    offset = times - starts[rows]
+    inside = (user_ids[rows] == users) & (offset >= 0) & (offset < activities.shape[1])
+    np.add.at(activities, (rows[inside], offset[inside]), actions[inside])
+
+
+def load_and_transform_badge_data(in_data_path, threshold_achievement, badges, chunksize=1000000):
+    """
+    Builds the datasets of several badges from two scans of ``so_badges.csv.gz``: one over the badge columns and one
+    over the actions, which scatters every chunk straight into the windows of the winners. ``badges`` maps a dataset
+    name to its [badge, not_badge] pair. Returns the datasets and the last time id of the file.
+    """
+    action_names = ELECTORATE_ACTIONS
+    ta = threshold_achievement
+    fname = os.path.join(in_data_path, "so_badges.csv.gz")
+
+    achievements = first_achievements(fname, sorted({b for pair in badges.values() for b in pair if b != ""}),
+                                      chunksize)
+    winners = {name: badge_winners(achievements, badge, not_badge) for name, (badge, not_badge) in badges.items()}
+    all_winners = np.unique(np.concatenate([users for users, _ in winners.values()]))
+
+    # the windows of the winners far enough from the start; the end of the data (the last row of a dataset's
+    # winners) is only known after the scan, the windows too close to it are dropped then
+    windows, max_times, last_time_id = {}, {}, None
+    for name, (badge_users, badge_win_dates) in winners.items():
+        keep = badge_win_dates - ta >= 0
+        windows[name] = (badge_users[keep], badge_win_dates[keep],
+                         np.zeros((int(keep.sum()), 2 * ta + 1, len(action_names)), dtype=np.int64))
+        max_times[name] = None
+
+    for user_ids, time_ix, chunk in read_activity_chunks(fname, action_names, chunksize):
+        wanted = np.in1d(user_ids, all_winners)
+        users, times, actions = user_ids[wanted], time_ix[wanted], chunk[action_names].values[wanted]
+        if len(time_ix) > 0:
+            last_time_id = time_ix.max() if last_time_id is None else max(last_time_id, time_ix.max())
+        for name, (badge_users, _) in winners.items():
+            rows = np.in1d(users, badge_users)
+            if rows.any():
+                max_time = times[rows].max()
+                max_times[name] = max_time if max_times[name] is None else max(max_times[name], max_time)
+            window_users, badge_win_dates, activities = windows[name]
+            _scatter_rows(activities, window_users, badge_win_dates - ta, users[rows], times[rows], actions[rows])
+
+    datasets = {}
+    for name, (window_users, badge_win_dates, activities) in windows.items():
+        max_time = 0 if max_times[name] is None else max_times[name]
+        keep = max_time - badge_win_dates - (ta + 1) >= 0
+        datasets[name] = window_users[keep].astype(np.int64), activities[keep].transpose(0, 2, 1).copy()
+    return datasets, last_time_id
+
+
+def load_and_transform_electorate_data(in_data_path, threshold_achievement, badge="Electorate", not_badge="",
+                                       chunksize=1000000):
+    datasets, _ = load_and_transform_badge_data(in_data_path, threshold_achievement, {badge: [badge, not_badge]},
+                                                chunksize)
+    return datasets[badge]
 
 ############################################
 # Executables
@@ -326,38 +536,58 @@ def create_reputation_dataset(
         threshold_achievement: int = 70,
         target_reputation: int = 500,
         reputation_range_u: int = 1000,
-        reputation_range_l: int = 250
+        reputation_range_l: int = 250,
+        num_workers: int = None,
+        split: str = 'random'
 ):
-    if not os.path.exists(out_data_path):
-        os.mkdir(out_data_path)
-    user_ids = load_and_transform_data(in_data_path, out_data_path, threshold_achievement, target_reputation, [reputation_range_l, reputation_range_u])
+    """
+    ``target_reputation`` and the reputation range bounds can be lists to build one dataset per target from a single
+    load of the data, in parallel. The datasets are written to ``out_data_path`` formatted with ``target_reputation``
+    (e.g. ``data/{target_reputation}/reputation_data``) or, without that placeholder, to a subdirectory per target.
+    Rebuilding into an existing directory only rewrites the users whose activity changed, with ``split='hash'`` the
+    users also keep their train/validate/test split.
+    """
+    targets = [int(t) for t in np.atleast_1d(target_reputation)]
+    upper = [int(u) for u in np.broadcast_to(reputation_range_u, len(targets))]
+    lower = [int(l) for l in np.broadcast_to(reputation_range_l, len(targets))]
+
+    out_data_paths = [out_data_path.format(target_reputation=t) for t in targets]
+    if len(set(out_data_paths)) < len(targets):
+        out_data_paths = [os.path.join(out_data_path, str(t)) for t in targets]
+
+    # the lowest target keeps every user any of the datasets needs
+    p_events, r_events, _ = load_reputation_events(in_data_path, min(targets))
     # user_ids = load_and_transform_by_reputation(in_data_path, out_data_path, threshold_achievement)
 
-    print(f"Total of {len(user_ids)} user trajectories")
-    dump_user_ids(user_ids, out_data_path)
+    def build(i):
+        user_ids, activity_data = activity_at_threshold(p_events, r_events, threshold_achievement, targets[i],
+                                                        [lower[i], upper[i]])
+        dump_activity_dataset(user_ids, activity_data, out_data_paths[i], last_time_id=r_events.times.max(),
+                              split=split)
 
+    with ThreadPoolExecutor(num_workers) as executor:
+        list(executor.map(build, range(len(targets))))
 
-def create_activity_dataset(
-    in_data_path: str, out_data_path: str, threshold_achievement: int, badge: str, not_badge: str):
+
+def dump_activity_dataset(user_ids, activity_data, out_data_path, last_time_id=None, split='random', splits=None):
     if not os.path.exists(out_data_path):
-        os.mkdir(out_data_path)
-
-    user_ids, activity_data = load_and_transform_electorate_data(
-        in_data_path,
-        threshold_achievement,
-        badge=badge,
-        not_badge=not_badge
-    )
+        os.makedirs(out_data_path)
+
     print(f"Total of {len(user_ids)} user trajectories")
 
-    for user_id, activities in tqdm(
-                                zip(user_ids, activity_data),
-                            total=len(user_ids),
-                            desc='dumping activity data'):
-        activity_data = torch.tensor(activities)
-        torch.save(activity_data, os.path.join(out_data_path, f'user_{user_id}.pt'))
+    changed = dump_user_tensors(user_ids, activity_data, out_data_path, last_time_id=last_time_id)
+
+    splits = dump_user_ids(user_ids, out_data_path, split=split, splits=splits)
+    dump_dense_splits(user_ids, activity_data, splits, out_data_path, changed=changed)
 
-    dump_user_ids(user_ids, out_data_path)
+
+def create_activity_dataset(
+    in_data_path: str, out_data_path: str, threshold_achievement: int, badge: str, not_badge: str,
+    split: str = 'random'):
+    datasets, last_time_id = load_and_transform_badge_data(in_data_path, threshold_achievement,
+                                                           {badge: [badge, not_badge]})
+    user_ids, activity_data = datasets[badge]
+    dump_activity_dataset(user_ids, activity_data, out_data_path, last_time_id=last_time_id, split=split)
 
 
 params = {
@@ -368,9 +598,23 @@ params = {
 }
 
 
-def create_dataset(in_data_path: str = 'data', threshold_achievement: int = 70, type="Electorate"):
+def create_dataset(in_data_path: str = 'data', threshold_achievement: int = 70, type="Electorate", split='random'):
     create_activity_dataset(in_data_path,
                             f"{in_data_path}/pt_{type.lower()}",
                             threshold_achievement,
                             params[type][0],
-                            params[type][1])
+                            params[type][1],
+                            split=split)
+
+
+def create_datasets(in_data_path: str = 'data', threshold_achievement: int = 70, types=tuple(params),
+                    split='random'):
+    """Writes the pt_<type> dataset of every badge type, reading so_badges.csv.gz once for all of them"""
+    if isinstance(types, str):
+        types = [types]
+    datasets, last_time_id = load_and_transform_badge_data(in_data_path, threshold_achievement,
+                                                           {t: params[t] for t in types})
+    for type, (user_ids, activity_data) in datasets.items():
+        print(f"Writing {type}")
+        dump_activity_dataset(user_ids, activity_data, f"{in_data_path}/pt_{type.lower()}",
+                              last_time_id=last_time_id, split=split)
@@ -0,0 +1,187 @@
+import os
+import gzip
+import json
+import pickle
+import hashlib
+import functools
+import collections
+
+from reputation_study.data_preprosessor import (
+    interchange_file,
+    load_data,
+    add_edits,
+    rename_post_time,
+    drop_unwanted_users,
+    preprocess_dfs,
+    activity_at_threshold,
+    split_user_ids,
+    dump_activity_dataset
+)
+from so_study.io_utils import atomic_write
+
+
+INPUT_FILES = ["posts_df", "reputation_df"]
+
+
+class Stage:
+    """
+    One step of the preprocessing: ``function`` is called with the outputs of the ``inputs`` stages followed by the
+    ``params`` of the configuration as keyword arguments. Stages that are cheap to recompute from their inputs, or
+    that only read the source files (a cached copy would be no faster to read), are created with ``cache=False`` and
+    never written to disk.
+    """
+    def __init__(self, name, function, inputs=(), params=(), cache=True):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.params = list(params)
+        self.cache = cache
+
+
+class Pipeline:
+    """
+    Runs a DAG of stages, caching every output in ``cache_dir`` under a hash of the stage, its parameters and the
+    keys of its inputs. A stage is only computed when that key is not cached, so changing a parameter recomputes
+    the stages using it and everything downstream of them. Within a run an output is kept in memory until the
+    last stage using it has been computed.
+    """
+    def __init__(self, stages, cache_dir):
+        self.stages = {stage.name: stage for stage in stages}
+        self.cache_dir = cache_dir
+        self.outputs = {}
+        self.consumers = collections.Counter()
+
+    def key(self, name, config, keys=None):
+        keys = {} if keys is None else keys
+        if name not in keys:
+            stage = self.stages[name]
+            settings = {
+                'stage': name,
+                'params': {p: config[p] for p in stage.params},
+                'inputs': [self.key(i, config, keys) for i in stage.inputs],
+            }
+            keys[name] = hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+        return keys[name]
+
+    def artifact(self, name, config):
+        return os.path.join(self.cache_dir, f'{name}_{self.key(name, config)}.pkl.gz')
+
+    def count_consumers(self, names, config):
+        '''How often every output is used in a run of ``names``: by each stage that is computed and each name'''
+        consumers = collections.Counter(names)
+        computed = set()
+
+        def visit(name):
+            if name in computed or os.path.exists(self.artifact(name, config)):
+                return
+            computed.add(name)
+            for i in self.stages[name].inputs:
+                consumers[i] += 1
+                visit(i)
+
+        for name in names:
+            visit(name)
+        return consumers
+
+    def run(self, names, config):
+        """The outputs of the stages ``names`` (or of the single stage ``names``), loaded from the cache or computed"""
+        single = isinstance(names, str)
+        names = [names] if single else list(names)
+        self.outputs = {}
+        self.consumers = self.count_consumers(names, config)
+        outputs = [self.output(name, config) for name in names]
+        return outputs[0] if single else outputs
+
+    def output(self, name, config):
+        fname = self.artifact(name, config)
+        if fname not in self.outputs:
+            self.outputs[fname] = self.compute(name, config)
+        output = self.outputs[fname]
+        self.consumers[name] -= 1
+        if self.consumers[name] <= 0:
+            del self.outputs[fname]
+        return output
+
+    def compute(self, name, config):
+        fname = self.artifact(name, config)
+        if os.path.exists(fname):
+            print(f"{name}: cached")
+            with gzip.open(fname, 'rb') as f:
+                return pickle.load(f)
+
+        stage = self.stages[name]
+        inputs = [self.output(i, config) for i in stage.inputs]
+        print(f"{name}: computing")
+        output = stage.function(*inputs, **{p: config[p] for p in stage.params})
+        del inputs
+
+        if stage.cache:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with atomic_write(fname, opener=functools.partial(gzip.open, compresslevel=3)) as f:
+                pickle.dump(output, f, pickle.HIGHEST_PROTOCOL)
+        return output
+
+
+def source_fingerprint(in_data_path):
+    '''Size and modification time of the input files, so a new dump invalidates the cached stages'''
+    fingerprint = {}
+    for name in INPUT_FILES:
+        fname = interchange_file(in_data_path, name)
+        stat = os.stat(fname)
+        fingerprint[os.path.basename(fname)] = [stat.st_size, stat.st_mtime]
+    return fingerprint
+
+
+def _windows(dropped, threshold_achievement, target_reputation, reputation_range_l, reputation_range_u):
+    p_events, r_events, _ = dropped
+    user_ids, activities = activity_at_threshold(p_events, r_events, threshold_achievement, target_reputation,
+                                                 [reputation_range_l, reputation_range_u])
+    return user_ids, activities, int(r_events.times.max())
+
+
+reputation_stages = [
+    Stage('load', lambda in_data_path, source: load_data(in_data_path), params=['in_data_path', 'source'],
+          cache=False),
+    Stage('add_edits', lambda loaded: (add_edits(*loaded), loaded[1]), inputs=['load'], cache=False),
+    Stage('rename', lambda edited: rename_post_time(*edited), inputs=['add_edits'], cache=False),
+    Stage('drop_users', lambda renamed, target_reputation: drop_unwanted_users(*renamed, target_reputation),
+          inputs=['rename'], params=['target_reputation']),
+    Stage('pivot', lambda dropped, target_reputation: preprocess_dfs(*dropped, target_reputation),
+          inputs=['drop_users'], params=['target_reputation']),
+    Stage('windows', _windows, inputs=['pivot'],
+          params=['threshold_achievement', 'target_reputation', 'reputation_range_l', 'reputation_range_u']),
+    Stage('split', lambda windows, split: split_user_ids(windows[0], split=split), inputs=['windows'],
+          params=['split']),
+]
+
+
+def run_reputation_pipeline(
+        in_data_path: str = 'data',
+        out_data_path: str = 'data/reputation_data',
+        threshold_achievement: int = 70,
+        target_reputation: int = 500,
+        reputation_range_u: int = 1000,
+        reputation_range_l: int = 250,
+        split: str = 'random',
+        cache_dir: str = None
+):
+    """
+    create_reputation_dataset as a pipeline of cached stages (load -> add_edits -> rename -> drop_users -> pivot ->
+    windows -> split). The stage outputs are kept in ``cache_dir`` (``<in_data_path>/pipeline_cache`` by default).
+    """
+    config = {
+        'in_data_path': os.path.abspath(in_data_path),
+        'source': source_fingerprint(in_data_path),
+        'threshold_achievement': threshold_achievement,
+        'target_reputation': target_reputation,
+        'reputation_range_l': reputation_range_l,
+        'reputation_range_u': reputation_range_u,
+        'split': split,
+    }
+    if cache_dir is None:
+        cache_dir = os.path.join(in_data_path, 'pipeline_cache')
+    pipeline = Pipeline(reputation_stages, cache_dir)
+
+    (user_ids, activity_data, last_time_id), splits = pipeline.run(['windows', 'split'], config)
+    dump_activity_dataset(user_ids, activity_data, out_data_path, last_time_id=last_time_id, splits=splits)
@@ -0,0 +1,103 @@
+import os
+import json
+
+import numpy as np
+
+from so_study.io_utils import atomic_write
+
+
+BADGE_INDEX = 'badge_index.npz'
+SPLITS = ['train', 'validate', 'test']
+
+
+class BadgeIndex:
+    """
+    Binary form of ``badge_achievements.json`` and ``data_indexes.json``: a users x badges boolean matrix,
+    the achievement days as a ragged array over the (user, badge) cells and the splits as row positions.
+    The days of user ``i`` for badge ``j`` are ``days[day_offsets[i*B + j]:day_offsets[i*B + j + 1]]``.
+    """
+
+    def __init__(self, user_ids, badges, has_badge, day_offsets, days, splits):
+        self.user_ids = user_ids
+        self.badges = badges
+        self.has_badge = has_badge
+        self.day_offsets = day_offsets
+        self.days = days
+        self.splits = splits
+        self.columns = {b: i for i, b in enumerate(badges)}
+
+    def rows(self, dset_type):
+        if dset_type == 'all':
+            return np.concatenate([self.splits['train'], self.splits['test'], self.splits['validate']])
+        return self.splits[dset_type]
+
+    def achieved(self, rows, badge):
+        if badge not in self.columns:
+            return np.zeros(len(rows), dtype=bool)
+        return self.has_badge[rows, self.columns[badge]]
+
+    def day_ranges(self, rows, badge):
+        cells = np.asarray(rows, dtype=np.int64) * len(self.badges) + self.columns[badge]
+        return self.day_offsets[cells], self.day_offsets[cells + 1]
+
+    def save(self, fname):
+        with atomic_write(fname) as f:
+            np.savez(
+                f,
+                user_ids=self.user_ids,
+                badges=self.badges,
+                has_badge=self.has_badge,
+                day_offsets=self.day_offsets,
+                days=self.days,
+                **{f'split_{s}': self.splits[s] for s in SPLITS}
+            )
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as f:
+            return cls(
+                f['user_ids'], f['badges'], f['has_badge'], f['day_offsets'], f['days'],
+                {s: f[f'split_{s}'] for s in SPLITS}
+            )
+
+
+def build_badge_index(data_path):
+    '''Parses the json files of a dataset once and writes them to ``badge_index.npz``'''
+    with open("{}/badge_achievements.json".format(data_path), 'r') as f:
+        badge_ids = json.load(f)
+    with open("{}/data_indexes.json".format(data_path), 'r') as f:
+        list_IDs = json.load(f)
+
+    user_ids = list(badge_ids)
+    badges = sorted({b for achieved in badge_ids.values() for b in achieved})
+    columns = {b: i for i, b in enumerate(badges)}
+
+    has_badge = np.zeros((len(user_ids), len(badges)), dtype=bool)
+    counts = np.zeros(len(user_ids) * len(badges), dtype=np.int64)
+    days = []
+    for i, user in enumerate(user_ids):
+        for badge in sorted(badge_ids[user], key=columns.get):
+            has_badge[i, columns[badge]] = True
+            counts[i * len(badges) + columns[badge]] = len(badge_ids[user][badge])
+            days.extend(badge_ids[user][badge])
+
+    day_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    day_offsets[1:] = np.cumsum(counts)
+
+    position = {u: i for i, u in enumerate(user_ids)}
+    splits = {s: np.array([position[str(u)] for u in list_IDs[s]], dtype=np.int64) for s in SPLITS}
+
+    index = BadgeIndex(np.array(user_ids), np.array(badges), has_badge, day_offsets, np.array(days, dtype=np.int32), splits)
+    index.save(os.path.join(data_path, BADGE_INDEX))
+    return index
+
+
+def load_badge_index(data_path):
+    '''Loads ``badge_index.npz``, (re)building it first when it is missing or older than the json files'''
+    fname = os.path.join(data_path, BADGE_INDEX)
+    sources = [os.path.join(data_path, f) for f in ['badge_achievements.json', 'data_indexes.json']]
+    if os.path.exists(fname):
+        built = os.path.getmtime(fname)
+        if not any(os.path.exists(s) and os.path.getmtime(s) > built for s in sources):
+            return BadgeIndex.load(fname)
+    return build_badge_index(data_path)
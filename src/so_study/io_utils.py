@@ -0,0 +1,67 @@
+import os
+import threading
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+@contextlib.contextmanager
+def atomic_path(fname):
+    """
+    A temporary path next to ``fname`` that is moved onto ``fname`` once the block has written it without raising.
+    Readers (a concurrent job, or the next run after an interrupted one) then only ever see a missing or a complete
+    file, never a partial one. The temporary file is removed when the block fails.
+    """
+    tmp_fname = f'{fname}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        yield tmp_fname
+        os.replace(tmp_fname, fname)
+    finally:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+
+
+@contextlib.contextmanager
+def atomic_write(fname, mode='wb', opener=open):
+    """``opener(fname, mode)`` through atomic_path, e.g. ``with atomic_write(fname, 'w') as f: json.dump(obj, f)``"""
+    with atomic_path(fname) as tmp_fname:
+        with opener(tmp_fname, mode) as f:
+            yield f
+
+
+def file_stats(fnames):
+    """Size and modification time of the files that exist, to tell when a cached result is older than its data"""
+    stats = {}
+    for fname in fnames:
+        if os.path.exists(fname):
+            stat = os.stat(fname)
+            stats[os.path.basename(fname)] = [stat.st_size, stat.st_mtime]
+    return stats
+
+
+def map_processes(function, items, num_workers=None, ordered=True):
+    """
+    ProcessPoolExecutor.map that only keeps a few items in flight, so a chunk iterator (e.g. decompressed lines) is
+    not read ahead of the workers, and can yield the results in completion order
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(num_workers) as executor:
+        in_flight = []
+        for item in items:
+            in_flight.append(executor.submit(function, item))
+            if len(in_flight) > 2 * num_workers:
+                if ordered:
+                    yield in_flight.pop(0).result()
+                else:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        in_flight.remove(future)
+                        yield future.result()
+        if ordered:
+            for future in in_flight:
+                yield future.result()
+        else:
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    in_flight.remove(future)
+                    yield future.result()
@@ -1,14 +1,22 @@
 import os
+import glob
 import pickle
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 from torch.utils import data
+from torch.utils.data.dataloader import default_collate
 
 import numpy as np
 import json
 
 from tqdm import tqdm
 
+from so_study.trajectory_store import TRAJECTORY_BACKENDS, write_packed_trajectories, write_sparse_trajectories
+from so_study.badge_index import load_badge_index
+from so_study.io_utils import atomic_write, file_stats
+
 
 ACTIONS = ['Answers', 'Questions', 'Comments', 'Edits', 'AnswerVotes', 'QuestionVotes', 'ReviewTasks']
 BADGES = ['CivicDuty', 'CopyEditor', 'Electorate', 'Reviewer', 'Steward', 'StrunkWhite']
@@ -16,6 +24,8 @@ action_ixs = {a:i for i,a in enumerate(ACTIONS)}
 
 csv_path = '~/edinburgh/incentive_design/data/'
 
+WINDOW_FIELDS = ['x_in', 'kernel_data', 'x_out', 'prox_to_badge', 'badge_index']
+
 
 class IdentityScaler:
     def transform(self, x):
@@ -24,6 +34,54 @@ class IdentityScaler:
         return x
 
 
+class ScalerIn(IdentityScaler):
+    """Divides every action by its maximum, broadcasting a per-action scale vector over the last dimension"""
+    def __init__(self, maxes_in, actions=ACTIONS):
+        self.maxes_in = maxes_in
+        self.ACTIONS = actions
+        self.scale = np.array([maxes_in[a] for a in actions], dtype=np.float32)
+
+    def _scale_like(self, x):
+        if torch.is_tensor(x):
+            return torch.as_tensor(self.scale, dtype=x.dtype, device=x.device)
+        return self.scale
+
+    def transform(self, x):
+        if len(x.shape) == 2:
+            x = x.reshape(1,-1,len(self.ACTIONS))
+        return x / self._scale_like(x)
+
+    def inverse_transform(self, x):
+        if len(x.shape) == 2:
+            x = x.reshape(1,-1,len(self.ACTIONS))
+        return x * self._scale_like(x)
+
+
+class ScalerOut(IdentityScaler):
+    def __init__(self, maxes_in):
+        self.maxes_in = maxes_in
+
+    def transform(self, x):
+        return x/self.maxes_in
+
+    def inverse_transform(self, x):
+        return x*self.maxes_in
+
+
+class ScaleInputs:
+    """
+    collate_fn that applies the input scaler once per batch, for datasets created with scale_in_collate=True.
+    Picklable, so it can be used with DataLoader workers.
+    """
+    def __init__(self, scaler_in, collate_fn=None):
+        self.scaler_in = scaler_in
+        self.collate_fn = collate_batch if collate_fn is None else collate_fn
+
+    def __call__(self, batch):
+        batch = self.collate_fn(batch)
+        return (self.scaler_in.transform(batch[0]),) + tuple(batch[1:])
+
+
 class StackOverflowDataset(data.Dataset):
 
     def __init__(
@@ -43,13 +101,12 @@ class StackOverflowDataset(data.Dataset):
              offset=0,
              requires_offset=False,
              return_all_dim=False,
-             badges_to_ensure=[]
+             badges_to_ensure=[],
+             backend='pt',
+             batched=False
         ):
 
-        with open("{}/badge_achievements.json".format(data_path), 'r') as f:
-            badge_ids = json.load(f)
-        with open("{}/data_indexes.json".format(data_path), 'r') as f:
-            list_IDs = json.load(f)
+        badge_index = load_badge_index(data_path)
 
         self.badge_focus = badge_focus
         self.subsample = subsample
@@ -66,6 +123,9 @@ class StackOverflowDataset(data.Dataset):
         self.requires_offset = requires_offset
         self.return_all_dim = return_all_dim
         self.dropped = []
+        self.trajectories = TRAJECTORY_BACKENDS[backend](data_path)
+        self.materialized = None
+        self.batched = batched
 
         if input_length == 'full':
             self.input_length = self.window_length * 2
@@ -81,57 +141,36 @@ class StackOverflowDataset(data.Dataset):
         elif type(out_dim) == int:
             self.out_dim = out_dim
 
-        if dset_type == "all":
-            list_IDs_ = list_IDs["train"]+list_IDs["test"]+list_IDs["validate"]
-            self.list_IDs, self.badge_ids = self._preprocess_user_ids(list_IDs_, badge_ids, offset)
-        else:
-            self.list_IDs, self.badge_ids = self._preprocess_user_ids(list_IDs[dset_type], badge_ids, offset)
+        self.list_IDs, self.badge_ids = self._preprocess_user_ids(badge_index.rows(dset_type), badge_index, offset)
 
         self.data_shape = (self.input_length, len(ACTIONS))
 
-    def _preprocess_user_ids(self, list_IDs, badge_ids, offset=0):
-        feasible_users = []
-        feasible_badges = {}
-
-        for user in list_IDs:
-            user = str(user)
-
-            if self.badge_focus in badge_ids[user]:
-                valid = True
-
-                for badge in self.badges_to_avoid:
-                    if badge in badge_ids[user]:
-                        valid = False
-                        break
-
-                if not valid:
-                    continue
-
-                if len(self.badges_to_ensure) > 0:
-                    valid = False
-
-                    for badge in self.badges_to_ensure:
-                        if badge in badge_ids[user]:
-                            valid = True
-                            break
-
-                if valid:
-
-                    if self.requires_offset != 0:
-                        X = torch.load(os.path.join(self.data_path, 'user_' + user + '.pt'))[:, self.out_dim]
-                        day_of_badge = badge_ids[user][self.badge_focus]
-                        cum_sum_x = torch.cumsum(X, dim=0)
-                        num_actions_on_day = cum_sum_x[day_of_badge]
-                        if cum_sum_x[-1] < num_actions_on_day + 50:
-                            self.dropped.append(user)
-                            continue
-                        num_actions_plus_offset = num_actions_on_day + offset
-                        first_day_of_this_num = torch.where(cum_sum_x >= num_actions_plus_offset)[0][0]
-                        feasible_badges[user] = int(first_day_of_this_num)
-                    else:
-                        feasible_badges[user] = int(np.random.choice(badge_ids[user][self.badge_focus], size=1))
-
-                    feasible_users.append(user)
+    def _preprocess_user_ids(self, rows, badge_index, offset=0):
+        valid = badge_index.achieved(rows, self.badge_focus)
+        for badge in self.badges_to_avoid:
+            valid &= ~badge_index.achieved(rows, badge)
+        if len(self.badges_to_ensure) > 0:
+            valid &= np.any([badge_index.achieved(rows, badge) for badge in self.badges_to_ensure], axis=0)
+
+        rows = rows[valid]
+        first, last = badge_index.day_ranges(rows, self.badge_focus) if len(rows) > 0 else (rows, rows)
+        rows, first, last = rows[last > first], first[last > first], last[last > first]
+        feasible_users = [str(u) for u in badge_index.user_ids[rows]]
+
+        if self.requires_offset != 0:
+            # one batched lookup over the prefix counts of all candidates instead of loading every trajectory
+            days_of_badge = badge_index.days[first]
+            first_days, on_day, totals = self.trajectories.offset_days(
+                feasible_users, days_of_badge, np.full(len(feasible_users), offset), self.out_dim
+            )
+            keep = (totals >= on_day + 50) & (first_days >= 0)
+            self.dropped.extend(u for u, k in zip(feasible_users, keep) if not k)
+            feasible_users = [u for u, k in zip(feasible_users, keep) if k]
+            feasible_badges = {u: int(d) for u, d in zip(feasible_users, first_days[keep])}
+        else:
+            # one of the days on which the badge was achieved, drawn at random
+            days_of_badge = badge_index.days[first + np.random.randint(0, last - first)]
+            feasible_badges = {u: int(d) for u, d in zip(feasible_users, days_of_badge)}
 
         if len(feasible_users) < self.subsample:
             self.subsample = len(feasible_users)
@@ -166,13 +205,144 @@ class StackOverflowDataset(data.Dataset):
 
         return prox_to_badge
 
+    def _batch_data_trans_in(self, data):
+        return (data > 0).astype(np.float32)
+
+    def _batch_data_trans_out(self, data):
+        return (data > 0).astype(np.float32)
+
+    def _scaler_state(self):
+        return None
+
+    def _window_centers(self, IDs):
+        '''The window centers of a batch of users and the position of the badge within each window'''
+        badge_dates = np.array([self.badge_ids[ID] for ID in IDs], dtype=np.int64)
+
+        if self.centered:
+            centers = badge_dates
+        else:
+            start = np.maximum(0, badge_dates - self.window_length + 1)
+            stop = np.minimum(badge_dates + self.window_length - 1, self.trajectories.lengths(IDs))
+            np.random.seed()
+            centers = start + np.random.randint(0, stop - start)
+
+        return centers, self.window_length + badge_dates - centers
+
+    def _windows(self, IDs, centers):
+        output = self.trajectories.windows(IDs, np.asarray(centers) - self.window_length, 2*self.window_length)
+        return output.astype(np.float32)
+
+    def _transform_windows(self, output):
+        x_in = self._batch_data_trans_in(output[:, :self.input_length, :].copy())
+        if self.return_all_dim:
+            x_out = self._batch_data_trans_out(output.copy())
+        elif type(self.out_dim) == list:
+            x_out = self._batch_data_trans_out(output[:, :, self.out_dim].sum(axis=-1))
+        else:
+            x_out = self._batch_data_trans_out(output[:, :, self.out_dim].copy())
+        return x_in, x_out
+
+    def _build_items(self, IDs, centers, badge_indexes):
+        '''
+        Vectorized version of __getitem__: builds the stacked outputs for the windows around ``centers``,
+        where ``badge_indexes`` is the position of the badge within each window.
+        '''
+        N = len(IDs)
+        output = self._windows(IDs, centers)
+        badge_indexes = np.asarray(badge_indexes, dtype=np.int64)
+
+        x_in, x_out = self._transform_windows(output)
+
+        if type(self.out_dim) == list:
+            prox_to_badge = np.cumsum(output[:, :, self.out_dim].sum(axis=-1), axis=1)
+        else:
+            prox_to_badge = np.cumsum(output[:, :, self.out_dim], axis=1)
+        at_badge = prox_to_badge[np.arange(N), badge_indexes][:, None]
+        prox_to_badge = 1 - (prox_to_badge + (self.badge_threshold - at_badge)) / self.badge_threshold
+        prox_to_badge[np.arange(2*self.window_length)[None, :] > badge_indexes[:, None]] = 0
+        prox_to_badge = np.clip(prox_to_badge, 0, 1)[:, :self.input_length]
+
+        kernel_data = (2*self.window_length - badge_indexes)[:, None] + np.arange(2*self.window_length)
+
+        return (
+            x_in.astype(np.float32),
+            kernel_data.astype(np.float32),
+            x_out.astype(np.float32),
+            prox_to_badge.astype(np.float32),
+            badge_indexes.astype(np.float32)
+        )
+
+    def _data_fingerprint(self):
+        '''Sizes and modification times of the trajectory store and the json files written with it'''
+        fnames = self.trajectories.store_files + ['badge_achievements.json', 'data_indexes.json']
+        return file_stats([os.path.join(self.data_path, f) for f in fnames])
+
+    def _window_cache_key(self):
+        settings = {
+            'class': type(self).__name__,
+            'data_path': os.path.abspath(self.data_path),
+            'data': self._data_fingerprint(),
+            'window_length': self.window_length,
+            'input_length': self.input_length,
+            'out_dim': self.out_dim,
+            'badge_threshold': self.badge_threshold,
+            'return_all_dim': self.return_all_dim,
+            'scaler': _state_digest(self._scaler_state()),
+        }
+        return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+    def materialize(self, cache_dir=None):
+        '''
+        Builds every (centered) item of the dataset once and serves __getitem__ from the stacked tensors afterwards.
+        The windows are cached on disk per experiment setting and version of the data (in
+        ``data_path/window_cache/<key>`` by default). Each run only builds the windows of users no earlier run has
+        built and adds them as one more chunk file, so the cost of a run is its new windows plus reading the chunks.
+        '''
+        if not self.centered:
+            raise ValueError('Only centered windows are deterministic, random windows cannot be materialized')
+        if cache_dir is None:
+            cache_dir = os.path.join(self.data_path, 'window_cache')
+        cache_dir = os.path.join(cache_dir, self._window_cache_key())
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        IDs = np.array(self.list_IDs, dtype=str)
+        centers = np.array([self.badge_ids[ID] for ID in IDs], dtype=np.int64)
+
+        chunks = []
+        for fname in sorted(glob.glob(os.path.join(cache_dir, '*.npz'))):
+            with np.load(fname) as f:
+                chunks.append({k: f[k] for k in f.files})
+        cached = [k for c in chunks for k in zip(c['user_ids'], c['centers'])]
+        row_of = {k: i for i, k in enumerate(cached)}
+
+        missing = np.array([i for i, k in enumerate(zip(IDs, centers)) if k not in row_of], dtype=np.int64)
+        if len(missing) > 0:
+            items = self._build_items(IDs[missing], centers[missing], np.full(len(missing), self.window_length))
+            chunk = dict(zip(WINDOW_FIELDS, items), user_ids=IDs[missing], centers=centers[missing])
+            # named by its windows, so concurrent runs building the same windows write the same chunk
+            name = hashlib.sha1(IDs[missing].tobytes() + centers[missing].tobytes()).hexdigest()
+            with atomic_write(os.path.join(cache_dir, name + '.npz')) as f:
+                np.savez(f, **chunk)
+            row_of.update({k: len(cached) + i for i, k in enumerate(zip(IDs[missing], centers[missing]))})
+            chunks.append(chunk)
+
+        cache = {k: np.concatenate([c[k] for c in chunks]) for k in WINDOW_FIELDS}
+        rows = np.array([row_of[k] for k in zip(IDs, centers)], dtype=np.int64)
+        self.materialized = tuple(torch.from_numpy(cache[k][rows]) for k in WINDOW_FIELDS)
+
     def __getitem__(self, index):
         # Select sample
         ID = self.list_IDs[index]
+
+        if self.materialized is not None:
+            item = tuple(t[index] for t in self.materialized)
+            return item + (ID,) if self.return_user_id else item
+
         badge_index = self.badge_ids[ID]
 
         # Load data and get label
-        X = torch.load(os.path.join(self.data_path, 'user_' + ID + '.pt'))
+        X = self.trajectories[ID]
         output = torch.zeros(size=(2*self.window_length, X.size()[1]))
 
         # if torch.sum(X[badge_index, [4,5]]) == 0:
@@ -242,6 +412,62 @@ class StackOverflowDataset(data.Dataset):
             torch.tensor(badge_index, dtype=torch.float)
         )
 
+    def __getitems__(self, indexes):
+        '''
+        torch's DataLoader uses this in place of __getitem__ when it exists. Datasets created with batched=True
+        return the whole batch from get_batch and need ``collate_batch`` as the collate_fn of the loader, the
+        others return the list of items that default_collate expects.
+        '''
+        if self.batched:
+            return self.get_batch(indexes)
+        return [self[i] for i in indexes]
+
+    def get_batch(self, indexes):
+        '''The items at ``indexes`` built together and already stacked into batch tensors'''
+        indexes = np.asarray(indexes, dtype=np.int64)
+        IDs = np.asarray(self.list_IDs)[indexes]
+
+        if self.materialized is not None:
+            items = tuple(t[indexes] for t in self.materialized)
+            return items + (list(IDs),) if self.return_user_id else items
+
+        centers, badge_indexes = self._window_centers(IDs)
+        items = tuple(torch.from_numpy(a) for a in self._build_items(IDs, centers, badge_indexes))
+        return items + (list(IDs),) if self.return_user_id else items
+
+
+def collate_batch(batch):
+    '''collate_fn for datasets created with batched=True, falls back to default_collate for item lists'''
+    if isinstance(batch, tuple):
+        return batch
+    return default_collate(batch)
+
+
+class InMemoryLoader:
+    """
+    Stand-in for a DataLoader that iterates over shuffled index batches in the main process, without workers.
+    Centered datasets are stacked into tensors once; random windows are still drawn per batch.
+    """
+    def __init__(self, dataset, batch_size, shuffle=True):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.items = None
+
+        if dataset.centered:
+            self.items = dataset.get_batch(np.arange(len(dataset)))
+
+    def __len__(self):
+        return int(np.ceil(len(self.dataset) / self.batch_size))
+
+    def __iter__(self):
+        indexes = torch.randperm(len(self.dataset)) if self.shuffle else torch.arange(len(self.dataset))
+        for batch in indexes.split(self.batch_size):
+            if self.items is None:
+                yield self.dataset.get_batch(batch.numpy())
+            else:
+                yield tuple(t[batch] if torch.is_tensor(t) else [t[i] for i in batch] for t in self.items)
+
 
 class StackOverflowDatasetIncCounts(StackOverflowDataset):
     def __init__(
@@ -258,6 +484,8 @@ class StackOverflowDatasetIncCounts(StackOverflowDataset):
         scaler_out=IdentityScaler(),
         self_initialise=False,
         return_user_id=False,
+        scaler_cache_dir=None,
+        scale_in_collate=False,
         **kwargs
         ):
 
@@ -275,18 +503,36 @@ class StackOverflowDatasetIncCounts(StackOverflowDataset):
 
         self.scaler_in = scaler_in
         self.scaler_out = scaler_out
+        self.scale_in_collate = scale_in_collate
 
         if self_initialise:
-            self.scaler_in, self.scaler_out = calculate_feature_transformation(self)
+            self.scaler_in, self.scaler_out = calculate_feature_transformation(self, cache_dir=scaler_cache_dir)
+
+    def _item_scaler_in(self):
+        # the inputs are left unscaled when the scaling happens per batch in the collate function
+        return IdentityScaler() if self.scale_in_collate else self.scaler_in
 
     def _StackOverflowDataset__data_trans_in(self, data):
         mid = (data.float().view(-1, self.data_shape[0]*self.data_shape[1])).numpy()
-        return self.scaler_in.transform(mid).reshape(self.data_shape[0], self.data_shape[1])
+        return self._item_scaler_in().transform(mid).reshape(self.data_shape[0], self.data_shape[1])
 
     def _StackOverflowDataset__data_trans_out(self, data):
         # return self.scaler_out.transform(torch.log1p(data.float()))
         return data.float().numpy()
 
+    def _batch_data_trans_in(self, data):
+        return self._item_scaler_in().transform(data)
+
+    def _batch_data_trans_out(self, data):
+        return data
+
+    def _scaler_state(self):
+        return vars(self._item_scaler_in())
+
+    def collate_fn(self):
+        '''The collate_fn to use with a DataLoader over this dataset'''
+        return ScaleInputs(self.scaler_in) if self.scale_in_collate else collate_batch
+
     def get_scalers(self):
         return self.scaler_in, self.scaler_out
 
@@ -297,59 +543,87 @@ class StackOverflowDatasetIncCounts(StackOverflowDataset):
         return data.float
 
 
-def calculate_feature_transformation(train_dataset):
-    dat_in, dat_out = [], []
-
-    print("Processing training data")
-    for i in tqdm(range(len(train_dataset))):
-        resp = train_dataset.__getitem__(i)
-
-        in_d = resp[0]
-        out_d = resp[2]
-
-        dat_in.append(in_d.numpy())
-        dat_out.append(out_d.numpy())
-
-    dat_in = np.array(dat_in)
-    maxes_in = {}
-    if len(train_dataset.ACTIONS) > 1:
-        for i, action in enumerate(ACTIONS):
-            maxes_in[action] = np.max(dat_in[:,:,i])
-            dat_in[:, :, i] = dat_in[:,:,i]/maxes_in[action]
+def _state_digest(state):
+    '''json-able form of a scaler state, with the arrays replaced by a hash of their raw bytes'''
+    def raw(value):
+        if isinstance(value, np.ndarray):
+            value = np.ascontiguousarray(value)
+            return {'dtype': value.dtype.str, 'shape': value.shape, 'sha1': hashlib.sha1(value.tobytes()).hexdigest()}
+        if isinstance(value, np.generic):
+            return value.item()
+        return str(value)
+    return json.loads(json.dumps(state, sort_keys=True, default=raw))
+
+
+def _feature_maxima(train_dataset, chunk_size=1024, num_workers=None):
+    # per-action maxima of the inputs and the maximum of the outputs, reduced chunk by chunk straight from the
+    # trajectories without building the items
+    IDs = np.asarray(train_dataset.list_IDs)
+    centers, _ = train_dataset._window_centers(IDs)
+
+    def chunk_maxima(start):
+        output = train_dataset._windows(IDs[start:start + chunk_size], centers[start:start + chunk_size])
+        x_in, x_out = train_dataset._transform_windows(output)
+        return x_in.max(axis=(0, 1)), x_out.max()
+
+    with ThreadPoolExecutor(num_workers) as executor:
+        maxima = list(tqdm(executor.map(chunk_maxima, range(0, len(IDs), chunk_size)),
+                           total=int(np.ceil(len(IDs) / chunk_size)), desc="Processing training data"))
+
+    maxes_in = np.max([m[0] for m in maxima], axis=0)
+    maxes_out = np.max([m[1] for m in maxima])
+    return [float(m) for m in maxes_in], float(maxes_out)
+
+
+def _scaler_cache_key(train_dataset):
+    # the maxima depend on the drawn users and their badge days, not only on the settings they were drawn with
+    users = sorted(f'{ID}:{train_dataset.badge_ids[ID]}' for ID in train_dataset.list_IDs)
+    settings = {
+        'class': type(train_dataset).__name__,
+        'data_path': os.path.abspath(train_dataset.data_path),
+        'data': train_dataset._data_fingerprint(),
+        'users': hashlib.sha1('\n'.join(users).encode()).hexdigest(),
+        'dset_type': train_dataset.dset_type,
+        'subsample': train_dataset.subsample,
+        'badge_focus': train_dataset.badge_focus,
+        'badges_to_avoid': train_dataset.badges_to_avoid,
+        'badges_to_ensure': train_dataset.badges_to_ensure,
+        'centered': train_dataset.centered,
+        'window_length': train_dataset.window_length,
+        'input_length': train_dataset.input_length,
+        'out_dim': train_dataset.out_dim,
+        'return_all_dim': train_dataset.return_all_dim,
+        'ACTIONS': train_dataset.ACTIONS,
+        'offset': train_dataset.offset,
+        'requires_offset': train_dataset.requires_offset,
+    }
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def calculate_feature_transformation(train_dataset, cache_dir=None):
+    """
+    Fits the input/output scalers on the training split. With a ``cache_dir`` the fitted maxima are stored per
+    version of the data, dataset setting and sample of users, and runs that draw the same sample reuse them
+    instead of refitting.
+    """
+    fname = None
+    if cache_dir is not None:
+        fname = os.path.join(cache_dir, f'scaler_{_scaler_cache_key(train_dataset)}.json')
+
+    if fname is not None and os.path.exists(fname):
+        with open(fname, 'r') as f:
+            fitted = json.load(f)
     else:
-        maxes_in[0] = np.max(dat_in[:, :, 0])
-        dat_in[:, :, 0] = dat_in[:, :, 0]/maxes_in[0]
-
-    maxes_out = np.max(dat_out)
-    dat_out = dat_out / maxes_out
-
-    class ScalerIn(IdentityScaler):
-        def __init__(self, maxes_in, actions=ACTIONS):
-            self.maxes_in = maxes_in
-            self.ACTIONS = actions
-
-        def transform(self, x):
-            if len(x.shape) == 2:
-                x = x.reshape(1,-1,len(self.ACTIONS))
-            for i,a in enumerate(self.ACTIONS):
-                x[:, :, i] = x[:, :, i] / self.maxes_in[a]
-            return x
-
-        def inverse_transform(self, x):
-            if len(x.shape) == 2:
-                x = x.reshape(1,-1,len(self.ACTIONS))
-            for i,a in enumerate(self.ACTIONS):
-                x[:, :, i] = x[:, :, i] * self.maxes_in[a]
-            return x
-
-    class ScalerOut(IdentityScaler):
-        def __init__(self, maxes_in):
-            self.maxes_in = maxes_in
-        def transform(self, x):
-            return x/self.maxes_in
-
-        def inverse_transform(self, x):
-            return x*self.maxes_in
+        maxes_in, maxes_out = _feature_maxima(train_dataset)
+        fitted = {'maxes_in': maxes_in, 'maxes_out': maxes_out}
+        if fname is not None:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            with atomic_write(fname, 'w') as f:
+                json.dump(fitted, f)
+
+    maxes_in = dict(zip(train_dataset.ACTIONS, fitted['maxes_in']))
+    maxes_out = fitted['maxes_out']
 
     scaler_in = ScalerIn(maxes_in, train_dataset.ACTIONS)
     scaler_out = ScalerOut(maxes_out)
@@ -505,56 +779,84 @@ def transform_data_to_file_folder_structure(path_to_csv, path_to_data_dir):
         json.dump(obj, f)
 
 
-def compile_smaller_files(input_actions, input_badges):
-    output_action_f_name = '../data/raw_data_from_so_query/actions_over_time.csv'
-    output_badges_f_name = '../data/raw_data_from_so_query/strunk_and_white_achievements.csv'
+def _nonzero_action_counts(file, columns, positions, users):
+    '''
+    Reads the given count columns of one exported csv and returns them in long format: the user ids of the file
+    and the (user, column position, count) triples of its non-zero counts
+    '''
+    import pandas as pd
 
-    df_actions = pd.read_csv(input_actions[0])
-    for file in input_actions[1:]:
-        df_actions_temp = pd.read_csv(file)
-        df_actions = df_actions.merge(df_actions_temp, on='UserId', suffixes=("_x", ""), how='outer')
+    dtypes = {c: np.float32 for c in columns}
+    dtypes['UserId'] = np.int64
+    df = pd.read_csv(file, usecols=['UserId'] + columns, dtype=dtypes)
+    df = df.drop_duplicates(subset='UserId')
+    df = df[df.UserId.isin(users)]
 
-    df_badges = pd.read_csv(input_badges[0])
-    for file in input_badges[1:]:
-        df_badges_temp = pd.read_csv(file)
-        df_badges = df_badges.merge(df_badges_temp, on='UserId', suffixes=("_x", ""), how='outer')
+    user_ids = df.UserId.values
+    counts = df[columns].values
+    rows, cols = np.nonzero(counts > 0)  # NaN compares False, so missing counts are dropped with the zeros
+    return user_ids, user_ids[rows], positions[cols], counts[rows, cols]
 
-        df_badges.drop_duplicates(subset="UserId", inplace=True)
-        df_badges.fillna(0, inplace=True)
 
-        df_badges.set_index('UserId', inplace=True)
-        df_badges.loc[df_badges['Date'] == 0, 'Date'] = df_badges.loc[df_badges['Date'] == 0, 'Date_x']
-        df_badges.drop(columns=['Date_x'], inplace=True)
-        df_badges = df_badges[df_badges['Date'] != 0]
-        df_badges.reset_index(inplace=True)
+def compile_smaller_files(input_actions, input_badges, num_workers=None):
+    '''
+    Combines the yearly exports of the Stack Overflow query editor. Every file is parsed once (in parallel) into
+    the non-zero (user, day, count) triples which are pivoted into a single users x days table at the end.
+    When a day is in several exports the counts of the last one are kept, for badges the last achievement date.
+    '''
+    import pandas as pd
 
-    cols_to_drop = df_actions.columns[df_actions.columns.str.contains("_x")]
-    df_actions.drop(columns=cols_to_drop, inplace=True)
+    output_action_f_name = '../data/raw_data_from_so_query/actions_over_time.csv'
+    output_badges_f_name = '../data/raw_data_from_so_query/strunk_and_white_achievements.csv'
 
-    cols = df_actions.columns[df_actions.columns.str.contains("-")]
-    dates = pd.to_datetime(cols).date
-    df_actions.rename(columns={d: c for d, c in zip(cols, dates)}, inplace=True)
-    df_actions.drop_duplicates(subset="UserId", inplace=True)
-    df_actions.fillna(0, inplace=True)
+    with ThreadPoolExecutor(num_workers) as executor:
+        df_badges = pd.concat(list(executor.map(pd.read_csv, input_badges)), ignore_index=True)
+    df_badges.drop_duplicates(subset='UserId', keep='last', inplace=True)
 
     df_badges.Date = pd.to_datetime(df_badges.Date)
-    df_badges = df_badges[df_badges.Date > pd.datetime(year=2010, month=2, day=1)]
-    df_badges = df_badges[df_badges.Date < pd.datetime(year=2020, month=1, day=1)]
+    df_badges = df_badges[df_badges.Date > pd.Timestamp(year=2010, month=2, day=1)]
+    df_badges = df_badges[df_badges.Date < pd.Timestamp(year=2020, month=1, day=1)]
+
+    # every column is read from the last export that contains it
+    headers = [pd.read_csv(file, nrows=0).columns.drop('UserId') for file in input_actions]
+    owner = {c: k for k, header in enumerate(headers) for c in header}
+    columns = [c for k, header in enumerate(headers) for c in header if owner[c] == k]
+    position = {c: i for i, c in enumerate(columns)}
+    owned = [[c for c in header if owner[c] == k] for k, header in enumerate(headers)]
+
+    def read(k):
+        cols = owned[k]
+        return _nonzero_action_counts(input_actions[k], cols, np.array([position[c] for c in cols], dtype=np.int64),
+                                      df_badges.UserId.values)
+
+    with ThreadPoolExecutor(num_workers) as executor:
+        parts = list(executor.map(read, range(len(input_actions))))
+
+    user_ids = np.unique(np.concatenate([p[0] for p in parts]))
+    rows = np.searchsorted(user_ids, np.concatenate([p[1] for p in parts]))
+    counts = np.zeros((len(user_ids), len(columns)), dtype=np.int64)
+    counts[rows, np.concatenate([p[2] for p in parts])] = np.concatenate([p[3] for p in parts])
 
-    df_actions = df_actions[df_actions.UserId.isin(df_badges.UserId)]
+    names = [str(pd.to_datetime(c).date()) if '-' in c else c for c in columns]
+    df_actions = pd.DataFrame(counts, columns=names)
+    df_actions.insert(0, 'UserId', user_ids)
 
     df_actions.to_csv(output_action_f_name, index=False)
     df_badges.to_csv(output_badges_f_name, index=False)
 
 
-def transform_editing_data_to_file_folder_structure(path_to_csv_actions, path_to_csv_badges, path_to_data_dir):
+def transform_editing_data_to_file_folder_structure(path_to_csv_actions, path_to_csv_badges, path_to_data_dir,
+                                                    output_format='pt', num_workers=None):
     '''
     Expecting data in the PIVOTED format from the Stack Overflow query editor. 
     Here the csv file has an index of userIds, and the columns are the date from 
     start to end. The values are the counts of edits that that user performed on that
     day. There is a separate file for the userId.
+
+    The whole dataset is built as one (users x days) count matrix and written as per-user user_<id>.pt files
+    (output_format='pt', written in parallel) or directly in the packed or sparse format of so_study.trajectory_store.
     '''
-    import tqdm
+    import pandas as pd
 
     data_actions = pd.read_csv(path_to_csv_actions)
     badge_achievements = pd.read_csv(path_to_csv_badges)
@@ -562,7 +864,7 @@ def transform_editing_data_to_file_folder_structure(path_to_csv_actions, path_to
     data_actions = data_actions[data_actions.UserId.isin(badge_achievements.UserId)]
     badge_achievements = badge_achievements[badge_achievements.UserId.isin(data_actions.UserId)]
 
-    start_date = pd.datetime(year=2009, month=1, day=1)
+    start_date = pd.Timestamp(year=2009, month=1, day=1)
 
     badge_achievements.Date = pd.to_datetime(badge_achievements.Date)
     badge_achievements['day'] = (badge_achievements.Date - start_date).dt.days
@@ -583,20 +885,32 @@ def transform_editing_data_to_file_folder_structure(path_to_csv_actions, path_to
 
     num_days = (badge_achievements.Date.max() - start_date).days
 
-    for dset in [train, validate, test]:
-        for user in tqdm.tqdm(dset):
-
-            trajectory = data_actions.loc[user]
-            trajectory = trajectory.reset_index()
-            trajectory['index'] = pd.to_datetime(trajectory['index'])
-            trajectory['day'] = (trajectory['index'] - start_date).dt.days
-            trajectory.rename(columns={'index': 'date', user: 'num_actions'}, inplace=True)
-            trajectory.sort_values('day', inplace=True)
-            trajectory.set_index('day', inplace=True)
-            trajectory = trajectory.reindex(range(num_days+1), fill_value=0)
-
-            action_trajectory = torch.tensor(trajectory[['num_actions']].values, dtype=torch.long)
-            torch.save(action_trajectory, '{}/user_{}.pt'.format(path_to_data_dir, user))
+    # the date columns are shared by all users, so they are parsed once and every user is written into the same matrix
+    column_days = np.asarray((pd.to_datetime(data_actions.columns) - start_date).days)
+    in_range = (column_days >= 0) & (column_days <= num_days)
+
+    users = np.concatenate([train, validate, test])
+    counts = np.zeros((len(users), num_days + 1), dtype=np.int64)
+    counts[:, column_days[in_range]] = data_actions.loc[users].values[:, in_range].astype(np.int64)
+
+    if output_format == 'pt':
+        def save_user(i):
+            action_trajectory = torch.from_numpy(counts[i][:, None].copy())
+            torch.save(action_trajectory, '{}/user_{}.pt'.format(path_to_data_dir, users[i]))
+
+        with ThreadPoolExecutor(num_workers) as executor:
+            list(tqdm(executor.map(save_user, range(len(users))), total=len(users), desc='dumping trajectories'))
+    elif output_format == 'packed':
+        offsets = np.arange(len(users) + 1, dtype=np.int64) * (num_days + 1)
+        write_packed_trajectories(path_to_data_dir, users, offsets, counts.reshape(-1, 1))
+    elif output_format == 'sparse':
+        rows, days = np.nonzero(counts)
+        offsets = np.zeros(len(users) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(rows, minlength=len(users)))
+        lengths = np.full(len(users), num_days + 1, dtype=np.int64)
+        write_sparse_trajectories(path_to_data_dir, users, lengths, offsets, days, counts[rows, days][:, None])
+    else:
+        raise ValueError(f"Unknown output format {output_format}, expected one of 'pt', 'packed' or 'sparse'")
 
     with open('{}/badge_achievements.json'.format(path_to_data_dir), 'w') as f:
         badge_dict = badge_achievements['day'].to_dict()
@@ -611,7 +925,7 @@ def transform_editing_data_to_file_folder_structure(path_to_csv_actions, path_to
         json.dump(obj, f)
 
 
-def transform_raw_edit_data_to_pt_format():
+def transform_raw_edit_data_to_pt_format(output_format='pt'):
 
     ##########################################################
     ###### EDITING
@@ -627,5 +941,6 @@ def transform_raw_edit_data_to_pt_format():
     path_to_csv_badges = '../data/raw_data_from_so_query/strunk_and_white_achievements.csv'
     data_dir = '../data/pt_editor'
 
-    transform_editing_data_to_file_folder_structure(path_to_csv_actions, path_to_csv_badges, data_dir)
+    transform_editing_data_to_file_folder_structure(path_to_csv_actions, path_to_csv_badges, data_dir,
+                                                    output_format=output_format)
     # transform_data_to_file_folder_structure("../data/so_badges.csv", "../data/pt_reviewer")
@@ -91,12 +91,16 @@ def main(args, experiment_settings):
 
     loader_params = experiment_settings.common_params
     loader_params["data_path"] = args.input
+    loader_params["backend"] = args.data_backend
+    # with --batched the datasets build whole batches in get_batch, collate_batch passes them through
+    loader_params["batched"] = args.batched
 
     dset_train = so_data.StackOverflowDatasetIncCounts(
         dset_type='train',
         subsample=5000,
         **loader_params,
-        self_initialise=True
+        self_initialise=True,
+        scaler_cache_dir=os.path.join(args.input, 'scalers') if args.scaler_cache else None
     )
     scalers = dset_train.get_scalers()
 
@@ -117,8 +121,16 @@ def main(args, experiment_settings):
         scaler_out=scalers[1]
     )
 
-    train_loader = DataLoader(dset_train, **params)
-    valid_loader = DataLoader(dset_valid, **params)
+    if args.materialize:
+        dset_train.materialize()
+        dset_valid.materialize()
+
+    if args.in_memory:
+        train_loader = so_data.InMemoryLoader(dset_train, params['batch_size'], shuffle=params['shuffle'])
+        valid_loader = so_data.InMemoryLoader(dset_valid, params['batch_size'], shuffle=params['shuffle'])
+    else:
+        train_loader = DataLoader(dset_train, collate_fn=so_data.collate_batch, **params)
+        valid_loader = DataLoader(dset_valid, collate_fn=so_data.collate_batch, **params)
 
     print(args.model_name)
     model_class = available_models[args.model_name]
@@ -274,6 +286,22 @@ def construct_parser():
                         help='Choose the model to run')
     parser.add_argument('-D', '--target-badge', default="StrunkWhite", required=False,
                         help='Which badge do you want to run inference on?')
+    parser.add_argument('--data-backend', default='pt', choices=['pt', 'packed', 'sparse'],
+                        help='How the user trajectories are stored: one user_<id>.pt file per user (pt), the '
+                             'memory-mapped file written by `preprocessing.py pack_trajectories` (packed) or the '
+                             'active days only, written by `preprocessing.py sparsify_trajectories` (sparse)')
+    parser.add_argument('--materialize', action='store_true', default=False,
+                        help='Build the centered windows of every split once (cached under <input>/window_cache) '
+                             'instead of recomputing them for every item of every epoch')
+    parser.add_argument('--scaler-cache', action='store_true', default=False,
+                        help='Store the fitted feature scalers under <input>/scalers and reuse them in later runs '
+                             'that draw the same training users from the same data')
+    parser.add_argument('--batched', action='store_true', default=False,
+                        help='Let the data loaders fetch each batch with one vectorized read instead of one read per '
+                             'item')
+    parser.add_argument('--in-memory', action='store_true', default=False,
+                        help='Stack every split into tensors once and iterate over them in the main process '
+                             'instead of using DataLoader worker processes')
     parser.add_argument('-i', '--input', required=True, help='Path to the input data for the model to read')
     parser.add_argument('-o', '--output', required=True, help='Path to the directory to write output to')
     return parser
@@ -0,0 +1,427 @@
+import os
+import glob
+
+import numpy as np
+import torch
+
+from tqdm import tqdm
+
+from so_study.io_utils import atomic_path, atomic_write
+
+
+PACKED_VALUES = 'trajectories.npy'
+PACKED_INDEX = 'trajectory_index.npz'
+PACKED_CUMSUM = 'trajectory_cumsum_{}.npy'
+SPARSE_DAYS = 'sparse_days.npy'
+SPARSE_COUNTS = 'sparse_counts.npy'
+SPARSE_INDEX = 'sparse_index.npz'
+
+
+def _compact_dtype(min_value, max_value):
+    # only dtypes that torch.from_numpy can wrap without a copy
+    for dtype in [np.uint8, np.int16, np.int32]:
+        info = np.iinfo(dtype)
+        if info.min <= min_value and max_value <= info.max:
+            return dtype
+    return np.int64
+
+
+def _user_from_file(fname):
+    return os.path.basename(fname)[len('user_'):-len('.pt')]
+
+
+def _as_columns(columns):
+    return [columns] if isinstance(columns, (int, np.integer)) else list(columns)
+
+
+def _write_cumsum(fname, values, offsets, columns, chunk_size=1 << 20):
+    """
+    Running count of the ``columns`` actions of every user, restarting at each user, written in chunks so that it
+    never has to fit in memory. The dtype only needs to hold the largest possible count of a single user.
+    """
+    max_length = int(np.diff(offsets).max()) if len(offsets) > 1 else 0
+    max_value = int(values.max()) if values.size > 0 else 0
+    dtype = _compact_dtype(0, max_value * len(columns) * max_length)
+
+    with atomic_path(fname) as tmp_fname:
+        cumsum = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=dtype, shape=(values.shape[0],))
+        # running count over the whole file before the first row of every user
+        user_start = np.zeros(len(offsets) - 1, dtype=np.int64)
+        carry = 0
+        for start in range(0, values.shape[0], chunk_size):
+            stop = min(start + chunk_size, values.shape[0])
+            counts = values[start:stop][:, columns].sum(axis=1, dtype=np.int64)
+            total = np.cumsum(counts) + carry
+            starting = np.where((offsets[:-1] >= start) & (offsets[:-1] < stop))[0]
+            user_start[starting] = total[offsets[starting] - start] - counts[offsets[starting] - start]
+            owner = np.searchsorted(offsets, np.arange(start, stop), side='right') - 1
+            cumsum[start:stop] = total - user_start[owner]
+            carry = total[-1]
+        cumsum.flush()
+        del cumsum
+
+
+class TorchFileTrajectories:
+    """One ``user_<id>.pt`` file per trajectory, as written by the preprocessing scripts"""
+    # the files are rewritten together with the json files of the dataset, there is no single file to check
+    store_files = []
+
+    def __init__(self, data_path):
+        self.data_path = data_path
+        self._lengths = {}
+
+    def __getitem__(self, user):
+        return torch.load(os.path.join(self.data_path, 'user_' + str(user) + '.pt'))
+
+    def lengths(self, users):
+        for user in users:
+            if user not in self._lengths:
+                self._lengths[user] = self[user].size()[0]
+        return np.array([self._lengths[user] for user in users], dtype=np.int64)
+
+    def offset_days(self, users, days, increments, columns):
+        '''
+        For every user: the first day on which the number of ``columns`` actions counted from the start of the
+        trajectory reaches (the count on ``day``) + ``increment`` (-1 when it is never reached), the count on
+        ``day`` and the user's total count.
+        '''
+        columns = _as_columns(columns)
+        first_days = np.full(len(users), -1, dtype=np.int64)
+        on_day = np.zeros(len(users), dtype=np.int64)
+        totals = np.zeros(len(users), dtype=np.int64)
+        for i, (user, day, increment) in enumerate(zip(users, days, increments)):
+            cum_sum_x = torch.cumsum(self[user][:, columns].sum(dim=-1), dim=0).numpy()
+            on_day[i] = cum_sum_x[day]
+            totals[i] = cum_sum_x[-1]
+            reached = np.where(cum_sum_x >= on_day[i] + increment)[0]
+            if len(reached) > 0:
+                first_days[i] = reached[0]
+        return first_days, on_day, totals
+
+    def windows(self, users, starts, length):
+        '''Rows ``start:start+length`` of every user's trajectory, zero padded where they fall outside of it'''
+        out = None
+        for i, (user, start) in enumerate(zip(users, starts)):
+            X = self[user].numpy()
+            if out is None:
+                out = np.zeros((len(users), length, X.shape[1]), dtype=X.dtype)
+            lo, hi = max(start, 0), min(start + length, X.shape[0])
+            if lo < hi:
+                out[i, lo - start:hi - start] = X[lo:hi]
+        return out
+
+
+class PackedTrajectories:
+    """
+    All trajectories of a dataset stacked into a single ``(sum of lengths, actions)`` array, read through np.memmap.
+    User ``i`` occupies the rows ``offsets[i]:offsets[i+1]``.
+    """
+    store_files = [PACKED_VALUES, PACKED_INDEX]
+
+    def __init__(self, data_path):
+        self.data_path = data_path
+        self._values = None
+        self._offsets = None
+        self._positions = None
+        self._prefix_counts = {}
+
+    def _open(self):
+        if self._values is not None:
+            return
+        index = np.load(os.path.join(self.data_path, PACKED_INDEX))
+        self._offsets = index['offsets']
+        self._positions = {u: i for i, u in enumerate(index['user_ids'])}
+        # copy-on-write so that torch can wrap the slices without complaining about read-only memory
+        self._values = np.load(os.path.join(self.data_path, PACKED_VALUES), mmap_mode='c')
+
+    def __getstate__(self):
+        # never pickle the mapped array into the DataLoader workers, each worker re-opens the file
+        state = self.__dict__.copy()
+        state['_values'] = None
+        state['_offsets'] = None
+        state['_positions'] = None
+        state['_prefix_counts'] = {}
+        return state
+
+    def __getitem__(self, user):
+        self._open()
+        i = self._positions[str(user)]
+        return torch.from_numpy(self._values[self._offsets[i]:self._offsets[i + 1]])
+
+    def _locate(self, users):
+        self._open()
+        positions = np.array([self._positions[str(u)] for u in users], dtype=np.int64)
+        return self._offsets[positions], self._offsets[positions + 1]
+
+    def lengths(self, users):
+        begin, end = self._locate(users)
+        return end - begin
+
+    def windows(self, users, starts, length):
+        '''Rows ``start:start+length`` of every user's trajectory, zero padded where they fall outside of it'''
+        begin, end = self._locate(users)
+        lengths = end - begin
+
+        steps = np.asarray(starts, dtype=np.int64)[:, None] + np.arange(length)
+        valid = (steps >= 0) & (steps < lengths[:, None])
+        out = self._values[np.where(valid, begin[:, None] + steps, 0)]
+        out[~valid] = 0
+        return out
+
+    def _prefix(self, columns):
+        # per user running count of the selected actions, only built (once) the first time an offset is needed
+        key = tuple(columns)
+        if key not in self._prefix_counts:
+            fname = os.path.join(self.data_path, PACKED_CUMSUM.format('_'.join(str(c) for c in columns)))
+            if not os.path.exists(fname):
+                self._open()
+                _write_cumsum(fname, self._values, self._offsets, list(columns))
+            self._prefix_counts[key] = np.load(fname, mmap_mode='r')
+        return self._prefix_counts[key]
+
+    def offset_days(self, users, days, increments, columns):
+        '''
+        For every user: the first day on which the number of ``columns`` actions counted from the start of the
+        trajectory reaches (the count on ``day``) + ``increment`` (-1 when it is never reached), the count on
+        ``day`` and the user's total count.
+        '''
+        prefix = self._prefix(_as_columns(columns))
+        begin, end = self._locate(users)
+        empty = end == begin
+        last = np.maximum(end - 1, 0)
+
+        totals = np.where(empty, 0, prefix[last]).astype(np.int64)
+        on_day = np.where(empty, 0, prefix[np.minimum(begin + np.asarray(days, dtype=np.int64), last)])
+        on_day = on_day.astype(np.int64)
+
+        targets = on_day + np.asarray(increments)
+        first_days = np.full(len(begin), -1, dtype=np.int64)
+        for i, (b, e, target) in enumerate(zip(begin, end, targets)):
+            reached = np.searchsorted(prefix[b:e], target, side='left')
+            if reached < e - b:
+                first_days[i] = reached
+        return first_days, on_day, totals
+
+
+class SparseTrajectories:
+    """
+    Only the days with any activity: ``days`` and the ``(events, actions)`` counts on those days, both sorted by
+    user and then day. User ``i`` owns the events ``offsets[i]:offsets[i+1]`` and is ``lengths[i]`` days long.
+    """
+    store_files = [SPARSE_DAYS, SPARSE_COUNTS, SPARSE_INDEX]
+
+    def __init__(self, data_path):
+        self.data_path = data_path
+        self._days = None
+        self._counts = None
+        self._offsets = None
+        self._lengths = None
+        self._positions = None
+        self._keys = None
+        self._prefix_counts = {}
+
+    def _open(self):
+        if self._days is not None:
+            return
+        index = np.load(os.path.join(self.data_path, SPARSE_INDEX))
+        self._offsets = index['offsets']
+        self._lengths = index['lengths']
+        self._positions = {u: i for i, u in enumerate(index['user_ids'])}
+        self._counts = np.load(os.path.join(self.data_path, SPARSE_COUNTS), mmap_mode='c')
+        days = np.load(os.path.join(self.data_path, SPARSE_DAYS))
+        # (user position, day) folded into one sorted key, so that day lookups for many users are one searchsorted
+        self._stride = int(self._lengths.max()) + 1 if len(self._lengths) > 0 else 1
+        owner = np.repeat(np.arange(len(self._lengths), dtype=np.int64), np.diff(self._offsets))
+        self._keys = owner * self._stride + days
+        self._days = days
+
+    def __getstate__(self):
+        # the arrays are re-opened lazily in each DataLoader worker
+        state = self.__dict__.copy()
+        for k in ['_days', '_counts', '_offsets', '_lengths', '_positions', '_keys']:
+            state[k] = None
+        state['_prefix_counts'] = {}
+        return state
+
+    def _locate(self, users):
+        self._open()
+        positions = np.array([self._positions[str(u)] for u in users], dtype=np.int64)
+        return positions, self._offsets[positions], self._offsets[positions + 1]
+
+    def __getitem__(self, user):
+        positions, begin, end = self._locate([user])
+        X = np.zeros((self._lengths[positions[0]], self._counts.shape[1]), dtype=self._counts.dtype)
+        X[self._days[begin[0]:end[0]]] = self._counts[begin[0]:end[0]]
+        return torch.from_numpy(X)
+
+    def lengths(self, users):
+        positions, _, _ = self._locate(users)
+        return self._lengths[positions]
+
+    def windows(self, users, starts, length):
+        '''Rows ``start:start+length`` of every user's trajectory, zero padded where they fall outside of it'''
+        positions, _, _ = self._locate(users)
+        starts = np.asarray(starts, dtype=np.int64)
+        base = positions * self._stride
+        # days are clipped to the user's own key range so that windows never pick up the neighbouring users' events
+        lo = np.searchsorted(self._keys, base + np.clip(starts, 0, self._stride))
+        hi = np.searchsorted(self._keys, base + np.clip(starts + length, 0, self._stride))
+        hi = np.maximum(hi, lo)
+
+        # the events of all windows laid out one after the other
+        n = hi - lo
+        window = np.repeat(np.arange(len(positions)), n)
+        events = np.arange(n.sum()) + np.repeat(lo - np.cumsum(n) + n, n)
+
+        out = np.zeros((len(positions), length, self._counts.shape[1]), dtype=self._counts.dtype)
+        out[window, self._days[events] - starts[window]] = self._counts[events]
+        return out
+
+    def _prefix(self, columns):
+        key = tuple(columns)
+        if key not in self._prefix_counts:
+            self._prefix_counts[key] = np.cumsum(self._counts[:, columns].sum(axis=1), dtype=np.int64)
+        return self._prefix_counts[key]
+
+    def offset_days(self, users, days, increments, columns):
+        '''
+        For every user: the first day on which the number of ``columns`` actions counted from the start of the
+        trajectory reaches (the count on ``day``) + ``increment`` (-1 when it is never reached), the count on
+        ``day`` and the user's total count.
+        '''
+        positions, begin, end = self._locate(users)
+        prefix = self._prefix(_as_columns(columns))
+
+        def count_before(event):
+            # number of actions in the events before ``event`` in the file
+            return np.where(event > 0, prefix[np.maximum(event - 1, 0)], 0)
+
+        before = count_before(begin)
+        totals = count_before(end) - before
+        on_day = count_before(np.searchsorted(self._keys, positions * self._stride + np.asarray(days), side='right'))
+        on_day = on_day - before
+
+        targets = on_day + np.asarray(increments)
+        reached = np.searchsorted(prefix, before + targets, side='left')
+        first_days = np.where(reached < end, self._days[np.minimum(reached, len(self._days) - 1)], -1)
+        first_days = np.where(targets <= 0, 0, first_days)
+        return first_days, on_day, totals
+
+
+TRAJECTORY_BACKENDS = {
+    'pt': TorchFileTrajectories,
+    'packed': PackedTrajectories,
+    'sparse': SparseTrajectories,
+}
+
+
+def _write_packed_index(out_path, user_ids, offsets):
+    # the running counts were built from the values that were just replaced
+    for fname in glob.glob(os.path.join(out_path, PACKED_CUMSUM.format('*'))):
+        os.remove(fname)
+    # the index is written last, readers open it first and so only find a new store once its values are complete
+    with atomic_write(os.path.join(out_path, PACKED_INDEX)) as f:
+        np.savez(f, user_ids=np.array([str(u) for u in user_ids]), offsets=np.asarray(offsets, dtype=np.int64))
+
+
+def write_packed_trajectories(out_path, user_ids, offsets, values):
+    '''Writes the arrays read by PackedTrajectories from trajectories that are already stacked in memory'''
+    if not os.path.exists(out_path):
+        os.makedirs(out_path)
+    min_value = int(values.min()) if values.size > 0 else 0
+    max_value = int(values.max()) if values.size > 0 else 0
+    values = values.astype(_compact_dtype(min_value, max_value))
+    with atomic_write(os.path.join(out_path, PACKED_VALUES)) as f:
+        np.save(f, values)
+    _write_packed_index(out_path, user_ids, offsets)
+
+
+def write_sparse_trajectories(out_path, user_ids, lengths, offsets, days, counts):
+    '''Writes the arrays read by SparseTrajectories'''
+    if not os.path.exists(out_path):
+        os.makedirs(out_path)
+    min_value = int(counts.min()) if counts.size > 0 else 0
+    max_value = int(counts.max()) if counts.size > 0 else 0
+    with atomic_write(os.path.join(out_path, SPARSE_DAYS)) as f:
+        np.save(f, np.asarray(days, dtype=np.int32))
+    with atomic_write(os.path.join(out_path, SPARSE_COUNTS)) as f:
+        np.save(f, counts.astype(_compact_dtype(min_value, max_value)))
+    # written last, like the index of the packed store
+    with atomic_write(os.path.join(out_path, SPARSE_INDEX)) as f:
+        np.savez(
+            f,
+            user_ids=np.array([str(u) for u in user_ids]),
+            lengths=np.asarray(lengths, dtype=np.int64),
+            offsets=np.asarray(offsets, dtype=np.int64)
+        )
+
+
+def sparsify_trajectory_directory(data_path, out_path=None):
+    '''Converts a ``pt_*`` directory of ``user_<id>.pt`` trajectories into the sparse format read by SparseTrajectories'''
+    if out_path is None:
+        out_path = data_path
+
+    files = sorted(glob.glob(os.path.join(data_path, 'user_*.pt')))
+    if len(files) == 0:
+        raise ValueError(f'No user_<id>.pt files found in {data_path}')
+
+    lengths = np.zeros(len(files), dtype=np.int64)
+    offsets = np.zeros(len(files) + 1, dtype=np.int64)
+    days, counts = [], []
+    for i, fname in enumerate(tqdm(files, desc='sparsifying trajectories')):
+        X = torch.load(fname).numpy()
+        active = np.where((X != 0).any(axis=1))[0]
+        lengths[i] = X.shape[0]
+        offsets[i + 1] = offsets[i] + len(active)
+        days.append(active)
+        counts.append(X[active])
+
+    write_sparse_trajectories(
+        out_path, [_user_from_file(f) for f in files], lengths, offsets, np.concatenate(days), np.concatenate(counts)
+    )
+
+
+def pack_trajectory_directory(data_path, out_path=None):
+    '''
+    Converts a ``pt_*`` directory of ``user_<id>.pt`` trajectories into the packed format read by
+    PackedTrajectories. The values are stored with the smallest integer dtype that holds them.
+    '''
+    if out_path is None:
+        out_path = data_path
+    if not os.path.exists(out_path):
+        os.makedirs(out_path)
+
+    files = sorted(glob.glob(os.path.join(data_path, 'user_*.pt')))
+    if len(files) == 0:
+        raise ValueError(f'No user_<id>.pt files found in {data_path}')
+
+    # first pass only collects the shapes and value range so that the output can be written without holding it in memory
+    lengths = np.zeros(len(files), dtype=np.int64)
+    min_value, max_value, num_actions = 0, 0, None
+    for i, fname in enumerate(tqdm(files, desc='indexing trajectories')):
+        X = torch.load(fname)
+        if num_actions is None:
+            num_actions = X.size()[1]
+        elif X.size()[1] != num_actions:
+            raise ValueError(f'{fname} has {X.size()[1]} actions, expected {num_actions}')
+        lengths[i] = X.size()[0]
+        if X.numel() > 0:
+            min_value = min(min_value, int(X.min()))
+            max_value = max(max_value, int(X.max()))
+
+    offsets = np.zeros(len(files) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+
+    with atomic_path(os.path.join(out_path, PACKED_VALUES)) as tmp_fname:
+        values = np.lib.format.open_memmap(
+            tmp_fname,
+            mode='w+',
+            dtype=_compact_dtype(min_value, max_value),
+            shape=(int(offsets[-1]), num_actions)
+        )
+        for i, fname in enumerate(tqdm(files, desc='packing trajectories')):
+            values[offsets[i]:offsets[i + 1]] = torch.load(fname).numpy()
+        values.flush()
+        del values
+
+    _write_packed_index(out_path, [_user_from_file(f) for f in files], offsets)
@@ -0,0 +1,132 @@
+import gzip
+import json
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+
+def write_so_dataset(data_path, num_users=60, seed=0):
+    '''A small ``pt_*`` dataset: user_<id>.pt trajectories (days x 7 actions) with badge_achievements.json and
+    data_indexes.json'''
+    rng = np.random.RandomState(seed)
+    user_ids = list(range(100, 100 + num_users))
+    badges = {}
+    for user in user_ids:
+        length = rng.randint(150, 300)
+        X = (rng.poisson(0.8, size=(length, 7)) * (rng.rand(length, 7) < 0.4)).astype(np.int64)
+        torch.save(torch.tensor(X), f'{data_path}/user_{user}.pt')
+        achieved = {}
+        if rng.rand() < 0.8:
+            achieved['Electorate'] = sorted(rng.choice(length, size=rng.randint(1, 3), replace=False).tolist())
+        if rng.rand() < 0.3:
+            achieved['CivicDuty'] = [int(rng.randint(length))]
+        if rng.rand() < 0.3:
+            achieved['Steward'] = [int(rng.randint(length))]
+        badges[str(user)] = achieved
+    with open(f'{data_path}/badge_achievements.json', 'w') as f:
+        json.dump(badges, f)
+    split = {'train': user_ids[:36], 'validate': user_ids[36:48], 'test': user_ids[48:]}
+    with open(f'{data_path}/data_indexes.json', 'w') as f:
+        json.dump(split, f)
+    return user_ids
+
+
+@pytest.fixture
+def so_data_path(tmp_path):
+    write_so_dataset(tmp_path)
+    return str(tmp_path)
+
+
+def write_reputation_dump(raw_dir, seed=5):
+    '''A small Users/Posts/Reps json dump in the format of data_utils.xml_to_json'''
+    rng = np.random.RandomState(seed)
+    start = datetime.datetime(2012, 6, 1)
+
+    def timestamp(days):
+        t = start + datetime.timedelta(seconds=int(days * 86400))
+        return t.strftime('%Y-%m-%dT%H:%M:%S.') + '%03d' % rng.randint(1000)
+
+    def write(name, rows):
+        with gzip.open(f'{raw_dir}/{name}.json.gz', 'wt') as f:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+
+    user_ids = [-1] + list(range(1, 80))
+    write('Users', [
+        {'Id': u, 'Reputation': int(rng.randint(1, 1000)), 'CreationDate': timestamp(rng.uniform(0, 200)),
+         'LastAccessDate': timestamp(rng.uniform(400, 800))}
+        for u in user_ids
+    ])
+    write('Posts', [
+        {'Id': i, 'PostTypeId': int(rng.choice([1, 2])), 'OwnerUserId': int(rng.choice(user_ids)),
+         'CreationDate': timestamp(rng.uniform(200, 900))}
+        for i in range(4000)
+    ])
+    reps = []
+    for i in range(8000):
+        rep = {'UserId': int(rng.choice(user_ids)), 'PostTypeId': int(rng.choice([1, 2])),
+               'Delta': int(rng.choice([10, 5, -2, 2, 15])), 'Text': str(rng.choice(['upvote', 'accept', 'edit'])),
+               'Time': timestamp(rng.uniform(200, 900))}
+        # reputation rows without a post type or a delta occur in the dumps
+        if rng.rand() < 0.03:
+            del rep['PostTypeId']
+        if rng.rand() < 0.03:
+            del rep['Delta']
+        reps.append(rep)
+    write('Reps', reps)
+
+
+@pytest.fixture
+def reputation_dump(tmp_path):
+    raw_dir = tmp_path / 'raw'
+    raw_dir.mkdir()
+    write_reputation_dump(raw_dir)
+    return str(raw_dir)
+
+
+@pytest.fixture
+def reputation_frames(reputation_dump, tmp_path):
+    '''posts_df and reputation_df of the dump, as written by convert_so_data_to_pandas'''
+    from reputation_study.convert_so_data_to_pandas import compute_pandas_dataframes_local, write_frame
+
+    frames_dir = tmp_path / 'frames'
+    frames_dir.mkdir()
+    _, posts_df, reps_df = compute_pandas_dataframes_local(reputation_dump, 50, 500000, num_workers=2)
+    write_frame(posts_df, frames_dir, "posts_df", "pickle")
+    write_frame(reps_df, frames_dir, "reputation_df", "pickle")
+    return str(frames_dir)
+
+
+def write_reputation_frames(path, num_users=250, seed=3):
+    '''posts_df and reputation_df pickles with the columns convert_so_data_to_pandas writes, weekly TimeIds'''
+    rng = np.random.RandomState(seed)
+    posts, reps = [], []
+    for user in range(1, num_users + 1):
+        start = rng.randint(0, 120)
+        weeks = np.sort(rng.choice(np.arange(start, 260), size=rng.randint(5, 60), replace=False))
+        rate = rng.uniform(2, 40)
+        for week in weeks:
+            for post_type in (1, 2):
+                # some users never post one of the types
+                if rng.rand() < 0.5 and user % 17 != post_type:
+                    posts.append((user, week, post_type, rng.randint(1, 5)))
+            reps.append((user, week, float(rng.choice([1, 2])), 'vote', rng.randint(1, 6), float(rng.poisson(rate))))
+            if rng.rand() < 0.3:
+                reps.append((user, week, 1.0, 'edit', rng.randint(1, 4), 2.0))
+            if rng.rand() < 0.05:
+                reps.append((user, week, np.nan, 'bounty', 1, np.nan))
+    posts = pd.DataFrame(posts, columns=['UserId', 'PostTimeId', 'PostTypeId', 'Count'])
+    reps = pd.DataFrame(reps, columns=['UserId', 'RepTimeId', 'PostTypeId', 'RepText', 'Count', 'Sum'])
+    posts.to_pickle(f'{path}/posts_df.pkl.gz', compression='gzip')
+    reps.to_pickle(f'{path}/reputation_df.pkl.gz', compression='gzip')
+
+
+@pytest.fixture
+def reputation_pickles(tmp_path):
+    path = tmp_path / 'pickles'
+    path.mkdir()
+    write_reputation_frames(path)
+    return str(path)
@@ -0,0 +1,66 @@
+import os
+import json
+
+import numpy as np
+
+from so_study.badge_index import BADGE_INDEX, load_badge_index
+from so_study.load_so_data import StackOverflowDataset
+
+
+def feasible_badges_from_json(data_path, dset_type, badge_focus, badges_to_avoid, badges_to_ensure):
+    '''The users (and their badge days) the dataset used to select from the json files'''
+    with open(f'{data_path}/badge_achievements.json') as f:
+        badge_ids = json.load(f)
+    with open(f'{data_path}/data_indexes.json') as f:
+        list_IDs = json.load(f)
+
+    feasible = {}
+    for user in list_IDs[dset_type]:
+        user = str(user)
+        if badge_focus not in badge_ids[user]:
+            continue
+        if any(badge in badge_ids[user] for badge in badges_to_avoid):
+            continue
+        if len(badges_to_ensure) > 0 and not any(badge in badge_ids[user] for badge in badges_to_ensure):
+            continue
+        feasible[user] = badge_ids[user][badge_focus]
+    return feasible
+
+
+def test_selection_matches_json(so_data_path):
+    settings = [
+        ('train', 'Electorate', [], []),
+        ('validate', 'Electorate', ['CivicDuty'], []),
+        ('train', 'Electorate', [], ['CivicDuty', 'Steward']),
+        ('train', 'Steward', ['CivicDuty'], ['Electorate']),
+    ]
+    for dset_type, badge_focus, badges_to_avoid, badges_to_ensure in settings:
+        expected = feasible_badges_from_json(so_data_path, dset_type, badge_focus, badges_to_avoid, badges_to_ensure)
+        dataset = StackOverflowDataset(data_path=so_data_path, dset_type=dset_type, badge_focus=badge_focus,
+                                       badges_to_avoid=badges_to_avoid, badges_to_ensure=badges_to_ensure)
+        assert len(expected) > 0
+        assert set(dataset.badge_ids) == set(expected)
+        assert sorted(dataset.list_IDs) == sorted(expected)
+        for user, day in dataset.badge_ids.items():
+            assert day in expected[user]
+
+
+def test_index_is_rebuilt_from_newer_json(so_data_path):
+    index = load_badge_index(so_data_path)
+    fname = os.path.join(so_data_path, BADGE_INDEX)
+    assert os.path.exists(fname)
+    assert [f for f in os.listdir(so_data_path) if f.endswith('.tmp')] == []
+
+    loaded = load_badge_index(so_data_path)
+    np.testing.assert_array_equal(loaded.has_badge, index.has_badge)
+    np.testing.assert_array_equal(loaded.days, index.days)
+
+    with open(f'{so_data_path}/data_indexes.json') as f:
+        split = json.load(f)
+    split['train'], split['test'] = split['test'], split['train']
+    with open(f'{so_data_path}/data_indexes.json', 'w') as f:
+        json.dump(split, f)
+    os.utime(f'{so_data_path}/data_indexes.json', (os.path.getmtime(fname) + 1,) * 2)
+
+    rebuilt = load_badge_index(so_data_path)
+    assert [str(u) for u in split['train']] == list(rebuilt.user_ids[rebuilt.rows('train')])
@@ -0,0 +1,45 @@
+import os
+
+import numpy as np
+import torch
+
+from reputation_study.data_loader import ReputationDataset, ReputationDatasetAllActions, ElectorateDatasetAllActions
+from reputation_study.data_preprosessor import dump_activity_dataset
+
+
+def write_activity_dataset(out_data_path, num_users=40, seed=3):
+    rng = np.random.RandomState(seed)
+    user_ids = np.arange(1000, 1000 + num_users)
+    activity_data = rng.poisson(2, size=(num_users, 4, 25))
+    dump_activity_dataset(user_ids, activity_data, out_data_path, split='random')
+
+
+def assert_same_items(a, b):
+    assert len(a) == len(b) > 0
+    for i in range(len(a)):
+        for x, y in zip(a[i], b[i]):
+            assert x.dtype == y.dtype == torch.int64
+            np.testing.assert_array_equal(x.numpy(), y.numpy())
+
+
+def test_dense_splits_match_pt_files(tmp_path):
+    write_activity_dataset(str(tmp_path))
+    for dataset_class in [ReputationDataset, ReputationDatasetAllActions, ElectorateDatasetAllActions]:
+        for dset_type in ['train', 'validate', 'all']:
+            assert_same_items(dataset_class(data_path=str(tmp_path), dset_type=dset_type, backend='dense'),
+                              dataset_class(data_path=str(tmp_path), dset_type=dset_type, backend='pt'))
+
+
+def test_dense_rows_are_not_copied(tmp_path):
+    write_activity_dataset(str(tmp_path))
+    dataset = ReputationDataset(data_path=str(tmp_path), backend='dense')
+    activity = dataset.activity[3]
+    assert np.shares_memory(activity.numpy(), dataset.activity._arrays[0])
+
+
+def test_int32_arrays_of_older_directories(tmp_path):
+    write_activity_dataset(str(tmp_path))
+    fname = os.path.join(str(tmp_path), 'train_activity.npy')
+    np.save(fname, np.load(fname).astype(np.int32))
+    assert_same_items(ReputationDataset(data_path=str(tmp_path), backend='dense'),
+                      ReputationDataset(data_path=str(tmp_path), backend='pt'))
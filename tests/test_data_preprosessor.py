@@ -0,0 +1,411 @@
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+
+from reputation_study.data_preprosessor import (
+    load_data, add_edits, rename_post_time, drop_unwanted_users, load_and_transform_data
+)
+
+
+def get_activity_helper(posts_df, user_id):
+    try:
+        result = posts_df.loc[user_id]
+    except:
+        result = pd.Series(data=np.zeros(posts_df.shape[1]).astype(int), index=posts_df.columns)
+    return result
+
+
+def pivot_dfs(posts_df, reps_df, target_reputation=2000):
+    '''preprocess_dfs as it pivoted the events into dense UserId x TimeId frames'''
+    p_dfs = []
+    for post_type in [1, 2, 3]:
+        p_dfs.append(posts_df[posts_df.PostTypeId == post_type]
+                     .groupby(['UserId', f'TimeId']).Count.sum().reset_index()
+                     .pivot(index='UserId', columns=f'TimeId', values='Count')
+                     .fillna(0))
+
+    r_df1 = reps_df.groupby(["UserId", f"TimeId"]) \
+        .Sum.sum() \
+        .groupby("UserId") \
+        .cumsum() \
+        .reset_index()
+
+    r_df = r_df1 \
+        .loc[(r_df1.Sum >= target_reputation)] \
+        .groupby('UserId').head(1)
+
+    r_df2 = r_df1.pivot(index='UserId', columns=f'TimeId', values='Sum').ffill(axis=1).bfill(axis=1)
+
+    min_col = r_df2.columns.min()
+    max_col = r_df2.columns.max()
+    col_names = list(range(min_col, max_col + 1))
+
+    for col in range(min_col, max_col + 1):
+        for p_df in p_dfs:
+            if col not in p_df.columns:
+                p_df[col] = 0
+
+        if col not in r_df2.columns:
+            r_df2[col] = r_df2[col - 1]
+
+    p_dfs = [p_df[col_names] for p_df in p_dfs]
+    return p_dfs, r_df2, r_df
+
+
+def pivoted_reputation_data(in_data_path, target_reputation):
+    posts_df, reps_df = load_data(in_data_path)
+    posts_df = add_edits(posts_df, reps_df)
+    posts_df, reps_df = rename_post_time(posts_df, reps_df)
+    posts_df, reps_df = drop_unwanted_users(posts_df, reps_df, target_reputation=target_reputation)
+    p_dfs, r_df2, r_df = pivot_dfs(posts_df, reps_df, target_reputation=target_reputation)
+    min_col = r_df2.columns.min()
+    max_col = r_df2.columns.max()
+    col_names = list(range(min_col, max_col + 1))
+    joined = r_df.merge(r_df2, how="inner", on="UserId", suffixes=(None, None))
+    return p_dfs, joined, min_col, max_col, col_names
+
+
+def windows_per_user(in_data_path, ta, target_reputation, reputation_range):
+    '''load_and_transform_data as it looped over the rows of the pivoted frames'''
+    p_dfs, joined, min_col, max_col, col_names = pivoted_reputation_data(in_data_path, target_reputation)
+
+    user_ids, activities = [], []
+    for user, row in joined.iterrows():
+        week_of_crossing = int(row[f'TimeId'])
+
+        if week_of_crossing-ta-min_col <= 0:
+            continue
+        if week_of_crossing+ta >= max_col - 1:
+            continue
+
+        user_id = int(row['UserId'])
+        my_reputation = row[col_names]
+
+        if my_reputation.loc[week_of_crossing + ta+1] > reputation_range[1]:
+            continue
+        if my_reputation.loc[week_of_crossing - ta - 1] < reputation_range[0]:
+            continue
+
+        my_activity = {
+            "questions": get_activity_helper(p_dfs[0], user_id).loc[week_of_crossing-ta:week_of_crossing+ta].values.astype(int),
+            "answers": get_activity_helper(p_dfs[1], user_id).loc[week_of_crossing - ta:week_of_crossing + ta].values.astype(int),
+            "edits": get_activity_helper(p_dfs[2], user_id).loc[week_of_crossing - ta:week_of_crossing + ta].values.astype(int),
+            "reputation": my_reputation.loc[week_of_crossing-ta:week_of_crossing+ta].values.astype(int)
+        }
+        user_ids.append(user_id)
+        activities.append(pd.DataFrame(my_activity).values.astype(int).T)
+
+    return np.array(user_ids), np.array(activities)
+
+
+def test_windows_match_the_pivoted_loop(reputation_pickles, tmp_path):
+    for ta, target_reputation, reputation_range in [(10, 500, [250, 1000]), (5, 300, [100, 800]), (3, 50, [0, 400])]:
+        expected_ids, expected = windows_per_user(reputation_pickles, ta, target_reputation, reputation_range)
+        out_data_path = str(tmp_path / f'out_{ta}')
+        os.makedirs(out_data_path)
+        user_ids, activities = load_and_transform_data(reputation_pickles, out_data_path, ta, target_reputation,
+                                                       reputation_range)
+        assert len(expected_ids) > 0
+        order = np.argsort(expected_ids)
+        np.testing.assert_array_equal(user_ids, expected_ids[order])
+        np.testing.assert_array_equal(activities, expected[order])
+        for user_id, activity in zip(user_ids, activities):
+            np.testing.assert_array_equal(torch.load(os.path.join(out_data_path, f'user_{user_id}.pt')).numpy(),
+                                          activity)
+
+
+def test_user_events_match_the_pivots():
+    from reputation_study.data_preprosessor import UserEvents
+
+    rng = np.random.RandomState(1)
+    df = pd.DataFrame({'UserId': rng.randint(0, 50, 800) * 3, 'TimeId': rng.randint(5, 90, 800),
+                       'Sum': rng.randint(-20, 40, 800)})
+    events = UserEvents.from_frame(df, 'Sum')
+    cumulative = events.cumulative()
+
+    running = df.groupby(['UserId', 'TimeId']).Sum.sum().groupby('UserId').cumsum().reset_index()
+    filled = running.pivot(index='UserId', columns='TimeId', values='Sum').reindex(columns=range(5, 90))
+    filled = filled.ffill(axis=1).bfill(axis=1)
+    users = filled.index.values
+    np.testing.assert_array_equal(cumulative.latest(cumulative.rows(users)[:, None], np.arange(5, 90)[None]),
+                                  filled.values)
+
+    # users without events and times outside of the events are zero
+    counts = df.groupby(['UserId', 'TimeId']).Sum.sum().unstack(fill_value=0).reindex(columns=range(100), fill_value=0)
+    queried = np.array([0, 1, 3, 300] + list(users))
+    np.testing.assert_array_equal(events.at(events.rows(queried)[:, None], np.arange(100)[None]),
+                                  counts.reindex(index=queried, fill_value=0).values)
+
+    expected = running[running.Sum >= 100].groupby('UserId').head(1).reset_index(drop=True)
+    np.testing.assert_array_equal(cumulative.first_reaching(100).values, expected.values)
+    np.testing.assert_array_equal(cumulative.last(), running.groupby('UserId').Sum.last().values)
+
+
+def test_preprocessed_events_match_the_pivoted_frames(reputation_pickles):
+    from reputation_study.data_preprosessor import load_reputation_events
+
+    p_events, r_events, r_df = load_reputation_events(reputation_pickles, 500)
+    p_dfs, joined, min_col, max_col, col_names = pivoted_reputation_data(reputation_pickles, 500)
+
+    np.testing.assert_array_equal(r_df.values, joined[['UserId', 'TimeId', 'Sum']].values)
+    times = np.array(col_names)
+    for p, p_df in zip(p_events, p_dfs):
+        users = p_df.index.values
+        np.testing.assert_array_equal(p.at(p.rows(users)[:, None], times[None]), p_df.values)
+    users = joined.UserId.values
+    np.testing.assert_array_equal(r_events.latest(r_events.rows(users)[:, None], times[None]),
+                                  joined[col_names].values)
+
+
+def reputation_bins_per_user(in_data_path, ta):
+    '''load_and_transform_by_reputation as it binned every user's window with pandas'''
+    target_reputation = 2000
+    reputation_range = 500, 3000
+    p_dfs, joined, min_col, max_col, col_names = pivoted_reputation_data(in_data_path, target_reputation)
+
+    base = pd.DataFrame({"reputation": np.arange(reputation_range[0], reputation_range[1])})
+
+    user_ids, activities = [], []
+    for user, row in joined.iterrows():
+        date_of_crossing = int(row[f'TimeId'])
+        if date_of_crossing-ta-min_col <= 0:
+            continue
+        if date_of_crossing+ta >= max_col - 1:
+            continue
+
+        user_id = int(row['UserId'])
+        my_reputation = row[col_names]
+
+        if my_reputation.loc[date_of_crossing + ta + 1] > reputation_range[1]:
+            continue
+        if my_reputation.loc[date_of_crossing + ta + 1] < target_reputation + 5:
+            continue
+
+        my_activity = {
+            "questions": get_activity_helper(p_dfs[0], user_id).loc[date_of_crossing - ta:date_of_crossing + ta].values.astype(int),
+            "answers": get_activity_helper(p_dfs[1], user_id).loc[date_of_crossing - ta:date_of_crossing + ta].values.astype(int),
+            "edits": get_activity_helper(p_dfs[2], user_id).loc[date_of_crossing - ta:date_of_crossing + ta].values.astype(int),
+            "reputation": my_reputation.loc[date_of_crossing - ta:date_of_crossing + ta].values.astype(int),
+        }
+        data = pd.DataFrame(my_activity).groupby("reputation").sum().reset_index().merge(base, on="reputation", how="right").fillna(0)
+        data = data[(data.reputation >= reputation_range[0]) & (data.reputation < reputation_range[1])]
+        data = data.groupby(data.reputation // 10).agg("sum")[["questions", "answers", "edits"]].reset_index()
+
+        user_ids.append(user_id)
+        activities.append(data.values.astype(int).T)
+
+    return np.array(user_ids), np.array(activities)
+
+
+def test_reputation_bins_match_the_pandas_binning(reputation_pickles, tmp_path):
+    from reputation_study.data_preprosessor import load_and_transform_by_reputation
+
+    for ta in [3, 8]:
+        expected_ids, expected = reputation_bins_per_user(reputation_pickles, ta)
+        assert len(expected_ids) > 0
+        out_data_path = str(tmp_path / f'out_{ta}')
+        os.makedirs(out_data_path)
+        user_ids = load_and_transform_by_reputation(reputation_pickles, out_data_path, ta)
+        np.testing.assert_array_equal(np.sort(user_ids), np.sort(expected_ids))
+        for user_id, activity in zip(expected_ids, expected):
+            np.testing.assert_array_equal(torch.load(os.path.join(out_data_path, f'user_{user_id}.pt')).numpy(),
+                                          activity)
+
+
+BADGE_ACTIONS = ['Answers', 'Questions', 'Comments', 'Edits', 'AnswerVotes', 'QuestionVotes', 'ReviewTasks']
+
+
+def write_badge_activity(path, num_users=80, seed=1):
+    '''so_badges.csv.gz: a row per user and day with the action counts, the badge columns are set on a win'''
+    rng = np.random.RandomState(seed)
+    days = pd.date_range('2017-01-01', periods=200, freq='D')
+    frames = []
+    for user in range(1, num_users + 1):
+        df = pd.DataFrame({'DummyUserId': user, 'Date': days.strftime('%Y-%m-%d %H:%M:%S')})
+        for action in BADGE_ACTIONS:
+            df[action] = rng.poisson(0.7, len(days))
+        for badge in ['Electorate', 'CivicDuty', 'CopyEditor', 'StrunkWhite']:
+            df[badge] = np.nan
+            if rng.rand() < 0.5:
+                df.loc[rng.choice(len(days), size=rng.randint(1, 3), replace=False), badge] = 1
+        frames.append(df)
+    pd.concat(frames).to_csv(f'{path}/so_badges.csv.gz', index=False, compression='gzip')
+
+
+def badge_windows_per_user(in_data_path, threshold_achievement, badge, not_badge=""):
+    '''load_and_transform_electorate_data as it loaded the whole csv and looped over the winners'''
+    activity_df = pd.read_csv(os.path.join(in_data_path, "so_badges.csv.gz"), compression="gzip")
+
+    activity_df.Date = pd.to_datetime(activity_df.Date)
+    activity_df['time_ix'] = (activity_df.Date - pd.Timestamp(year=2017, month=1, day=1)).dt.days
+
+    badge_wins = activity_df.dropna(subset=[badge]).groupby('DummyUserId')['time_ix'].first().reset_index()
+    if not_badge != "":
+        not_badge = activity_df.dropna(subset=[not_badge]).groupby('DummyUserId')['time_ix'].first().reset_index()
+        badge_wins = badge_wins[~badge_wins.DummyUserId.isin(not_badge.DummyUserId)]
+
+    badge_wins.rename(columns={'time_ix': 'badge_win_date'}, inplace=True)
+
+    df = pd.merge(activity_df[['DummyUserId', 'time_ix'] + BADGE_ACTIONS],
+                  badge_wins[['DummyUserId', "badge_win_date"]], on='DummyUserId')
+
+    user_ids = []
+    activities = []
+
+    max_time = df.time_ix.max()
+
+    for user_id, user_actions in df.groupby("DummyUserId"):
+        badge_win_date = user_actions.badge_win_date.min()
+        if badge_win_date - threshold_achievement < 0:
+            continue
+        if max_time - badge_win_date - (threshold_achievement + 1) < 0:
+            continue
+
+        user_acts = user_actions.set_index("time_ix").loc[badge_win_date-threshold_achievement:badge_win_date+threshold_achievement]
+
+        activities.append(user_acts[BADGE_ACTIONS].values.astype(int).T)
+        user_ids.append(int(user_id))
+
+    return np.array(user_ids), np.stack(activities)
+
+
+def test_badge_windows_match_the_loop_over_winners(tmp_path):
+    from reputation_study.data_preprosessor import load_and_transform_badge_data
+
+    write_badge_activity(str(tmp_path))
+    badges = {'Electorate': ['Electorate', ''], 'CivicDuty': ['CivicDuty', 'Electorate'],
+              'StrunkWhite': ['StrunkWhite', 'CopyEditor']}
+    for threshold_achievement in [10, 30]:
+        # chunks smaller than a user's rows, so windows are filled from several chunks
+        datasets, _ = load_and_transform_badge_data(str(tmp_path), threshold_achievement, badges, chunksize=150)
+        for name, (badge, not_badge) in badges.items():
+            expected_ids, expected = badge_windows_per_user(str(tmp_path), threshold_achievement, badge, not_badge)
+            user_ids, activities = datasets[name]
+            assert len(expected_ids) > 0
+            np.testing.assert_array_equal(user_ids, expected_ids)
+            np.testing.assert_array_equal(activities, expected)
+
+
+def test_create_datasets_writes_every_badge_dataset(tmp_path):
+    import json
+    from reputation_study.data_preprosessor import create_datasets, params, split_user_ids
+
+    write_badge_activity(str(tmp_path))
+    create_datasets(str(tmp_path), threshold_achievement=20)
+    for type, (badge, not_badge) in params.items():
+        expected_ids, expected = badge_windows_per_user(str(tmp_path), 20, badge, not_badge)
+        out_data_path = os.path.join(str(tmp_path), f'pt_{type.lower()}')
+        with open(os.path.join(out_data_path, 'data_indexes.json')) as f:
+            assert json.load(f) == split_user_ids(expected_ids)
+        for user_id, activity in zip(expected_ids, expected):
+            np.testing.assert_array_equal(torch.load(os.path.join(out_data_path, f'user_{user_id}.pt')).numpy(),
+                                          activity)
+
+
+def test_reputation_datasets_of_several_targets(reputation_pickles, tmp_path):
+    import json
+    from reputation_study.data_preprosessor import create_reputation_dataset, split_user_ids
+
+    targets, lower, upper = [300, 500], [100, 250], [800, 1000]
+    create_reputation_dataset(reputation_pickles, str(tmp_path / '{target_reputation}' / 'reputation_data'),
+                              threshold_achievement=5, target_reputation=targets, reputation_range_l=lower,
+                              reputation_range_u=upper, num_workers=2)
+    for target, low, high in zip(targets, lower, upper):
+        expected_ids, expected = windows_per_user(reputation_pickles, 5, target, [low, high])
+        assert len(expected_ids) > 0
+        order = np.argsort(expected_ids)
+        out_data_path = str(tmp_path / str(target) / 'reputation_data')
+        with open(os.path.join(out_data_path, 'data_indexes.json')) as f:
+            assert json.load(f) == split_user_ids(expected_ids[order])
+        for user_id, activity in zip(expected_ids, expected):
+            np.testing.assert_array_equal(torch.load(os.path.join(out_data_path, f'user_{user_id}.pt')).numpy(),
+                                          activity)
+
+
+def test_rebuild_only_writes_changed_users(tmp_path):
+    import json
+    from reputation_study.data_preprosessor import MANIFEST, dump_activity_dataset, activity_hash
+
+    rng = np.random.RandomState(4)
+    user_ids = np.arange(100, 160, dtype=np.int64)
+    activity_data = rng.poisson(1.0, size=(len(user_ids), 4, 9)).astype(np.int64)
+    out_data_path = str(tmp_path / 'data')
+    dump_activity_dataset(user_ids, activity_data, out_data_path, last_time_id=40, split='hash')
+    with open(os.path.join(out_data_path, 'data_indexes.json')) as f:
+        splits = json.load(f)
+
+    # the next dump: one user has new events, one has left and one is new
+    activity_data[3, 0, -1] += 1
+    user_ids, activity_data = np.append(user_ids[1:], 200), np.concatenate([activity_data[1:], activity_data[:1]])
+    mtimes = {u: os.path.getmtime(os.path.join(out_data_path, f'user_{u}.pt')) - 100 for u in user_ids[:-1]}
+    for u, mtime in mtimes.items():
+        os.utime(os.path.join(out_data_path, f'user_{u}.pt'), (mtime, mtime))
+    dump_activity_dataset(user_ids, activity_data, out_data_path, last_time_id=45, split='hash')
+
+    written = {u for u, mtime in mtimes.items()
+               if os.path.getmtime(os.path.join(out_data_path, f'user_{u}.pt')) != mtime}
+    assert written == {103}
+    assert not os.path.exists(os.path.join(out_data_path, 'user_100.pt'))
+    for user_id, activity in zip(user_ids, activity_data):
+        np.testing.assert_array_equal(torch.load(os.path.join(out_data_path, f'user_{user_id}.pt')).numpy(),
+                                      activity)
+
+    with open(os.path.join(out_data_path, MANIFEST)) as f:
+        manifest = json.load(f)
+    assert manifest == {'last_time_id': 45,
+                        'users': {str(u): activity_hash(a) for u, a in zip(user_ids, activity_data)}}
+    assert [f for f in os.listdir(out_data_path) if f.endswith('.tmp')] == []
+
+    # the users that were there before keep their split
+    with open(os.path.join(out_data_path, 'data_indexes.json')) as f:
+        rebuilt = json.load(f)
+    for split, split_ids in splits.items():
+        assert set(split_ids) - {100} <= set(rebuilt[split])
+    for split, split_ids in rebuilt.items():
+        np.testing.assert_array_equal(np.load(os.path.join(out_data_path, f'{split}_user_ids.npy')), split_ids)
+        rows = [list(user_ids).index(u) for u in split_ids]
+        np.testing.assert_array_equal(np.load(os.path.join(out_data_path, f'{split}_activity.npy')),
+                                      activity_data[rows])
+
+
+def load_pickles(in_data_path):
+    '''load_data as it read the gzip pickles and cast every column'''
+    posts_df = pd.read_pickle(os.path.join(in_data_path, "posts_df.pkl.gz"), compression="gzip")
+    reps_df = pd.read_pickle(os.path.join(in_data_path, "reputation_df.pkl.gz"), compression="gzip")
+    for col in posts_df.columns:
+        posts_df[col] = posts_df[col].astype(int)
+    for col in ['UserId', 'RepTimeId', 'Count', 'Sum']:
+        if col == 'Sum':
+            reps_df.Sum.fillna(0, inplace=True)
+        reps_df[col] = reps_df[col].astype(int)
+    return posts_df, reps_df
+
+
+def test_parquet_frames_load_like_the_pickles(reputation_pickles, tmp_path):
+    from reputation_study.convert_so_data_to_pandas import write_frame
+
+    posts_df = pd.read_pickle(os.path.join(reputation_pickles, "posts_df.pkl.gz"), compression="gzip")
+    reps_df = pd.read_pickle(os.path.join(reputation_pickles, "reputation_df.pkl.gz"), compression="gzip")
+    # values outside the compact types: daily time ids past int16 and reputation sums past int32
+    wide = tmp_path / 'wide'
+    wide.mkdir()
+    posts_wide, reps_wide = posts_df.copy(), reps_df.copy()
+    posts_wide.loc[0, 'PostTimeId'] = 40000
+    reps_wide.loc[0, 'RepTimeId'] = 40000
+    reps_wide.loc[reps_wide.Sum.notna().idxmax(), 'Sum'] = 3e9
+    posts_wide.to_pickle(wide / 'posts_df.pkl.gz', compression='gzip')
+    reps_wide.to_pickle(wide / 'reputation_df.pkl.gz', compression='gzip')
+
+    for pickles, frames in [(reputation_pickles, (posts_df, reps_df)), (str(wide), (posts_wide, reps_wide))]:
+        out = tmp_path / f'parquet_{os.path.basename(pickles)}'
+        out.mkdir()
+        write_frame(frames[0], out, "posts_df")
+        write_frame(frames[1], out, "reputation_df")
+        for expected, loaded in zip(load_pickles(pickles), load_data(str(out))):
+            assert list(loaded.columns) == list(expected.columns)
+            for col in expected.columns:
+                # the post type of reputation rows is not cast, its nulls are NaN in the pickles and NA in parquet
+                np.testing.assert_array_equal(loaded[col].astype(expected[col].dtype).to_numpy(),
+                                              expected[col].to_numpy())
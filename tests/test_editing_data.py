@@ -0,0 +1,191 @@
+import json
+
+import numpy as np
+import pandas as pd
+import torch
+
+from so_study.load_so_data import transform_editing_data_to_file_folder_structure
+from so_study.trajectory_store import TRAJECTORY_BACKENDS
+
+
+def write_editing_exports(path, seed=3):
+    rng = np.random.RandomState(seed)
+    # the exports start before the first day of the trajectories
+    dates = pd.date_range('2008-12-20', periods=400, freq='D')
+    users = np.arange(1000, 1060)
+    counts = rng.poisson(0.3, size=(len(users), len(dates))) * (rng.rand(len(users), len(dates)) < 0.2)
+    actions = pd.DataFrame(counts.astype(float), columns=[str(d.date()) for d in dates])
+    actions.insert(0, 'UserId', users)
+    actions.to_csv(f'{path}/actions.csv', index=False)
+    # users without a badge and a badge of a user without actions are left out
+    badge_users = np.concatenate([users[5:], [5000]])
+    days = rng.randint(20, 300, len(badge_users))
+    pd.DataFrame({'UserId': badge_users, 'Date': [str(dates[d]) for d in days]}).to_csv(f'{path}/badges.csv',
+                                                                                        index=False)
+
+
+def editing_trajectories_per_user(path_to_csv_actions, path_to_csv_badges, path_to_data_dir):
+    '''transform_editing_data_to_file_folder_structure as it reindexed every user's row on its own'''
+    data_actions = pd.read_csv(path_to_csv_actions)
+    badge_achievements = pd.read_csv(path_to_csv_badges)
+
+    data_actions = data_actions[data_actions.UserId.isin(badge_achievements.UserId)]
+    badge_achievements = badge_achievements[badge_achievements.UserId.isin(data_actions.UserId)]
+
+    start_date = pd.Timestamp(year=2009, month=1, day=1)
+
+    badge_achievements.Date = pd.to_datetime(badge_achievements.Date)
+    badge_achievements['day'] = (badge_achievements.Date - start_date).dt.days
+
+    user_ids = badge_achievements.UserId.unique()
+    size_data = len(user_ids)
+
+    np.random.seed(11)
+
+    train = np.random.choice(user_ids, size=int(np.floor(0.6 * size_data)), replace=False)
+    user_ids = user_ids[~np.in1d(user_ids, train)]
+    validate = np.random.choice(user_ids, size=int(np.floor(0.2 * size_data)), replace=False)
+    user_ids = user_ids[~np.in1d(user_ids, validate)]
+    test = np.random.choice(user_ids, size=int(np.floor(0.2 * size_data)), replace=False)
+
+    data_actions.set_index('UserId', inplace=True)
+    badge_achievements.set_index('UserId', inplace=True)
+
+    num_days = (badge_achievements.Date.max() - start_date).days
+
+    for dset in [train, validate, test]:
+        for user in dset:
+            trajectory = data_actions.loc[user]
+            trajectory = trajectory.reset_index()
+            trajectory['index'] = pd.to_datetime(trajectory['index'])
+            trajectory['day'] = (trajectory['index'] - start_date).dt.days
+            trajectory.rename(columns={'index': 'date', user: 'num_actions'}, inplace=True)
+            trajectory.sort_values('day', inplace=True)
+            trajectory.set_index('day', inplace=True)
+            trajectory = trajectory.reindex(range(num_days+1), fill_value=0)
+
+            action_trajectory = torch.tensor(trajectory[['num_actions']].values, dtype=torch.long)
+            torch.save(action_trajectory, '{}/user_{}.pt'.format(path_to_data_dir, user))
+
+    with open('{}/badge_achievements.json'.format(path_to_data_dir), 'w') as f:
+        badge_dict = badge_achievements['day'].to_dict()
+        badge_dict = {k: {'strunk_white': [int(v)]} for k,v in badge_dict.items()}
+        json.dump(badge_dict, f)
+
+    with open('{}/data_indexes.json'.format(path_to_data_dir), 'w') as f:
+        obj = {}
+        obj['train'] = [int(u) for u in train]
+        obj['test'] = [int(u) for u in test]
+        obj['validate'] = [int(u) for u in validate]
+        json.dump(obj, f)
+
+
+def test_editing_trajectories_match_per_user_reindexing(tmp_path):
+    write_editing_exports(str(tmp_path))
+    actions, badges = str(tmp_path / 'actions.csv'), str(tmp_path / 'badges.csv')
+    reference = tmp_path / 'reference'
+    reference.mkdir()
+    editing_trajectories_per_user(actions, badges, str(reference))
+
+    for output_format in ['pt', 'packed', 'sparse']:
+        out = tmp_path / output_format
+        out.mkdir()
+        transform_editing_data_to_file_folder_structure(actions, badges, str(out), output_format=output_format,
+                                                        num_workers=2)
+        for fname in ['badge_achievements.json', 'data_indexes.json']:
+            with open(reference / fname) as a, open(out / fname) as b:
+                assert json.load(a) == json.load(b)
+
+        with open(reference / 'data_indexes.json') as f:
+            users = [u for split in json.load(f).values() for u in split]
+        assert len(users) == 55
+        store = TRAJECTORY_BACKENDS[output_format](str(out))
+        for user in users:
+            expected = torch.load(reference / f'user_{user}.pt')
+            np.testing.assert_array_equal(store[user].numpy(), expected.numpy())
+
+
+def write_yearly_exports(path, seed=0):
+    rng = np.random.RandomState(seed)
+    dates = pd.date_range('2009-06-01', periods=60).strftime('%Y-%m-%d')
+    actions, badges = [], []
+    # overlapping exports with missing counts, a day in two exports takes the counts of the later one
+    for k, (a, b) in enumerate([(0, 25), (20, 45), (40, 60)]):
+        users = rng.choice(np.arange(1, 80), size=50, replace=False)
+        counts = rng.poisson(0.7, size=(50, b - a)).astype(float)
+        counts[rng.rand(*counts.shape) < 0.05] = np.nan
+        df = pd.DataFrame(counts, columns=dates[a:b])
+        df.insert(0, 'UserId', users)
+        actions.append(f'{path}/actions_{k}.csv')
+        df.to_csv(actions[-1], index=False)
+    for k in range(2):
+        users = rng.choice(np.arange(1, 80), size=40, replace=False)
+        days = pd.to_datetime('2009-06-01') + pd.to_timedelta(rng.randint(0, 4000, 40), unit='D')
+        badges.append(f'{path}/badges_{k}.csv')
+        pd.DataFrame({'UserId': users, 'Date': days.strftime('%Y-%m-%d %H:%M:%S')}).to_csv(badges[-1], index=False)
+    return actions, badges
+
+
+def compile_by_merging(input_actions, input_badges, output_action_f_name, output_badges_f_name):
+    '''compile_smaller_files as it merged the exports one after the other'''
+    df_actions = pd.read_csv(input_actions[0])
+    for file in input_actions[1:]:
+        df_actions_temp = pd.read_csv(file)
+        df_actions = df_actions.merge(df_actions_temp, on='UserId', suffixes=("_x", ""), how='outer')
+
+    df_badges = pd.read_csv(input_badges[0])
+    for file in input_badges[1:]:
+        df_badges_temp = pd.read_csv(file)
+        df_badges = df_badges.merge(df_badges_temp, on='UserId', suffixes=("_x", ""), how='outer')
+
+        df_badges.drop_duplicates(subset="UserId", inplace=True)
+        df_badges.fillna(0, inplace=True)
+
+        df_badges.set_index('UserId', inplace=True)
+        df_badges.loc[df_badges['Date'] == 0, 'Date'] = df_badges.loc[df_badges['Date'] == 0, 'Date_x']
+        df_badges.drop(columns=['Date_x'], inplace=True)
+        df_badges = df_badges[df_badges['Date'] != 0]
+        df_badges.reset_index(inplace=True)
+
+    cols_to_drop = df_actions.columns[df_actions.columns.str.contains("_x")]
+    df_actions.drop(columns=cols_to_drop, inplace=True)
+
+    cols = df_actions.columns[df_actions.columns.str.contains("-")]
+    dates = pd.to_datetime(cols).date
+    df_actions.rename(columns={d: c for d, c in zip(cols, dates)}, inplace=True)
+    df_actions.drop_duplicates(subset="UserId", inplace=True)
+    df_actions.fillna(0, inplace=True)
+
+    df_badges.Date = pd.to_datetime(df_badges.Date)
+    df_badges = df_badges[df_badges.Date > pd.Timestamp(year=2010, month=2, day=1)]
+    df_badges = df_badges[df_badges.Date < pd.Timestamp(year=2020, month=1, day=1)]
+
+    df_actions = df_actions[df_actions.UserId.isin(df_badges.UserId)]
+
+    df_actions.to_csv(output_action_f_name, index=False)
+    df_badges.to_csv(output_badges_f_name, index=False)
+
+
+def test_compiled_exports_match_merging(tmp_path, monkeypatch):
+    from so_study.load_so_data import compile_smaller_files
+
+    actions, badges = write_yearly_exports(str(tmp_path))
+    compile_by_merging(actions, badges, str(tmp_path / 'actions_ref.csv'), str(tmp_path / 'badges_ref.csv'))
+
+    # the outputs are written relative to the working directory
+    out = tmp_path / 'data' / 'raw_data_from_so_query'
+    out.mkdir(parents=True)
+    (tmp_path / 'run').mkdir()
+    monkeypatch.chdir(tmp_path / 'run')
+    compile_smaller_files(actions, badges, num_workers=2)
+
+    expected = pd.read_csv(tmp_path / 'actions_ref.csv').set_index('UserId').sort_index()
+    compiled = pd.read_csv(out / 'actions_over_time.csv').set_index('UserId').sort_index()
+    assert len(expected) > 0
+    assert list(compiled.columns) == list(expected.columns)
+    assert compiled.index.equals(expected.index)
+    np.testing.assert_array_equal(compiled.values, expected.values)
+
+    expected = pd.read_csv(tmp_path / 'badges_ref.csv').set_index('UserId').sort_index()
+    compiled = pd.read_csv(out / 'strunk_and_white_achievements.csv').set_index('UserId').sort_index()
+    pd.testing.assert_frame_equal(compiled, expected)
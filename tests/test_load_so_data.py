@@ -0,0 +1,237 @@
+import os
+import glob
+import json
+
+import numpy as np
+import torch
+
+from so_study.load_so_data import StackOverflowDataset, StackOverflowDatasetIncCounts
+
+
+def assert_items_equal(a, b):
+    assert len(a) == len(b)
+    for x, y in zip(a, b):
+        if torch.is_tensor(x):
+            np.testing.assert_allclose(x.numpy(), y.numpy(), rtol=1e-6)
+        else:
+            assert x == y
+
+
+def test_materialized_items_match_getitem(so_data_path, tmp_path):
+    for dataset_class in [StackOverflowDataset, StackOverflowDatasetIncCounts]:
+        dataset = dataset_class(data_path=so_data_path, window_length=20, subsample=30)
+        items = [dataset[i] for i in range(len(dataset))]
+        dataset.materialize(cache_dir=str(tmp_path / 'windows'))
+        assert len(dataset) > 0
+        for i, item in enumerate(items):
+            assert_items_equal(dataset[i], item)
+
+
+def test_window_cache_adds_chunks_and_follows_the_data(so_data_path, tmp_path):
+    cache_dir = str(tmp_path / 'windows')
+
+    first = StackOverflowDataset(data_path=so_data_path, window_length=20, subsample=10)
+    first.materialize(cache_dir=cache_dir)
+    key = first._window_cache_key()
+    assert len(glob.glob(os.path.join(cache_dir, key, '*.npz'))) == 1
+
+    # a larger sample reuses the cached windows and only adds the windows of the new users
+    second = StackOverflowDataset(data_path=so_data_path, window_length=20, subsample=30)
+    items = [second[i] for i in range(len(second))]
+    second.materialize(cache_dir=cache_dir)
+    assert second._window_cache_key() == key
+    chunks = sorted(glob.glob(os.path.join(cache_dir, key, '*.npz')))
+    assert len(chunks) == 2
+    built = sum(len(np.load(c)['user_ids']) for c in chunks)
+    # windows are cached per user and badge day, users with several badges may be drawn on another day
+    windows = {(ID, d.badge_ids[ID]) for d in [first, second] for ID in d.list_IDs}
+    assert built == len(windows)
+    for i, item in enumerate(items):
+        assert_items_equal(second[i], item)
+
+    # the same users again add nothing
+    second.materialize(cache_dir=cache_dir)
+    assert len(glob.glob(os.path.join(cache_dir, key, '*.npz'))) == 2
+
+    # rewriting the data gives the windows a new key
+    fname = os.path.join(so_data_path, 'data_indexes.json')
+    with open(fname) as f:
+        split = json.load(f)
+    with open(fname, 'w') as f:
+        json.dump(split, f, indent=1)
+    assert StackOverflowDataset(data_path=so_data_path, window_length=20, subsample=10)._window_cache_key() != key
+
+
+def test_window_cache_key_hashes_the_scaler_arrays(so_data_path):
+    dataset = StackOverflowDatasetIncCounts(data_path=so_data_path, window_length=20, subsample=10,
+                                            self_initialise=True)
+    key = dataset._window_cache_key()
+    assert dataset._window_cache_key() == key
+
+    # a change below the precision str() prints an array with still changes the key
+    dataset.scaler_in.scale = dataset.scaler_in.scale.copy()
+    dataset.scaler_in.scale[0] = np.nextafter(dataset.scaler_in.scale[0], np.float32(np.inf))
+    assert dataset._window_cache_key() != key
+
+
+def test_scaler_cache_follows_the_sample_and_the_data(so_data_path, tmp_path, monkeypatch):
+    from so_study import load_so_data
+
+    cache_dir = str(tmp_path / 'scalers')
+    dataset = StackOverflowDatasetIncCounts(data_path=so_data_path, window_length=20, subsample=20)
+    items = [dataset[i] for i in range(len(dataset))]
+    maxes_in = np.max([item[0].numpy() for item in items], axis=(0, 1))
+    maxes_out = np.max([item[2].numpy() for item in items])
+
+    scaler_in, scaler_out = load_so_data.calculate_feature_transformation(dataset, cache_dir=cache_dir)
+    np.testing.assert_array_equal([scaler_in.maxes_in[a] for a in dataset.ACTIONS], maxes_in)
+    assert scaler_out.maxes_in == maxes_out
+    assert len(os.listdir(cache_dir)) == 1
+
+    def refit(*args, **kwargs):
+        raise AssertionError('the scalers should have been read from the cache')
+
+    monkeypatch.setattr(load_so_data, '_feature_maxima', refit)
+    cached_in, cached_out = load_so_data.calculate_feature_transformation(dataset, cache_dir=cache_dir)
+    assert cached_in.maxes_in == scaler_in.maxes_in and cached_out.maxes_in == scaler_out.maxes_in
+
+    key = load_so_data._scaler_cache_key(dataset)
+    other = StackOverflowDatasetIncCounts(data_path=so_data_path, window_length=20, subsample=10)
+    assert load_so_data._scaler_cache_key(other) != key
+
+    with open(os.path.join(so_data_path, 'badge_achievements.json')) as f:
+        badges = json.load(f)
+    with open(os.path.join(so_data_path, 'badge_achievements.json'), 'w') as f:
+        json.dump(badges, f, indent=1)
+    assert load_so_data._scaler_cache_key(dataset) != key
+
+
+def offset_badges_from_json(data_path, dset_type, badge_focus, offset, out_dim):
+    '''The badge days of requires_offset datasets as they were computed from the pt files, one user at a time'''
+    with open(f'{data_path}/badge_achievements.json') as f:
+        badge_ids = json.load(f)
+    with open(f'{data_path}/data_indexes.json') as f:
+        list_IDs = json.load(f)
+
+    feasible, dropped = {}, []
+    for user in map(str, list_IDs[dset_type]):
+        if badge_focus not in badge_ids[user]:
+            continue
+        X = torch.load(os.path.join(data_path, 'user_' + user + '.pt'))[:, out_dim]
+        cum_sum_x = torch.cumsum(X, dim=0)
+        num_actions_on_day = cum_sum_x[badge_ids[user][badge_focus]]
+        if cum_sum_x[-1] < num_actions_on_day + 50:
+            dropped.append(user)
+            continue
+        feasible[user] = int(torch.where(cum_sum_x >= num_actions_on_day + offset)[0][0])
+    return feasible, dropped
+
+
+def test_offset_badge_days_match_pt_files(so_data_path, tmp_path):
+    from so_study.trajectory_store import pack_trajectory_directory, sparsify_trajectory_directory
+
+    # the reference indexes the running count with the list of badge days, which only works for a single day
+    with open(f'{so_data_path}/badge_achievements.json') as f:
+        badges = json.load(f)
+    badges = {u: {b: days[:1] for b, days in achieved.items()} for u, achieved in badges.items()}
+    with open(f'{so_data_path}/badge_achievements.json', 'w') as f:
+        json.dump(badges, f)
+    pack_trajectory_directory(so_data_path)
+    sparsify_trajectory_directory(so_data_path)
+
+    for offset in [0, 3, 20]:
+        expected, dropped = offset_badges_from_json(so_data_path, 'train', 'Electorate', offset, 1)
+        assert len(expected) > 0 and len(dropped) > 0
+        for backend in ['pt', 'packed', 'sparse']:
+            dataset = StackOverflowDataset(data_path=so_data_path, out_dim='Questions', offset=offset,
+                                           requires_offset=True, backend=backend)
+            assert dataset.badge_ids == expected
+            assert sorted(dataset.dropped) == sorted(dropped)
+
+
+def test_batches_match_items(so_data_path):
+    from torch.utils.data import DataLoader
+    from so_study.load_so_data import collate_batch
+    from so_study.trajectory_store import pack_trajectory_directory, sparsify_trajectory_directory
+
+    pack_trajectory_directory(so_data_path)
+    sparsify_trajectory_directory(so_data_path)
+
+    for dataset_class in [StackOverflowDataset, StackOverflowDatasetIncCounts]:
+        reference = dataset_class(data_path=so_data_path, window_length=20, return_user_id=True)
+        items = [reference[i] for i in range(len(reference))]
+        for backend in ['pt', 'packed', 'sparse']:
+            dataset = dataset_class(data_path=so_data_path, window_length=20, return_user_id=True, backend=backend,
+                                    batched=True)
+            dataset.list_IDs, dataset.badge_ids = reference.list_IDs, reference.badge_ids
+            batch = dataset.get_batch(np.arange(len(dataset)))
+            for i, item in enumerate(items):
+                assert_items_equal(tuple(t[i] for t in batch), item)
+
+            loader = DataLoader(dataset, batch_size=7, shuffle=False, collate_fn=collate_batch)
+            unbatched = DataLoader(reference, batch_size=7, shuffle=False)
+            for a, b in zip(loader, unbatched):
+                assert_items_equal(a[:-1], b[:-1])
+                assert list(a[-1]) == list(b[-1])
+
+
+def scale_per_action(x, maxes_in, actions, inverse=False):
+    '''The ScalerIn transform as it was applied, one action at a time'''
+    if len(x.shape) == 2:
+        x = x.reshape(1, -1, len(actions))
+    x = x.copy()
+    for i, a in enumerate(actions):
+        x[:, :, i] = x[:, :, i] * maxes_in[a] if inverse else x[:, :, i] / maxes_in[a]
+    return x
+
+
+def test_scaler_in_matches_per_action_scaling():
+    from so_study.load_so_data import ACTIONS, ScalerIn
+
+    rng = np.random.RandomState(0)
+    maxes_in = {a: float(m) for a, m in zip(ACTIONS, rng.randint(1, 20, size=len(ACTIONS)))}
+    scaler = ScalerIn(maxes_in)
+    for x in [rng.poisson(3, size=(5, 40, 7)).astype(np.float32), rng.poisson(3, size=(40, 7)).astype(np.float32)]:
+        expected = scale_per_action(x, maxes_in, ACTIONS)
+        np.testing.assert_allclose(scaler.transform(x), expected, rtol=1e-6)
+        np.testing.assert_allclose(scaler.transform(torch.from_numpy(x)).numpy(), expected, rtol=1e-6)
+        np.testing.assert_allclose(scaler.inverse_transform(x), scale_per_action(x, maxes_in, ACTIONS, inverse=True))
+
+
+def test_scaling_in_the_collate_fn_matches_scaled_items(so_data_path):
+    from torch.utils.data import DataLoader
+
+    scaled = StackOverflowDatasetIncCounts(data_path=so_data_path, window_length=20, self_initialise=True)
+    dataset = StackOverflowDatasetIncCounts(data_path=so_data_path, window_length=20, scale_in_collate=True,
+                                            scaler_in=scaled.scaler_in, scaler_out=scaled.scaler_out)
+    dataset.list_IDs, dataset.badge_ids = scaled.list_IDs, scaled.badge_ids
+    for a, b in zip(DataLoader(dataset, batch_size=8, collate_fn=dataset.collate_fn()),
+                    DataLoader(scaled, batch_size=8)):
+        assert_items_equal(a, b)
+
+
+def test_in_memory_loader_matches_data_loader(so_data_path):
+    from torch.utils.data import DataLoader
+    from so_study.load_so_data import InMemoryLoader
+
+    dataset = StackOverflowDatasetIncCounts(data_path=so_data_path, window_length=20, return_user_id=True)
+    loader = InMemoryLoader(dataset, batch_size=8, shuffle=False)
+    batches = list(loader)
+    assert len(batches) == len(loader)
+    for a, b in zip(batches, DataLoader(dataset, batch_size=8, shuffle=False)):
+        assert_items_equal(a[:-1], b[:-1])
+        assert list(a[-1]) == list(b[-1])
+
+    # a shuffled epoch serves every item once, with each user's own window
+    items = {dataset[i][-1]: dataset[i] for i in range(len(dataset))}
+    served = []
+    for batch in InMemoryLoader(dataset, batch_size=8, shuffle=True):
+        for i, ID in enumerate(batch[-1]):
+            assert_items_equal(tuple(t[i] for t in batch[:-1]), items[ID][:-1])
+            served.append(ID)
+    assert sorted(served) == sorted(items)
+
+    random_windows = StackOverflowDataset(data_path=so_data_path, window_length=20, centered=False)
+    shapes = [batch[0].shape[1:] for batch in InMemoryLoader(random_windows, batch_size=8)]
+    assert len(shapes) == len(InMemoryLoader(random_windows, batch_size=8))
+    assert set(shapes) == {torch.Size([40, 7])}
@@ -0,0 +1,75 @@
+import os
+import json
+
+import numpy as np
+import torch
+
+from reputation_study.data_preprosessor import create_reputation_dataset
+from reputation_study.pipeline import Pipeline, Stage, reputation_stages, run_reputation_pipeline
+
+
+PARAMS = dict(threshold_achievement=4, target_reputation=100, reputation_range_l=80, reputation_range_u=200)
+
+
+def assert_same_dataset(a, b):
+    with open(os.path.join(a, 'data_indexes.json')) as f:
+        splits = json.load(f)
+    with open(os.path.join(b, 'data_indexes.json')) as f:
+        assert json.load(f) == splits
+    users = [u for s in splits.values() for u in s]
+    assert len(users) > 0
+    for user in users:
+        np.testing.assert_array_equal(torch.load(os.path.join(a, f'user_{user}.pt')).numpy(),
+                                      torch.load(os.path.join(b, f'user_{user}.pt')).numpy())
+    for split in splits:
+        np.testing.assert_array_equal(np.load(os.path.join(a, f'{split}_activity.npy')),
+                                      np.load(os.path.join(b, f'{split}_activity.npy')))
+
+
+def test_pipeline_matches_create_reputation_dataset(reputation_frames, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    create_reputation_dataset(reputation_frames, str(tmp_path / 'direct'), **PARAMS)
+    run_reputation_pipeline(reputation_frames, str(tmp_path / 'pipeline'), cache_dir=cache_dir, **PARAMS)
+    assert_same_dataset(str(tmp_path / 'direct'), str(tmp_path / 'pipeline'))
+
+    cached = sorted(f.split('_')[0] for f in os.listdir(cache_dir))
+    assert cached == ['drop', 'pivot', 'split', 'windows']
+
+    # another window around the same target only recomputes the windows and the split
+    params = dict(PARAMS, threshold_achievement=3)
+    create_reputation_dataset(reputation_frames, str(tmp_path / 'direct_3'), **params)
+    run_reputation_pipeline(reputation_frames, str(tmp_path / 'pipeline_3'), cache_dir=cache_dir, **params)
+    assert_same_dataset(str(tmp_path / 'direct_3'), str(tmp_path / 'pipeline_3'))
+    assert len(os.listdir(cache_dir)) == 6
+
+
+def test_outputs_are_released_after_their_last_consumer(tmp_path):
+    seen = []
+
+    def stage(name, inputs=(), cache=True):
+        def function(*args):
+            # the outputs still held while this stage runs
+            seen.append((name, sorted(os.path.basename(n).split('_')[0] for n in pipeline.outputs)))
+            return name
+        return Stage(name, function, inputs=inputs, cache=cache)
+
+    pipeline = Pipeline([
+        stage('a', cache=False),
+        stage('b', inputs=['a']),
+        stage('c', inputs=['b']),
+        stage('d', inputs=['b', 'c']),
+    ], str(tmp_path))
+    assert pipeline.run(['c', 'd'], {}) == ['c', 'd']
+    assert pipeline.outputs == {}
+    # b is held for d while c runs, the inputs of d are released once they are passed to it
+    assert seen == [('a', []), ('b', []), ('c', ['b']), ('d', [])]
+
+    # b and c come from the cache, a is not needed
+    seen.clear()
+    os.remove(pipeline.artifact('d', {}))
+    assert pipeline.run('d', {}) == 'd'
+    assert seen == [('d', [])]
+
+
+def test_reputation_stages_cache_no_copy_of_the_input():
+    assert [s.name for s in reputation_stages if s.cache] == ['drop_users', 'pivot', 'windows', 'split']
@@ -0,0 +1,167 @@
+import gzip
+import json
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from reputation_study.convert_so_data_to_pandas import compute_pandas_dataframes_local, write_frame
+from reputation_study.data_preprosessor import load_reputation_events, activity_at_threshold
+
+
+# the reputation limits the reputation_frames fixture is built with
+MIN_REP, MAX_REP = 50, 500000
+THRESHOLD_ACHIEVEMENT = 4
+TARGET_REPUTATION = 100
+REPUTATION_RANGE = [80, 200]
+
+
+def write_rows(fname, rows):
+    with gzip.open(fname, 'wt') as f:
+        for row in rows:
+            f.write(json.dumps(row) + '\n')
+
+
+def week(k, hour=0):
+    '''A timestamp in TimeId ``k``: the weeks are counted from 2008-07-27'''
+    t = datetime.datetime(2008, 7, 27) + datetime.timedelta(days=7 * k + 1, hours=hour)
+    return t.strftime('%Y-%m-%dT%H:%M:%S.000')
+
+
+def test_local_backend_window_by_hand(tmp_path):
+    raw_dir, frames_dir = tmp_path / "raw", tmp_path / "frames"
+    raw_dir.mkdir()
+    frames_dir.mkdir()
+
+    users = [
+        {'Id': 1, 'Reputation': 500, 'CreationDate': '2013-01-01T00:00:00.000', 'LastAccessDate': week(300)},
+        # crosses in the first week of the data, too early for a window, but sets its first TimeId
+        {'Id': 2, 'Reputation': 500, 'CreationDate': '2013-01-01T00:00:00.000', 'LastAccessDate': week(300)},
+        # below the minimum reputation
+        {'Id': 3, 'Reputation': 10, 'CreationDate': '2013-01-01T00:00:00.000', 'LastAccessDate': week(300)},
+    ]
+    posts = [
+        {'Id': 10, 'PostTypeId': 1, 'OwnerUserId': 1, 'CreationDate': week(254)},
+        {'Id': 11, 'PostTypeId': 2, 'OwnerUserId': 1, 'CreationDate': week(255)},
+        {'Id': 12, 'PostTypeId': 2, 'OwnerUserId': 1, 'CreationDate': week(255, hour=5)},
+        {'Id': 13, 'PostTypeId': 2, 'OwnerUserId': 1, 'CreationDate': week(258)},
+        {'Id': 14, 'PostTypeId': 1, 'OwnerUserId': 3, 'CreationDate': week(255)},
+    ]
+    reps = [
+        {'UserId': 1, 'PostTypeId': 2, 'Delta': 50, 'Text': 'upvote', 'Time': week(250)},
+        {'UserId': 1, 'PostTypeId': 2, 'Delta': 60, 'Text': 'accept', 'Time': week(255)},
+        {'UserId': 1, 'PostTypeId': 1, 'Delta': 2, 'Text': 'edit', 'Time': week(256)},
+        {'UserId': 2, 'PostTypeId': 1, 'Delta': 100, 'Text': 'upvote', 'Time': week(240)},
+        {'UserId': 2, 'PostTypeId': 1, 'Delta': 5, 'Text': 'upvote', 'Time': week(280)},
+        {'UserId': 3, 'PostTypeId': 1, 'Delta': 200, 'Text': 'upvote', 'Time': week(255)},
+    ]
+    write_rows(raw_dir / 'Users.json.gz', users)
+    write_rows(raw_dir / 'Posts.json.gz', posts)
+    write_rows(raw_dir / 'Reps.json.gz', reps)
+
+    _, posts_df, reps_df = compute_pandas_dataframes_local(raw_dir, MIN_REP, MAX_REP, chunksize=2, num_workers=2)
+    write_frame(posts_df, frames_dir, "posts_df", "pickle")
+    write_frame(reps_df, frames_dir, "reputation_df", "pickle")
+    p_events, r_events, _ = load_reputation_events(frames_dir, 100)
+    user_ids, activities = activity_at_threshold(p_events, r_events, 2, 100, [0, 1000])
+
+    # user 1 reaches 110 in week 255, the window is weeks 253 to 257
+    np.testing.assert_array_equal(user_ids, [1])
+    np.testing.assert_array_equal(activities[0], [
+        [0, 1, 0, 0, 0],  # questions
+        [0, 0, 2, 0, 0],  # answers
+        [0, 0, 0, 1, 0],  # edits
+        [50, 50, 110, 112, 112],  # reputation
+    ])
+
+
+def dataframes_of_whole_files(data_dir, min_rep, max_rep, time_type="week"):
+    '''compute_pandas_dataframes (the Spark joins and group-bys) on the whole json files read at once'''
+    start = datetime.datetime(2008, 7, 27)
+    seconds = {"week": 604800, "day": 86400}[time_type]
+
+    def read(name):
+        with gzip.open(f'{data_dir}/{name}.json.gz', 'rt') as f:
+            return [json.loads(line) for line in f]
+
+    def to_time(value):
+        return None if value is None else datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+
+    def time_id(t):
+        return np.nan if t is None else int((t - start).total_seconds()) // seconds
+
+    users = []
+    for u in read('Users'):
+        created = to_time(u.get('CreationDate'))
+        if u['Id'] != -1 and min_rep <= u['Reputation'] < max_rep and created > datetime.datetime(2012, 1, 1):
+            users.append({'UserId': u['Id'], 'UserRep': u['Reputation'], 'UserCreationDayId': time_id(created),
+                          'UserLastAccessDayId': time_id(to_time(u.get('LastAccessDate')))})
+    users_df = pd.DataFrame(users)
+    user_ids = set(users_df.UserId)
+
+    posts = pd.DataFrame([
+        {'UserId': p['OwnerUserId'], 'PostTimeId': time_id(to_time(p.get('CreationDate'))),
+         'PostTypeId': p.get('PostTypeId', np.nan)}
+        for p in read('Posts') if p.get('OwnerUserId') in user_ids
+    ])
+    posts_df = posts.groupby(['UserId', 'PostTimeId', 'PostTypeId'], dropna=False).size().rename('Count')
+
+    reps = pd.DataFrame([
+        {'UserId': r['UserId'], 'RepTimeId': time_id(to_time(r.get('Time'))),
+         'PostTypeId': r.get('PostTypeId', np.nan), 'RepText': r.get('Text', np.nan),
+         'RepDelta': r.get('Delta', np.nan)}
+        for r in read('Reps') if r.get('UserId') in user_ids
+    ])
+    grouped = reps.groupby(['UserId', 'RepTimeId', 'PostTypeId', 'RepText'], dropna=False).RepDelta
+    reps_df = pd.DataFrame({'Count': grouped.size(), 'Sum': grouped.sum(min_count=1)})
+    return users_df, posts_df.reset_index(), reps_df.reset_index()
+
+
+def test_local_backend_matches_the_whole_files(reputation_dump):
+    expected_users, expected_posts, expected_reps = dataframes_of_whole_files(reputation_dump, MIN_REP, MAX_REP)
+    # batches much smaller than the files, so the counts of a group are summed over batches
+    users_df, posts_df, reps_df = compute_pandas_dataframes_local(reputation_dump, MIN_REP, MAX_REP, chunksize=300,
+                                                                  num_workers=2)
+    assert len(expected_users) > 0
+    assert users_df.UserCreationTime.is_monotonic_increasing
+    pd.testing.assert_frame_equal(users_df[expected_users.columns].sort_values('UserId', ignore_index=True),
+                                  expected_users.sort_values('UserId', ignore_index=True), check_dtype=False)
+    for df, expected in [(posts_df, expected_posts), (reps_df, expected_reps)]:
+        keys = list(expected.columns[:-2 if 'Sum' in expected else -1])
+        df = df.sort_values(keys, ignore_index=True)
+        expected = expected.sort_values(keys, ignore_index=True)
+        assert len(expected) > 0
+        pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+
+
+def test_spark_windows_match_local_backend(reputation_dump, reputation_frames):
+    pytest.importorskip("pyspark")
+    from pyspark.sql import SparkSession
+    from reputation_study.convert_so_data_to_pandas import compute_activity_windows
+
+    p_events, r_events, _ = load_reputation_events(reputation_frames, TARGET_REPUTATION)
+    expected_ids, expected = activity_at_threshold(p_events, r_events, THRESHOLD_ACHIEVEMENT, TARGET_REPUTATION,
+                                                   REPUTATION_RANGE)
+    assert len(expected_ids) > 0
+
+    spark = (
+        SparkSession.builder
+        .master('local[2]')
+        .config('spark.sql.session.timeZone', 'UTC')
+        .config('spark.sql.shuffle.partitions', '4')
+        .appName('test_activity_windows')
+        .getOrCreate()
+    )
+    try:
+        users, posts, reps = [spark.read.format('json').load(f'{reputation_dump}/{name}.json.gz')
+                              for name in ['Users', 'Posts', 'Reps']]
+        user_ids, activities, _ = compute_activity_windows(
+            users, posts, reps, MIN_REP, MAX_REP, THRESHOLD_ACHIEVEMENT, TARGET_REPUTATION, REPUTATION_RANGE
+        )
+    finally:
+        spark.stop()
+
+    order = np.argsort(expected_ids)
+    np.testing.assert_array_equal(user_ids, np.asarray(expected_ids)[order])
+    np.testing.assert_array_equal(activities, np.asarray(expected)[order])
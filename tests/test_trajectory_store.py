@@ -0,0 +1,85 @@
+import os
+import glob
+
+import numpy as np
+import torch
+
+from so_study.trajectory_store import (
+    PACKED_CUMSUM, PackedTrajectories, SparseTrajectories, TorchFileTrajectories, pack_trajectory_directory,
+    sparsify_trajectory_directory, write_packed_trajectories
+)
+
+
+def user_ids(data_path):
+    return sorted(os.path.basename(f)[len('user_'):-len('.pt')] for f in glob.glob(f'{data_path}/user_*.pt'))
+
+
+def assert_same_trajectories(store, reference, users):
+    np.testing.assert_array_equal(store.lengths(users), reference.lengths(users))
+    for user in users:
+        np.testing.assert_array_equal(store[user].numpy(), reference[user].numpy())
+
+    # windows reaching over both ends of the trajectories are zero padded
+    lengths = reference.lengths(users)
+    for starts in [np.zeros(len(users)), lengths // 2, lengths - 10, np.full(len(users), -15)]:
+        starts = starts.astype(np.int64)
+        np.testing.assert_array_equal(store.windows(users, starts, 40), reference.windows(users, starts, 40))
+
+    days = lengths // 3
+    for columns in [0, [2, 3], [0, 1, 2, 3, 4, 5, 6]]:
+        for increment in [0, 5, 1000]:
+            increments = np.full(len(users), increment)
+            for a, b in zip(store.offset_days(users, days, increments, columns),
+                            reference.offset_days(users, days, increments, columns)):
+                np.testing.assert_array_equal(a, b)
+
+
+def test_packed_store_matches_pt_files(so_data_path, tmp_path):
+    users = user_ids(so_data_path)
+    reference = TorchFileTrajectories(so_data_path)
+
+    pack_trajectory_directory(so_data_path, str(tmp_path / 'packed'))
+    assert_same_trajectories(PackedTrajectories(str(tmp_path / 'packed')), reference, users)
+
+    X = [reference[u].numpy() for u in users]
+    offsets = np.concatenate([[0], np.cumsum([len(x) for x in X])])
+    write_packed_trajectories(str(tmp_path / 'stacked'), users, offsets, np.concatenate(X))
+    assert_same_trajectories(PackedTrajectories(str(tmp_path / 'stacked')), reference, users)
+    assert glob.glob(str(tmp_path / '*' / '*.tmp')) == []
+
+
+def test_repacking_drops_the_running_counts(so_data_path, tmp_path):
+    users = user_ids(so_data_path)
+    out_path = str(tmp_path / 'packed')
+    pack_trajectory_directory(so_data_path, out_path)
+    PackedTrajectories(out_path).offset_days(users, np.zeros(len(users), dtype=np.int64), np.ones(len(users)), 0)
+    assert len(glob.glob(os.path.join(out_path, PACKED_CUMSUM.format('*')))) == 1
+
+    torch.save(torch.ones((30, 7), dtype=torch.int64), f'{so_data_path}/user_{users[0]}.pt')
+    pack_trajectory_directory(so_data_path, out_path)
+    assert glob.glob(os.path.join(out_path, PACKED_CUMSUM.format('*'))) == []
+    first_days, on_day, totals = PackedTrajectories(out_path).offset_days(users[:1], [0], [5], 0)
+    assert (first_days[0], on_day[0], totals[0]) == (5, 1, 30)
+
+
+def test_sparse_store_matches_pt_files(so_data_path, tmp_path):
+    users = user_ids(so_data_path)
+    # a user without any activity has no events at all
+    torch.save(torch.zeros((50, 7), dtype=torch.int64), f'{so_data_path}/user_{users[-1]}.pt')
+    sparsify_trajectory_directory(so_data_path, str(tmp_path))
+    assert_same_trajectories(SparseTrajectories(str(tmp_path)), TorchFileTrajectories(so_data_path), users)
+    assert glob.glob(str(tmp_path / '*.tmp')) == []
+
+
+def test_running_counts_restart_at_every_user_across_chunks(tmp_path):
+    from so_study.trajectory_store import _write_cumsum
+
+    rng = np.random.RandomState(1)
+    lengths = [5, 0, 12, 1, 30, 7]
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    values = rng.randint(0, 4, size=(offsets[-1], 3))
+    fname = str(tmp_path / 'cumsum.npy')
+    for chunk_size in [1, 4, 7, 1000]:
+        _write_cumsum(fname, values, offsets, [0, 2], chunk_size=chunk_size)
+        expected = np.concatenate([np.cumsum(values[a:b][:, [0, 2]].sum(axis=1)) for a, b in zip(offsets, offsets[1:])])
+        np.testing.assert_array_equal(np.load(fname), expected)
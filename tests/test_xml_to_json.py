@@ -0,0 +1,74 @@
+import numpy as np
+
+from data_utils.xml_to_json import SCHEMAS, parse, parse_row, split_lines
+
+
+def lines_of_decoded_buffer(blocks):
+    '''The lines load_archive parsed when it decoded the whole accumulated buffer after every block'''
+    buf = b''
+    for block in blocks:
+        buf += block
+        try:
+            ss = buf.decode('utf8').split('\n')
+        except UnicodeDecodeError:
+            continue
+        for s in ss[:-1]:
+            yield s
+        buf = ss[-1].encode('utf8')
+
+
+def write_dump(rng, num_rows=300):
+    '''The xml of a dump table: one row per line, with multi-byte characters and rows longer than a block'''
+    words = ['plain', 'café', '中文', '\U0001f600 emoji', '&lt;b&gt;', 'x' * 500]
+    rows = ['<?xml version="1.0" encoding="utf-8"?>', '<posts>']
+    for i in range(num_rows):
+        body = ' '.join(rng.choice(words, size=rng.randint(1, 20)))
+        rows.append(f'  <row Id="{i}" Score="{rng.randint(-5, 50)}" Body="{body}" />')
+    # the dumps end without a newline after the closing tag
+    return ('\r\n'.join(rows) + '\r\n</posts>').encode('utf8')
+
+
+def test_split_lines_match_decoding_the_whole_buffer():
+    rng = np.random.RandomState(0)
+    data = write_dump(rng)
+    for block_size in [1, 7, 64, 4096, len(data)]:
+        # blocks cut at random byte positions, inside multi-byte characters too
+        cuts = np.unique(np.concatenate([np.arange(0, len(data), block_size), rng.randint(0, len(data), 20)]))
+        blocks = [data[a:b] for a, b in zip(cuts, np.append(cuts[1:], len(data)))]
+        assert b''.join(blocks) == data
+
+        expected = list(lines_of_decoded_buffer(blocks))
+        lines = list(split_lines(blocks))
+        # the line after the last newline is yielded too, it is the closing tag that parse skips
+        assert lines[:-1] == expected
+        assert lines[-1] == '</posts>'
+        assert [parse(s) for s in lines if parse(s) is not None] == \
+            [parse(s) for s in expected if parse(s) is not None]
+        assert len([s for s in lines if parse(s) is not None]) == 300
+
+
+# attribute values as they appear in the xml (escaped): integers, values int() takes that are not plain integers,
+# integers outside of what try_int converts and values that are no integer at all
+EDGE_VALUES = ['0', '42', '-5', '+7', '007', '', ' 3', '3 ', '\t4', '1_000', '\u0663', str(2 ** 63), str(2 ** 63 - 1),
+               str(-2 ** 63), str(-2 ** 63 + 1), '3.0', 'abc', '0x10', '&#51;', '&#x34;2', '1&amp;2', '12\r',
+               '\u00e9t\u00e9', '-', '&lt;5&gt;']
+
+
+def test_parse_row_matches_parse():
+    rng = np.random.RandomState(1)
+    for table, schema in SCHEMAS.items():
+        columns = list(schema) + ['CreationDate', 'Title', 'Extra']
+        rows = 0
+        for _ in range(500):
+            chosen = rng.choice(columns, size=rng.randint(1, len(columns)), replace=False)
+            attributes = ' '.join(f'{c}="{rng.choice(EDGE_VALUES)}"' for c in chosen)
+            line = f'  <row {attributes} />'
+            expected = parse(line)
+            assert parse_row(line, schema) == expected, line
+            assert parse_row(line) == expected, line
+            rows += expected is not None
+        assert rows == 500
+
+    for line in ['<posts>', '</posts>', '<row Id="1" Body="a & b" />', '<row Id="1"', '']:
+        assert parse(line) is None
+        assert parse_row(line, SCHEMAS['Posts']) is None